@@ -1,6 +1,6 @@
 """ Simple pixel-composition library.
 
-Dependencies: numpy, sympy, PIL.
+Dependencies: numpy, PIL.
 
 Blit performs basic, Photoshop-style layer compositions with blend modes
 and selected adjustments, using Numpy internally to perform all math.
@@ -20,25 +20,62 @@ and Blit.photoshop for PSD file output support.
 """
 __version__ = 'N.N.N'
 
+import threading
+
 import numpy
-import Image
 
 from . import blends
 from . import adjustments
+from . import encode
+from . import workers
+from . import cache
+from . import memory
 from . import utils
 
 class Layer:
     """ Represents a raster layer that can be combined with other layers.
     """
-    def __init__(self, channels):
+    def __init__(self, channels, origin=(0, 0)):
         """ Channels is a four-element list of numpy arrays: red, green, blue, alpha.
+        
+            Origin is an optional x, y position of the top-left pixel,
+            used to place small layers on a larger canvas.
+            
+            Channel arrays are made read-only, so that they can be shared
+            between layers instead of copied.
         """
+        for chan in channels:
+            chan.flags.writeable = False
+        
         self._rgba = channels
+        self._origin = tuple(origin)
+    
+    def __getstate__(self):
+        """ Return attributes for pickling, with channels as contiguous arrays.
+        
+            Channels shared between layers are pickled just once. Contiguous
+            arrays could also be passed out-of-band, but that needs pickle
+            protocol 5, which isn't available on Python 2.
+        """
+        channels = [numpy.ascontiguousarray(chan) for chan in self._rgba]
+        
+        return dict(self.__dict__, _rgba=channels)
+    
+    def __setstate__(self, state):
+        """ Restore pickled attributes, and make channels read-only again.
+        """
+        self.__dict__.update(state)
+        Layer.__init__(self, self._rgba, self._origin)
 
     def size(self):
         """ Return width and height of the raster layer in pixels.
         """
-        return self._rgba[0].shape[1], self._rgba[0].shape[0]
+        return self._rgba[0].shape[-1], self._rgba[0].shape[-2]
+    
+    def origin(self):
+        """ Return x and y position of the raster layer's top-left pixel.
+        """
+        return self._origin
     
     def rgba(self, width, height):
         """ Return a list of numpy arrays, one for each channel.
@@ -46,35 +83,157 @@ class Layer:
             Width and height are required, and the resulting channels
             will be clipped or extended to match the requested size.
         """
-        w, h = self.size()
+        return self.region(0, 0, width, height)
+    
+    def region(self, left, top, width, height):
+        """ Return a list of numpy arrays for a rectangle of the canvas.
         
-        if w == width and h == height:
-            return self._rgba
-
-        #
-        # In theory, this should bring back a right-sized image.
-        #
-        r, g, b, a = [numpy.zeros((height, width), dtype=float) for i in '1234']
-
-        w = min(w, width)
-        h = min(h, height)
+            The layer is placed at its origin, and areas of the rectangle
+            outside the layer are transparent black. If the rectangle falls
+            entirely within the layer, the channels are views, not copies.
+        """
+        return [_crop(chan, self.origin(), left, top, width, height) for chan in self._rgba]
+    
+    def luminance(self, left, top, width, height):
+        """ Return a single numpy array of luminance for a rectangle of the canvas.
+        
+            Used for masks, see utils.rgba2lum() for details. Luminance
+            is of sRGB values, whatever the color space.
+        """
+        rgba = self.region(left, top, width, height)
+        return utils.rgba2lum([utils.color2srgb(chan) for chan in rgba[0:3]])
+    
+    def transparent(self):
+        """ Return true if the layer is completely transparent.
+        """
+        return self._constant(3) == 0
+    
+    def opaque(self):
+        """ Return true if the layer is completely opaque.
+        """
+        return self._constant(3) == 1
+    
+    def uniform(self):
+        """ Return (red, green, blue, alpha) floats if the layer is a single color.
         
-        r[:w,:h] = self._rgba[0][:h,:w]
-        g[:w,:h] = self._rgba[1][:h,:w]
-        b[:w,:h] = self._rgba[2][:h,:w]
-        a[:w,:h] = self._rgba[3][:h,:w]
+            Return None if the layer has more than one color in it.
+        """
+        values = [self._constant(index) for index in range(4)]
         
-        return r, g, b, a
+        if None in values:
+            return None
+        
+        return tuple(values)
+    
+    def _constant(self, index):
+        """ Return the single value of one channel, or None if it varies.
+        
+            Computed on first use and remembered after that.
+        """
+        constants = self.__dict__.setdefault('_constants', {})
+        
+        if index not in constants:
+            constants[index] = utils.chan2constant(self._rgba[index])
+        
+        return constants[index]
+    
+    def _uniform_luminance(self):
+        """ Return the single luminance value of the layer, or None if it varies.
+        """
+        red, green, blue = [self._constant(index) for index in range(3)]
+        
+        if None in (red, green, blue):
+            return None
+        
+        red, green, blue = [float(utils.color2srgb(value)) for value in (red, green, blue)]
+        
+        return 0.299 * red + 0.587 * green + 0.114 * blue
     
     def image(self):
         """ Generate a new PIL Image representation of the contained channels.
         """
         return utils.rgba2img(self._rgba)
     
+    def strips(self, rows):
+        """ Generate a new Layer for each strip of rows, top to bottom.
+        
+            Strips share channel data with this layer instead of copying it.
+        """
+        (x, y), (width, height) = self.origin(), self.size()
+        
+        for top in range(y, y + height, rows):
+            strip_height = min(rows, y + height - top)
+            yield _layer(self.region(x, top, width, strip_height), (x, top))
+    
+    def pyramid(self, levels):
+        """ Return a list of this layer and up to levels successive 2x reductions.
+        
+            See reductions() for details.
+        """
+        return [self] + list(self.reductions(levels))
+    
+    def reductions(self, levels=None):
+        """ Generate successive 2x reductions of the layer, for zoom levels.
+        
+            Each pixel is the mean of up to four below it, premultiplied by
+            alpha so that transparent pixels don't bleed into edges. Each
+            level is reduced from the one before, and stops after levels or
+            at a single pixel. Origins are halved along with sizes.
+        """
+        (x, y), (width, height) = self.origin(), self.size()
+        red, green, blue, alpha = self.region(x, y, width, height)
+        
+        premultiplied = [chan * alpha for chan in (red, green, blue)] + [alpha]
+        count = 0
+        
+        while (levels is None or count < levels) and (width > 1 or height > 1):
+            premultiplied = _halved(premultiplied)
+            (x, y), count = (x // 2, y // 2), count + 1
+            height, width = premultiplied[3].shape[-2:]
+            
+            yield _layer(_straight(premultiplied), (x, y))
+    
+    def save(self, outfile, format='PNG', rows=64, palette=None):
+        """ Save an image to a named file or file-like object.
+        
+            Format may be PNG or JPEG. Rows are encoded a strip at a time,
+            see Blit.encode for details.
+            
+            Optional palette makes an indexed color PNG: either a number of
+            colors to choose from this layer, or a palette from encode.palette().
+            Files opened here from a name are closed when done.
+        """
+        if format.upper() not in ('PNG', 'JPG', 'JPEG'):
+            raise ValueError('Unknown format "%s"' % format)
+        
+        width, height = self.size()
+        strips = self.strips(rows)
+        
+        if type(palette) is int:
+            palette = encode.palette(self.region(*(self.origin() + self.size())), palette)
+        
+        opened = not hasattr(outfile, 'write')
+        
+        if opened:
+            outfile = open(outfile, 'wb')
+        
+        try:
+            if format.upper() == 'PNG':
+                encode.png(outfile, width, height, strips, palette=palette)
+            else:
+                encode.jpeg(outfile, width, height, strips)
+        finally:
+            if opened:
+                outfile.close()
+    
     def blend(self, other, mask=None, opacity=1, blendfunc=None):
         """ Return a new Layer, with data from another layer blended on top.
         
-            See blends.combine() for details on blend functions.
+            The new layer has the size and origin of this one, and blending
+            is only computed where other layer and mask overlap it.
+        
+            See blends.combine() for details on blend functions. Blends over
+            a budget set in Blit.memory may be computed a strip at a time.
         """
         no_dim = False
         
@@ -82,67 +241,566 @@ class Layer:
         # Choose an output size based on the first input that has one.
         #
         if self.size():
-            dim = self.size()
+            dim, origin = self.size(), self.origin()
         elif other.size():
-            dim = other.size()
+            dim, origin = other.size(), other.origin()
         elif mask and mask.size():
-            dim = mask.size()
+            dim, origin = mask.size(), mask.origin()
         else:
             no_dim = True
-            dim = 1, 1
+            dim, origin = (1, 1), (0, 0)
         
-        bottom_rgba = self.rgba(*dim)
-        alpha_chan = other.rgba(*dim)[3]
-        top_rgb = other.rgba(*dim)[0:3]
+        canvas = origin + dim
         
-        if mask is not None:
-            # Multiply alpha channel by mask image luminance
-            alpha_chan *= utils.rgba2lum(mask.rgba(*dim))
+        #
+        # Narrow the blended area to where other layer and mask can have an effect.
+        #
+        left, top = origin
+        right, bottom = left + dim[0], top + dim[1]
+        
+        for layer in (other, mask):
+            if layer is not None and layer.size():
+                (x, y), (w, h) = layer.origin(), layer.size()
+                left, top = max(left, x), max(top, y)
+                right, bottom = min(right, x + w), min(bottom, y + h)
+        
+        area = left, top, right - left, bottom - top
+        mask_value = None if mask is None else mask._uniform_luminance()
+        
+        # uniform inputs and shortcuts still return a batch if any input is one
+        batch = _batch_shape(self, other, mask)
+        
+        if right <= left or bottom <= top or (not no_dim and (opacity == 0
+           or other.transparent() or mask_value == 0)):
+            # no overlap or nothing visible, nothing to blend
+            return _layer(_batched(self.region(*canvas), batch), origin)
+        
+        if not no_dim and area == canvas and opacity == 1 and not blendfunc and other.opaque() \
+        and (mask is None or mask_value == 1) and not isinstance(self, LayerBatch):
+            # plain paste of an opaque layer hides this one entirely
+            return _layer(_batched(other.region(*canvas), batch), origin)
+        
+        over_budget = memory.blend_strips(self, canvas, area)
+        
+        if over_budget:
+            strategy, rows = over_budget
+            return self._blend_strips(strategy, rows, other, mask, opacity, blendfunc)
+        
+        bottom_rgba = self.region(*area)
+        top_rgba = other.uniform()
         
+        if top_rgba is None:
+            top_rgba = other.region(*area)
+        else:
+            # single-color layer is treated like a Color, without full-size arrays
+            top_rgba = [numpy.array(value) for value in top_rgba]
+        
+        alpha_chan = top_rgba[3]
+        top_rgb = top_rgba[0:3]
+        
+        if mask_value is not None:
+            # Multiply alpha channel by uniform mask luminance
+            alpha_chan = alpha_chan * mask_value
+        
+        elif mask is not None:
+            # Multiply alpha channel by mask image luminance
+            alpha_chan = alpha_chan * mask.luminance(*area)
+
+
         output_rgba = blends.combine(bottom_rgba, top_rgb, alpha_chan, opacity, blendfunc)
         
         if no_dim:
-            rgba = [chan[0,0] * 255 for chan in output_rgba]
-            return Color(*rgba)
+            return _color([chan[0,0] for chan in output_rgba])
         
-        return Layer(output_rgba)
+        if area != canvas:
+            #
+            # Paste blended area back into a copy of the full bottom layer.
+            #
+            blended_rgba, output_rgba = output_rgba, []
+            
+            for (base, chan) in zip(self.region(*canvas), blended_rgba):
+                # bottom may be a single layer under a batch
+                out = numpy.empty(chan.shape[:-2] + base.shape[-2:], base.dtype)
+                out[...] = base
+                out[..., top-origin[1]:bottom-origin[1], left-origin[0]:right-origin[0]] = chan
+                output_rgba.append(out)
+        
+        return _layer(_batched(output_rgba, batch), origin)
+    
+    def _blend_strips(self, strategy, rows, other, mask, opacity, blendfunc):
+        """ Return a new Layer like blend(), computed a strip of rows at a time.
+        
+            Strategy is "strips" for output channels in memory, or "disk"
+            for scratch files in a new DiskLayer, see Blit.memory.
+        """
+        from . import disk
+        
+        (x, y), (width, height) = self.origin(), self.size()
+        output_rgba = None
+        
+        for strip in self.strips(rows):
+            top = strip.origin()[1] - y
+            rgba = strip.blend(other, mask, opacity, blendfunc).region(*(strip.origin() + strip.size()))
+            
+            if output_rgba is None:
+                # other layer may be a batch over a single bottom layer
+                shape = rgba[0].shape[:-2] + (height, width)
+                new = disk.scratch if strategy == 'disk' else numpy.empty
+                output_rgba = [new(shape, chan.dtype) for chan in rgba]
+            
+            for (chan, part) in zip(output_rgba, rgba):
+                chan[..., top:top+part.shape[-2], :] = part
+        
+        if strategy == 'disk' and output_rgba[0].ndim == 2:
+            return disk.DiskLayer(output_rgba, (x, y), rows)
+        
+        return _layer(output_rgba, (x, y))
     
     def adjust(self, adjustfunc):
+        """ Return a new Layer with an adjustment function applied to its channels.
+        
+            Raise memory.OverBudget for adjustments over a budget set in Blit.memory.
+        """
+        memory.check(memory.adjust_bytes(self), 'Adjustment')
+        return _layer(adjustfunc(self._rgba), self.origin())
+    
+    def blend_async(self, other, mask=None, opacity=1, blendfunc=None, executor=None):
+        """ Return a workers.Job for blend() called on a worker thread.
+        
+            Executor is optional, see Blit.workers for details.
+        """
+        executor = executor or workers.default()
+        return executor.submit(self.blend, other, mask, opacity, blendfunc)
+    
+    def adjust_async(self, adjustfunc, executor=None):
+        """ Return a workers.Job for adjust() called on a worker thread.
         """
+        executor = executor or workers.default()
+        return executor.submit(self.adjust, adjustfunc)
+    
+    def image_async(self, executor=None):
+        """ Return a workers.Job for image() called on a worker thread.
         """
-        return Layer(adjustfunc(self._rgba))
+        executor = executor or workers.default()
+        return executor.submit(self.image)
+
+class LayerBatch (Layer):
+    """ Stack of identically-sized layers, blended and adjusted all at once.
+    
+        Channels carry a leading batch axis, so one call to blend() or
+        adjust() processes every layer in the stack. Single layers, masks
+        and colors used with a batch are broadcast across all of it.
+    """
+    def __init__(self, layers, origin=(0, 0)):
+        """ Layers is a list of same-sized Layers, or a four-element list
+            of numpy arrays with shape (count, height, width).
+        """
+        if layers and isinstance(layers[0], Layer):
+            origin, size = layers[0].origin(), layers[0].size()
+            channels = zip(*[layer.region(*(origin + size)) for layer in layers])
+            layers = [numpy.array(chans) for chans in channels]
+        
+        Layer.__init__(self, layers, origin)
+    
+    def __len__(self):
+        return self._rgba[0].shape[0]
+    
+    def __getitem__(self, index):
+        """ Return a single Layer from the stack, sharing its channel data.
+        """
+        return Layer([chan[index] for chan in self._rgba], self.origin())
+    
+    def image(self):
+        """ Generate a list of new PIL Images, one for each layer.
+        """
+        return [self[index].image() for index in range(len(self))]
+
+def _batch_shape(*layers):
+    """ Return the leading batch axes of the first LayerBatch among layers, or ().
+    """
+    for layer in layers:
+        if isinstance(layer, LayerBatch):
+            return layer._rgba[0].shape[:-2]
+    
+    return ()
+
+def _batched(channels, batch):
+    """ Return channels broadcast to leading batch axes, as read-only views if needed.
+    """
+    return [chan if chan.shape[:-2] == batch else numpy.broadcast_to(chan, batch + chan.shape[-2:])
+            for chan in channels]
+
+def _crop(chan, origin, left, top, width, height):
+    """ Return a rectangle of the canvas from a channel placed at an origin.
+    
+        Areas outside the channel are zero. If the rectangle falls entirely
+        within the channel, return a view instead of a copy.
+    """
+    x, y = origin
+    h, w = chan.shape[-2:]
+    
+    # rectangle relative to the channel
+    left, top = left - x, top - y
+    
+    if left >= 0 and top >= 0 and left + width <= w and top + height <= h:
+        return chan[..., top:top+height, left:left+width]
+    
+    out = numpy.zeros(chan.shape[:-2] + (height, width), dtype=chan.dtype)
+    
+    # overlap of the rectangle and the channel, in channel coordinates
+    x1, y1 = max(left, 0), max(top, 0)
+    x2, y2 = min(left + width, w), min(top + height, h)
+    
+    if x2 > x1 and y2 > y1:
+        out[..., y1-top:y2-top, x1-left:x2-left] = chan[..., y1:y2, x1:x2]
+    
+    return out
+
+def _halved(channels):
+    """ Return new channels at half size, each pixel the mean of up to four.
+    
+        Odd rows and columns at the edges are the mean of just two or one.
+    """
+    height, width = channels[0].shape[-2:]
+    rows = numpy.array([2] * (height // 2) + [1] * (height % 2), numpy.float32)
+    columns = numpy.array([2] * (width // 2) + [1] * (width % 2), numpy.float32)
+    counts = numpy.outer(rows, columns)
+    
+    out = []
+    
+    for chan in channels:
+        if height % 2 or width % 2:
+            padded = numpy.zeros(chan.shape[:-2] + (height + height % 2, width + width % 2), chan.dtype)
+            padded[..., :height, :width] = chan
+            chan = padded
+        
+        # pairs of rows and columns on axes of their own, summed together
+        shape = chan.shape[:-2] + (len(rows), 2, len(columns), 2)
+        out.append(chan.reshape(shape).sum(axis=-1).sum(axis=-2) / counts)
+    
+    return out
+
+def _straight(channels):
+    """ Return new channels with colors no longer premultiplied by alpha.
+    """
+    red, green, blue, alpha = channels
+    visible = alpha > 0
+    out = []
+    
+    for chan in (red, green, blue):
+        chan = numpy.divide(chan, alpha, where=visible, out=numpy.zeros_like(chan))
+        out.append(numpy.clip(chan, 0, 1, out=chan))
+    
+    return out + [alpha]
+
+def _color(rgba):
+    """ Return a new Color from four channel values between zero and one.
+    """
+    red, green, blue = utils.color2srgb(rgba[0:3])
+    return Color(red * 255, green * 255, blue * 255, rgba[3] * 255)
+
+def _layer(channels, origin):
+    """ Return a Layer or LayerBatch as appropriate for the channels.
+    """
+    if channels[0].ndim > 2:
+        return LayerBatch(channels, origin)
+    
+    return Layer(channels, origin)
 
 class Bitmap (Layer):
     """ Raster layer instantiated with a bitmap image.
+    
+        Decoding is lazy: size() is read from the image header, regions
+        are converted to channels one rectangle at a time, and the whole
+        image is converted only when something needs all of it.
+        
+        Whole images decoded from file names are kept in Blit.cache.
+        Decoding is guarded by a lock, so one Bitmap can be shared between
+        threads, e.g. by jobs in a Blit.workers.Executor.
+    """
+    def __init__(self, input, origin=(0, 0), scale=1):
+        """ Input is a PIL Image or file name, origin an optional x, y position.
+        
+            Scale is an optional factor for decoding at reduced resolution,
+            e.g. .25 for a quarter-size thumbnail. JPEG files are decoded
+            at the smallest sufficient size to begin with.
+        """
+        self._key = None
+        self._lock = threading.RLock()
+        
+        if type(input) in (str, unicode):
+            self._key = cache.key(input, scale, utils.colorspace())
+            rgba = cache.get(self._key)
+            
+            if rgba is not None:
+                Layer.__init__(self, rgba, origin)
+                self._size = Layer.size(self)
+                return
+            
+            import Image
+            input = Image.open(input)
+        
+        else:
+            # a private copy, so later changes to the caller's image don't show
+            input = input.copy()
+        
+        width, height = input.size
+        
+        self._image = input
+        self._size = max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+        self._origin = tuple(origin)
+    
+    def __getattr__(self, name):
+        """ Convert the whole image to channels on first use of them.
+        """
+        if name != '_rgba':
+            raise AttributeError(name)
+        
+        with self._lock:
+            image = self._decode()
+            
+            # another thread may have converted it while this one waited
+            if image is not None:
+                Layer.__init__(self, utils.img2rgba(image), self._origin)
+                del self._image
+                
+                if self._key is not None:
+                    cache.put(self._key, self._rgba)
+        
+        return self.__dict__['_rgba']
+    
+    def __getstate__(self):
+        """ Return attributes for pickling, without the lock.
+        """
+        state = Layer.__getstate__(self)
+        del state['_lock']
+        
+        return state
+    
+    def __setstate__(self, state):
+        """ Restore pickled attributes and a new lock.
+        """
+        Layer.__setstate__(self, state)
+        self._lock = threading.RLock()
+    
+    def size(self):
+        """ Return width and height of the raster layer in pixels.
+        """
+        return self._size
+    
+    def region(self, left, top, width, height):
+        """ Return a list of numpy arrays for a rectangle of the canvas.
+        
+            Until the whole image is needed, only the overlapping part
+            of the image is converted to channels.
+        """
+        (x, y), (w, h) = self._origin, self._size
+        
+        # overlap of the rectangle and the image, in image coordinates
+        x1, y1 = max(left - x, 0), max(top - y, 0)
+        x2, y2 = min(left + width - x, w), min(top + height - y, h)
+        
+        if '_rgba' in self.__dict__ or (x1, y1, x2, y2) == (0, 0, w, h):
+            return Layer.region(self, left, top, width, height)
+        
+        if x2 <= x1 or y2 <= y1:
+            return [_crop(numpy.zeros((0, 0), numpy.float32), (x, y), left, top, width, height)
+                    for band in 'rgba']
+        
+        image = self._decode()
+        
+        if image is None:
+            return Layer.region(self, left, top, width, height)
+        
+        rgba = utils.img2rgba(image.crop((x1, y1, x2, y2)))
+        
+        return [_crop(chan, (x + x1, y + y1), left, top, width, height) for chan in rgba]
+    
+    def _constant(self, index):
+        """ Return the single value of one channel, or None if it varies.
+        
+            Read from 8-bit extrema while the image is still undecoded.
+        """
+        if '_rgba' in self.__dict__:
+            return Layer._constant(self, index)
+        
+        constants = self.__dict__.get('_constants')
+        
+        if constants is None:
+            image = self._decode()
+            
+            if image is None:
+                return Layer._constant(self, index)
+            
+            # one pass over the image gives extrema of every band
+            constants = {}
+            
+            for (band, (lo, hi)) in enumerate(image.getextrema()):
+                value = utils.ubyte2color(lo) if band < 3 else numpy.float32(lo) / 255
+                constants[band] = float(value) if lo == hi else None
+            
+            self._constants = constants
+        
+        return constants[index]
+    
+    def _decode(self):
+        """ Return an RGBA PIL Image at the final size, decoding it on first use.
+        
+            Return None once the whole image has been converted to channels.
+        """
+        with self._lock:
+            return self._decode_image()
+    
+    def _decode_image(self):
+        """ Decode the image to RGBA at the final size, with the lock held.
+        """
+        if '_image' not in self.__dict__:
+            return None
+        
+        image = self._image
+        
+        if image.size == self._size and image.mode == 'RGBA':
+            return image
+        
+        if image.size != self._size:
+            import Image
+            
+            # no-op for anything but JPEG, which then decodes at 1/2, 1/4 or 1/8
+            image.draft(image.mode, self._size)
+            image = image.convert('RGBA')
+            
+            # integer reduction in newer PIL versions is cheaper than resampling
+            factor = min(image.size[0] // self._size[0], image.size[1] // self._size[1])
+            
+            if factor > 1 and hasattr(image, 'reduce'):
+                image = image.reduce(factor)
+            
+            if image.size != self._size:
+                image = image.resize(self._size, Image.ANTIALIAS)
+        
+        self._image = image.convert('RGBA')
+        
+        return self._image
+
+class Mask (Layer):
+    """ Single-channel greyscale layer, typically used as a mask.
+    
+        Stores one luminance channel instead of four, and is accepted
+        anywhere a mask layer is. As a layer, it's opaque grey.
     """
-    def __init__(self, input):
-        """ Input is a PIL Image or file name.
+    def __init__(self, input, origin=(0, 0)):
+        """ Input is a PIL Image or file name, a Layer, or a 2D numpy array.
+        
+            Origin is an optional x, y position. Layers keep their own.
         """
         if type(input) in (str, unicode):
+            import Image
             input = Image.open(input)
         
-        self._rgba = utils.img2rgba(input.convert('RGBA'))
+        if isinstance(input, Layer):
+            origin = input.origin()
+            chan = input.luminance(*(origin + input.size()))
+        
+        elif isinstance(input, numpy.ndarray):
+            chan = input
+        
+        else:
+            chan = utils.img2chan(input.convert('L'))
+        
+        # red, green and blue share the one channel, and alpha takes no memory
+        alpha = numpy.broadcast_to(numpy.ones((), chan.dtype), chan.shape)
+        Layer.__init__(self, [chan, chan, chan, alpha], origin)
+        self._lum = chan
+    
+    def __getstate__(self):
+        """ Return attributes for pickling, with just the one channel.
+        """
+        state = dict(self.__dict__, _lum=numpy.ascontiguousarray(self._lum))
+        del state['_rgba']
+        
+        return state
+    
+    def __setstate__(self, state):
+        """ Restore pickled attributes, and the shared channels.
+        """
+        self.__dict__.update(state)
+        Mask.__init__(self, self._lum, self._origin)
+    
+    def luminance(self, left, top, width, height):
+        """ Return the luminance channel for a rectangle of the canvas.
+        """
+        return _crop(self._lum, self.origin(), left, top, width, height)
+    
+    def image(self):
+        """ Generate a new greyscale PIL Image of the mask.
+        """
+        return utils.chan2img(self._lum)
+    
+    def adjust(self, adjustfunc):
+        """ Return a new Mask with the luminance of an adjusted layer.
+        """
+        # channels of masks are not colors, so they skip utils.color2srgb()
+        adjusted = Layer.adjust(self, adjustfunc)
+        return Mask(utils.rgba2lum(adjusted.region(*(self.origin() + self.size()))), self.origin())
+    
+    def _uniform_luminance(self):
+        """ Return the single luminance value of the mask, or None if it varies.
+        """
+        return self._constant(0)
+    
+    def _constant(self, index):
+        """ Return the single value of one channel, or None if it varies.
+        """
+        if index == 3:
+            return 1.0
+        
+        # one check covers red, green and blue
+        return Layer._constant(self, 0)
 
 class Color (Layer):
     """ Simple single-color layer of indeterminate size.
     """
     def __init__(self, red, green, blue, alpha=0xFF):
         """ Red, green, blue and alpha are 8-bit channel values. Alpha optional.
+        
+            Red, green and blue are sRGB, see utils.colorspace().
+        """
+        red, green, blue = [float(value) for value in utils.srgb2color([red / 255., green / 255., blue / 255.])]
+        self._components = red, green, blue, alpha / 255.
+    
+    def __getstate__(self):
+        """ Return attributes for pickling, just the color.
         """
-        self._components = red / 255., green / 255., blue / 255., alpha / 255.
+        return self.__dict__
+    
+    def __setstate__(self, state):
+        """ Restore pickled attributes.
+        """
+        self.__dict__.update(state)
     
     def size(self):
         """ Return nothing so it's clear that a color has no intrinsic size.
         """
         return None
     
+    def origin(self):
+        """ Return nothing so it's clear that a color has no intrinsic position.
+        """
+        return None
+    
+    def _constant(self, index):
+        """ Return the value of one channel.
+        """
+        return self._components[index]
+    
     def image(self):
         """ Return a fresh 1x1 image with the correct color.
         """
-        color = [int(c * 255) for c in self._components]
+        import Image
+        color = [int(round(c * 255)) for c in list(utils.color2srgb(self._components[0:3])) + [self._components[3]]]
         return Image.new('RGBA', (1, 1), tuple(color))
     
-    def rgba(self, width, height):
+    def region(self, left, top, width, height):
         """ Generate a new list of channel arrays for the given dimensions.
         """
         r = numpy.ones((height, width)) * self._components[0]
@@ -158,7 +816,5 @@ class Color (Layer):
         # make a list of 1x1 arrays as though this was a bitmap
         rgba = [numpy.ones((1, 1), dtype=float) * c for c in self._components]
 
-        # apply adjustment to arrays and turn them back into 8-bit components
-        rgba = [chan[0,0] * 255 for chan in adjustfunc(rgba)]
-        
-        return Color(*rgba)
+        # apply adjustment to arrays and turn them back into a color
+        return _color([chan[0,0] for chan in adjustfunc(rgba)])
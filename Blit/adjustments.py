@@ -2,11 +2,21 @@
 
 An adjustment is a function that takes a list of four identically-sized channel
 arrays (red, green, blue, and alpha) and returns a new list of four channels.
+Input arrays are read-only; unchanged channels can be returned as they are.
 The factory functions in this module return functions that perform adjustments.
+
+Adjustments work element by element, so channel arrays may also be stacked
+with a leading batch axis as in Blit.LayerBatch. The spatial filters blur(),
+glow(), drop_shadow(), hillshade() and slope() work across the last two axes.
 """
-import sympy
+import threading
+import math
+
 import numpy
 
+from . import backends
+from . import utils
+
 def threshold(red_value, green_value=None, blue_value=None):
     """ Return a function that applies a threshold operation.
     """
@@ -20,14 +30,10 @@ def threshold(red_value, green_value=None, blue_value=None):
     def adjustfunc(rgba):
         red, green, blue, alpha = rgba
         
-        red[red > red_value] = 1
-        red[red <= red_value] = 0
-        
-        green[green > green_value] = 1
-        green[green <= green_value] = 0
-        
-        blue[blue > blue_value] = 1
-        blue[blue <= blue_value] = 0
+        # new arrays, input channels may be shared and read-only
+        red = (red > red_value).astype(red.dtype)
+        green = (green > green_value).astype(green.dtype)
+        blue = (blue > blue_value).astype(blue.dtype)
         
         return red, green, blue, alpha
     
@@ -48,26 +54,16 @@ def curves(black, grey, white):
     # knowns are given in 0-255 range, need to be converted to floats
     black, grey, white = black / 255.0, grey / 255.0, white / 255.0
     
-    # coefficients
-    a, b, c = [sympy.Symbol(n) for n in 'abc']
-    
-    # black, gray, white
-    eqs = [a * black**2 + b * black + c - 0.0,
-           a *  grey**2 + b *  grey + c - 0.5,
-           a * white**2 + b * white + c - 1.0]
-    
-    co = sympy.solve(eqs, a, b, c)
+    # coefficients for black, gray, white
+    do, re, mi = _quadratic([(black, 0.0), (grey, 0.5), (white, 1.0)])
     
     def adjustfunc(rgba):
         red, green, blue, alpha = rgba
     
-        # arrays for each coefficient
-        do, re, mi = [float(co[n]) * numpy.ones(red.shape, numpy.float32) for n in (a, b, c)]
-        
         # arithmetic
-        red   = numpy.clip(do * red**2   + re * red   + mi, 0, 1)
-        green = numpy.clip(do * green**2 + re * green + mi, 0, 1)
-        blue  = numpy.clip(do * blue**2  + re * blue  + mi, 0, 1)
+        red   = _curve(red,   do, re, mi)
+        green = _curve(green, do, re, mi)
+        blue  = _curve(blue,  do, re, mi)
         
         return red, green, blue, alpha
     
@@ -97,32 +93,303 @@ def curves2(map_red, map_green=None, map_blue=None):
     if map_green is None or map_blue is None:
         # if there aren't three provided, use the one
         map_green, map_blue = map_red, map_red
+    
+    # parameters given in 0-255 range, need to be converted to floats
+    coefficients = [_quadratic([(in_ / 255.0, out_ / 255.0) for (in_, out_) in input])
+                    for input in (map_red, map_green, map_blue)]
 
     def adjustfunc(rgba):
         red, green, blue, alpha = rgba
         out = []
         
-        for (chan, input) in ((red, map_red), (green, map_green), (blue, map_blue)):
-            # coefficients
-            a, b, c = [sympy.Symbol(n) for n in 'abc']
-            
-            # parameters given in 0-255 range, need to be converted to floats
-            (in_1, out_1), (in_2, out_2), (in_3, out_3) \
-                = [(in_ / 255.0, out_ / 255.0) for (in_, out_) in input]
-            
-            # quadratic function
-            eqs = [a * in_1**2 + b * in_1 + c - out_1,
-                   a * in_2**2 + b * in_2 + c - out_2,
-                   a * in_3**2 + b * in_3 + c - out_3]
-            
-            co = sympy.solve(eqs, a, b, c)
-            
-            # arrays for each coefficient
-            a, b, c = [float(co[n]) * numpy.ones(chan.shape, numpy.float32) for n in (a, b, c)]
-            
-            # arithmetic
-            out.append(numpy.clip(a * chan**2 + b * chan + c, 0, 1))
+        for (chan, (a, b, c)) in zip((red, green, blue), coefficients):
+            out.append(_curve(chan, a, b, c))
         
         return out + [alpha]
     
     return adjustfunc
+
+def blur(radius):
+    """ Return a function that applies an approximately Gaussian blur.
+    
+        Radius is the standard deviation in pixels. Three running-sum box
+        filters in each direction stand in for the Gaussian, so cost stays
+        the same for any radius. Colors are blurred premultiplied by alpha,
+        and areas outside the layer count as transparent.
+        
+        Blurred Masks are still Masks, for feathered edges:
+            feathered = mask.adjust(blur(4))
+    """
+    radii = _box_radii(radius)
+    
+    def adjustfunc(rgba):
+        return _blurred(rgba, radii)
+    
+    return adjustfunc
+
+def glow(radius, red, green, blue, strength=1):
+    """ Return a function that surrounds a layer with a glow of solid color.
+    
+        Color is given in 0-255 sRGB range. Radius is the blur of the layer's
+        alpha channel, see blur(), and strength multiplies it: two or three
+        make a solid halo around map labels. Layers should have room around
+        their contents, since nothing outside them can glow.
+    """
+    radii = _box_radii(radius)
+    srgb = red / 255.0, green / 255.0, blue / 255.0
+    
+    def adjustfunc(rgba):
+        color = utils.srgb2color(srgb)
+        halo = _spread(rgba[3], radii)
+        
+        if strength != 1:
+            numpy.clip(halo * strength, 0, 1, out=halo)
+        
+        return _under(rgba, color, halo)
+    
+    return adjustfunc
+
+def drop_shadow(x, y, radius, opacity=.5, red=0, green=0, blue=0):
+    """ Return a function that adds a blurred shadow beneath a layer.
+    
+        Shadow is offset by x, y pixels and blurred by radius, see blur().
+        Color is given in 0-255 sRGB range, black by default.
+    """
+    radii = _box_radii(radius)
+    srgb = red / 255.0, green / 255.0, blue / 255.0
+    
+    def adjustfunc(rgba):
+        color = utils.srgb2color(srgb)
+        alpha = rgba[3]
+        height, width = alpha.shape[-2:]
+        dx, dy = max(-width, min(x, width)), max(-height, min(y, height))
+        
+        # offset alpha, with nothing coming in from the edges
+        shadow = numpy.zeros(alpha.shape, numpy.float32)
+        shadow[..., max(dy, 0):height+min(dy, 0), max(dx, 0):width+min(dx, 0)] \
+            = alpha[..., max(-dy, 0):height-max(dy, 0), max(-dx, 0):width-max(dx, 0)]
+        
+        _filter(shadow, radii)
+        shadow *= opacity
+        
+        return _under(rgba, color, shadow)
+    
+    return adjustfunc
+
+def hillshade(azimuth=315, altitude=45, zfactor=1, scale=1):
+    """ Return a function that shades relief from an elevation layer.
+    
+        Elevation is read from the red channel, so a Mask or any greyscale
+        layer will do, and comes out as grey shading from zero to one with
+        alpha unchanged. Azimuth is the direction of the light in degrees
+        clockwise from north at the top, and altitude its angle above the
+        horizon. Zfactor multiplies elevations, and scale is the width of
+        a pixel in the same units as elevation.
+        
+        Gradients are Horn's 3x3 finite differences, with edge pixels repeated.
+        Elevation layers with a buffer of at least one pixel, such as a
+        metatile, shade exactly like their neighbors once it's cut away.
+        
+        Shaded relief from elevations in meters on a 30 meter grid, ready
+        for Imhof-style coloring with curves2():
+            relief = Mask(elevation).adjust(hillshade(zfactor=2, scale=30))
+    """
+    azimuth, altitude = math.radians(azimuth), math.radians(altitude)
+    
+    # direction to the light, x east and y north
+    light = math.sin(azimuth) * math.cos(altitude), math.cos(azimuth) * math.cos(altitude), math.sin(altitude)
+    
+    def adjustfunc(rgba):
+        east, north = _gradients(rgba[0], zfactor, scale)
+        
+        # light falling on the surface normal (-east, -north, 1), scaled to unit length
+        shade = light[2] - light[0] * east - light[1] * north
+        shade /= numpy.sqrt(1 + east**2 + north**2)
+        numpy.clip(shade, 0, 1, out=shade)
+        
+        return shade, shade, shade, rgba[3]
+    
+    return adjustfunc
+
+def slope(zfactor=1, scale=1):
+    """ Return a function that shows steepness of an elevation layer.
+    
+        Elevation, zfactor and scale are as in hillshade(). Output is grey from
+        zero for flat ground to one for vertical, in proportion to the angle.
+    """
+    def adjustfunc(rgba):
+        east, north = _gradients(rgba[0], zfactor, scale)
+        
+        steepness = numpy.arctan(numpy.hypot(east, north)) / numpy.float32(math.pi / 2)
+        
+        return steepness, steepness, steepness, rgba[3]
+    
+    return adjustfunc
+
+def _gradients(elevation, zfactor, scale):
+    """ Return new arrays of east and north elevation gradients.
+    
+        Uses Horn's method, a weighted 3x3 neighborhood of each pixel:
+        http://desktop.arcgis.com/en/arcmap/10.3/tools/spatial-analyst-toolbox/how-slope-works.htm
+    """
+    # one repeated pixel on each side, so every pixel has neighbors
+    padding = [(0, 0)] * (elevation.ndim - 2) + [(1, 1), (1, 1)]
+    padded = numpy.pad(numpy.asarray(elevation, numpy.float32), padding, mode='edge')
+    height, width = elevation.shape[-2:]
+    
+    def neighbors(row, column):
+        return padded[..., 1+row:1+row+height, 1+column:1+column+width]
+    
+    # columns and rows of three neighbors, weighted 1, 2, 1
+    right = neighbors(-1, 1) + 2 * neighbors(0, 1) + neighbors(1, 1)
+    left = neighbors(-1, -1) + 2 * neighbors(0, -1) + neighbors(1, -1)
+    below = neighbors(1, -1) + 2 * neighbors(1, 0) + neighbors(1, 1)
+    above = neighbors(-1, -1) + 2 * neighbors(-1, 0) + neighbors(-1, 1)
+    
+    # rows count down, so north is up
+    east = numpy.subtract(right, left, out=right)
+    north = numpy.subtract(above, below, out=above)
+    
+    east *= float(zfactor) / (8 * scale)
+    north *= float(zfactor) / (8 * scale)
+    
+    return east, north
+
+def _box_radii(sigma, passes=3):
+    """ Return radii of box filters that add up to a Gaussian blur.
+    
+        http://www.peterkovesi.com/papers/FastGaussianSmoothing.pdf
+    """
+    if sigma <= 0:
+        return []
+    
+    lower = int(numpy.sqrt(12.0 * sigma**2 / passes + 1))
+    lower -= 1 - lower % 2
+    upper = lower + 2
+    
+    count = (12.0 * sigma**2 - passes * lower**2 - 4 * passes * lower - 3 * passes) / (-4 * lower - 4)
+    widths = [lower if index < round(count) else upper for index in range(passes)]
+    
+    return [(width - 1) // 2 for width in widths if width > 1]
+
+def _blurred(rgba, radii):
+    """ Return new blurred channels, blurred with alpha premultiplied.
+    """
+    alpha = numpy.array(rgba[3], numpy.float32)
+    colors = [numpy.multiply(chan, alpha, dtype=numpy.float32) for chan in rgba[0:3]]
+    
+    for chan in colors + [alpha]:
+        _filter(chan, radii)
+    
+    # back to straight colors, and black where nothing's left
+    visible = alpha > 0
+    
+    for chan in colors:
+        numpy.divide(chan, alpha, out=chan, where=visible)
+        chan[~visible] = 0
+        numpy.clip(chan, 0, 1, out=chan)
+    
+    return colors + [alpha]
+
+def _spread(alpha, radii):
+    """ Return a new blurred copy of an alpha channel.
+    """
+    alpha = numpy.array(alpha, numpy.float32)
+    _filter(alpha, radii)
+    
+    return alpha
+
+def _under(rgba, color, alpha):
+    """ Return new channels with a solid color composited beneath a layer.
+    
+        Alpha is the coverage of the color, and may be modified in place.
+    """
+    red, green, blue, top = rgba
+    
+    # alpha of color showing through, then combined alpha
+    alpha *= 1 - top
+    total = alpha + top
+    visible = total > 0
+    
+    out = []
+    
+    for (chan, value) in zip((red, green, blue), color):
+        mixed = chan * top + value * alpha
+        numpy.divide(mixed, total, out=mixed, where=visible)
+        mixed[~visible] = 0
+        out.append(mixed)
+    
+    return out + [total]
+
+def _filter(chan, radii):
+    """ Blur a channel in place with box filters across the last two axes.
+    
+        Rows are split into bands, each filtered on its own thread.
+    """
+    for axis in (-1, -2):
+        for radius in radii:
+            _threaded(_box, chan, radius, axis)
+
+def _threaded(func, chan, radius, axis, threads=4, rows=64):
+    """ Call func() on bands of a channel split across the other axis.
+    
+        Func gets each band, radius and axis. Bands of a few dozen rows
+        or columns are spread over as many as four threads.
+    """
+    across = -1 if axis == -2 else -2
+    length = chan.shape[across]
+    count = max(1, min(threads, length // rows))
+    edges = [length * index // count for index in range(count + 1)]
+    
+    if count == 1:
+        return func(chan, radius, axis)
+    
+    if across == -2:
+        bands = [chan[..., start:end, :] for (start, end) in zip(edges[:-1], edges[1:])]
+    else:
+        bands = [chan[..., start:end] for (start, end) in zip(edges[:-1], edges[1:])]
+    
+    workers = [threading.Thread(target=func, args=(band, radius, axis)) for band in bands]
+    
+    for worker in workers:
+        worker.start()
+    
+    for worker in workers:
+        worker.join()
+
+def _box(chan, radius, axis):
+    """ Replace a channel in place with a running-sum box filter along one axis.
+    
+        Every pixel takes the mean of 2 * radius + 1 pixels, centered on
+        itself, with zeros beyond the edges. Cost doesn't depend on radius.
+    """
+    chan = numpy.moveaxis(chan, axis, -1)
+    length = chan.shape[-1]
+    
+    # sums[i] is the total of the first i padded values, in double precision
+    sums = numpy.zeros(chan.shape[:-1] + (length + 2 * radius + 1, ), numpy.float64)
+    sums[..., radius+1:radius+1+length] = chan
+    numpy.cumsum(sums, axis=-1, out=sums)
+    
+    numpy.subtract(sums[..., 2*radius+1:], sums[..., :length], out=sums[..., :length])
+    numpy.divide(sums[..., :length], 2 * radius + 1, out=chan, casting='unsafe')
+
+def _curve(chan, a, b, c):
+    """ Return a new channel with a quadratic curve applied, clipped to 0-1.
+    
+        Uses the current compute backend's kernel if there is one.
+    """
+    kernel = backends.kernel('curve')
+    
+    if kernel:
+        return kernel(chan, a, b, c)
+    
+    return numpy.clip(a * chan**2 + b * chan + c, 0, 1)
+
+def _quadratic(points):
+    """ Return a, b, c coefficients of a quadratic through three (x, y) points.
+    """
+    xs, ys = zip(*points)
+    equations = [[x**2, x, 1.0] for x in xs]
+    
+    return [float(co) for co in numpy.linalg.solve(equations, ys)]
@@ -0,0 +1,156 @@
+""" Compute backends for blend and adjustment kernels.
+
+Blend functions, the over operator in blends.combine() and curves are written
+as chains of NumPy operations, each of which allocates a full temporary array
+and reads through memory again. When numexpr or Numba is installed, the same
+kernels can run as fused, single-pass loops instead. Plain NumPy is always
+available, and is used for any kernel a backend doesn't provide.
+
+>>> from Blit import backends
+>>> backends.available()
+['numpy', 'numexpr']
+>>> backends.use('numexpr')
+
+Backends are loaded on first use, so neither numexpr nor Numba slows down
+importing Blit. Additional backends can be added with register().
+"""
+import numpy
+
+_loaders = {}
+_name, _kernels = 'numpy', {}
+
+def register(name, loader):
+    """ Add a named backend.
+    
+        Loader is a function that returns a dictionary of kernel functions by
+        name, or raises ImportError if the backend can't be used here.
+        Kernel names and arguments match those in _numexpr_kernels().
+    """
+    _loaders[name] = loader
+
+def available():
+    """ Return a list of backend names that can be used here.
+    """
+    names = []
+    
+    for name in sorted(_loaders):
+        try:
+            _loaders[name]()
+        except ImportError:
+            continue
+        else:
+            names.append(name)
+    
+    return names
+
+def use(name):
+    """ Switch kernels to the named backend.
+    
+        Raise ImportError if the backend can't be used here.
+    """
+    global _name, _kernels
+    
+    if name not in _loaders:
+        raise ValueError('Unknown backend "%s"' % name)
+    
+    _name, _kernels = name, _loaders[name]()
+
+def current():
+    """ Return the name of the backend in use.
+    """
+    return _name
+
+def kernel(name):
+    """ Return the current backend's kernel function, or None for plain NumPy.
+    """
+    return _kernels.get(name)
+
+#
+# Kernels as element-by-element expressions. Blends take bottom and top values
+# (b, t), "over" takes output, bottom, mask and bottom alpha values (o, b, m, a),
+# and "curve" takes a value and quadratic coefficients (x, qa, qb, qc).
+#
+_expressions = {
+    'screen': ('b, t', '1 - (1 - b) * (1 - t)'),
+    'add': ('b, t', 'where(b + t > 1, 1, b + t)'),
+    'multiply': ('b, t', 'b * t'),
+    'subtract': ('b, t', 'where(b - t < 0, 0, b - t)'),
+    'linear_light': ('b, t', 'where(b + 2 * t - 1 < 0, 0, where(b + 2 * t - 1 > 1, 1, b + 2 * t - 1))'),
+    'hard_light': ('b, t', 'where(t < .5, 2 * b * t, 1 - 2 * (1 - b) * (1 - t))'),
+    'overlay': ('b, t', 'where(b < .5, 2 * b * t, 1 - 2 * (1 - b) * (1 - t))'),
+    'soft_light': ('b, t', 'where(t < .5, b - (1 - 2 * t) * b * (1 - b), b + (2 * t - 1) * (sqrt(b) - b))'),
+    'darken': ('b, t', 'where(b < t, b, t)'),
+    'lighten': ('b, t', 'where(b > t, b, t)'),
+    'difference': ('b, t', 'abs(b - t)'),
+    'exclusion': ('b, t', 'b + t - 2 * b * t'),
+    'color_dodge': ('b, t', 'where(b > 1 - t, 1, b / where(1 - t < 1e-6, 1e-6, 1 - t))'),
+    'color_burn': ('b, t', 'where(1 - b > t, 0, 1 - (1 - b) / where(t < 1e-6, 1e-6, t))'),
+    'over': ('o, b, m, a', 'where(1 - (1 - m) * (1 - a) > 0, (o - b) * m / (1 - (1 - m) * (1 - a)) + b, 0)'),
+    'curve': ('x, qa, qb, qc', 'where(qa * x**2 + qb * x + qc < 0, 0, where(qa * x**2 + qb * x + qc > 1, 1, qa * x**2 + qb * x + qc))')
+    }
+
+def _numpy_kernels():
+    """ Plain NumPy, with each blend's own code.
+    """
+    return {}
+
+def _numexpr_kernels():
+    """ Kernels compiled by numexpr into single-pass, multi-threaded loops.
+    """
+    import numexpr
+    
+    kernels = {}
+    
+    for (name, (args, expression)) in _expressions.items():
+        names = args.split(', ')
+        kernels[name] = _numexpr_kernel(numexpr, names, expression)
+    
+    return kernels
+
+def _numexpr_kernel(numexpr, names, expression):
+    """ Return a function of positional arguments for a numexpr expression.
+    
+        Results keep the type of the arguments, as they do with NumPy, where
+        numexpr would otherwise promote float32 channels to float64.
+    """
+    def kernel(*values, **kwargs):
+        if kwargs.get('out') is None:
+            kwargs['out'] = numpy.empty(numpy.broadcast(*values).shape, numpy.result_type(*values))
+        
+        return numexpr.evaluate(expression, local_dict=dict(zip(names, values)),
+                                casting='same_kind', **kwargs)
+    
+    return kernel
+
+_numba_cache = {}
+
+def _numba_kernels():
+    """ Kernels compiled by Numba into single-pass ufuncs, on first use.
+    """
+    import numba
+    import math
+    
+    if not _numba_cache:
+        for (name, (args, expression)) in _expressions.items():
+            source = 'def kernel(%s): return %s' % (args, expression.replace('where(', '_where('))
+            namespace = dict(_where=numba.njit(_where), sqrt=math.sqrt)
+            exec(source, namespace)
+            
+            count = len(args.split(', '))
+            signatures = ['float32(%s)' % ', '.join(['float32'] * count),
+                          'float64(%s)' % ', '.join(['float64'] * count)]
+            
+            _numba_cache[name] = numba.vectorize(signatures)(namespace['kernel'])
+    
+    return _numba_cache
+
+def _where(condition, yes, no):
+    """ Scalar version of numexpr's where() for Numba.
+    """
+    if condition:
+        return yes
+    return no
+
+register('numpy', _numpy_kernels)
+register('numexpr', _numexpr_kernels)
+register('numba', _numba_kernels)
@@ -2,29 +2,37 @@
 
 A blend is a function that accepts two identically-sized
 input channel arrays and returns a single output array.
+
+Blends in this module also accept an optional out array, and are
+written without branches or temporary masks, so that they allocate
+at most the output array and one scratch array.
+
+Channel arrays may be stacked with a leading batch axis,
+and blends broadcast inputs of different shapes together.
+
+Blends run on the kernels of the current compute backend when it
+has them, see Blit.backends for details.
 """
 import numpy
 
+from . import backends
+
 def combine(bottom_rgba, top_rgb, mask_chan, opacity, blendfunc):
     """ Blend arrays using a given mask, opacity, and blend function.
     
         A blend function accepts two floating point, two-dimensional
         numpy arrays with values in 0-1 range and returns a third.
+        
+        Arrays may also have a leading batch axis with shape (N, H, W),
+        and inputs are broadcast against one another so that a single
+        color or mask can be combined with a whole stack at once.
     """
+    shape = numpy.broadcast(mask_chan, *(list(bottom_rgba) + list(top_rgb))).shape
+
     if opacity == 0 or not mask_chan.any():
-        # no-op for zero opacity or empty mask
-        return [numpy.copy(chan) for chan in bottom_rgba]
-    
-    # prepare unitialized output arrays
-    output_rgba = [numpy.empty_like(chan) for chan in bottom_rgba]
+        # no-op for zero opacity or empty mask, reuse bottom arrays
+        return [_shaped(chan, shape) for chan in bottom_rgba]
     
-    if not blendfunc:
-        # plain old paste
-        output_rgba[:3] = [numpy.copy(chan) for chan in top_rgb]
-
-    else:
-        output_rgba[:3] = [blendfunc(bottom_rgba[c], top_rgb[c]) for c in (0, 1, 2)]
-        
     # comined effective mask channel
     if opacity < 1:
         mask_chan = mask_chan * opacity
@@ -32,75 +40,318 @@ def combine(bottom_rgba, top_rgb, mask_chan, opacity, blendfunc):
     # pixels from mask that aren't full-white
     gr = mask_chan < 1
     
-    if gr.any():
+    if not blendfunc and not gr.any():
+        # opaque plain paste hides the bottom entirely, reuse top arrays
+        output_rgba = [_shaped(chan, shape) for chan in top_rgb]
+        return output_rgba + [numpy.ones(shape, bottom_rgba[3].dtype)]
+    
+    # prepare unitialized output arrays
+    output_rgba = [numpy.empty(shape, chan.dtype) for chan in bottom_rgba]
+    
+    if not blendfunc:
+        # plain old paste
+        for c in (0, 1, 2):
+            output_rgba[c][...] = top_rgb[c]
+
+    elif blendfunc in _with_out:
+        for c in (0, 1, 2):
+            blendfunc(bottom_rgba[c], top_rgb[c], out=output_rgba[c])
+
+    else:
+        for c in (0, 1, 2):
+            output_rgba[c][...] = blendfunc(bottom_rgba[c], top_rgb[c])
+    
+    kernel = backends.kernel('over')
+    
+    if gr.any() and kernel:
+        # same math as below, fused
+        for c in (0, 1, 2):
+            output_rgba[c][...] = kernel(output_rgba[c], bottom_rgba[c], mask_chan, bottom_rgba[3])
+    
+    elif gr.any():
+        #
+        # Math borrowed from Wikipedia; C0 is the variable alpha_denom:
+        # http://en.wikipedia.org/wiki/Alpha_compositing#Analytical_derivation_of_the_over_operator
+        #
+        alpha_denom = numpy.broadcast_to(1 - (1 - mask_chan) * (1 - bottom_rgba[3]), shape)
+        nz = alpha_denom > 0 # non-zero alpha denominator
+        
+        alpha_ratio = numpy.broadcast_to(mask_chan, shape)[nz] / alpha_denom[nz]
+        
         # we have some shades of gray to take care of
         for c in (0, 1, 2):
-            #
-            # Math borrowed from Wikipedia; C0 is the variable alpha_denom:
-            # http://en.wikipedia.org/wiki/Alpha_compositing#Analytical_derivation_of_the_over_operator
-            #
-            
-            alpha_denom = 1 - (1 - mask_chan) * (1 - bottom_rgba[3])
-            nz = alpha_denom > 0 # non-zero alpha denominator
-            
-            alpha_ratio = mask_chan[nz] / alpha_denom[nz]
+            bottom_chan = numpy.broadcast_to(bottom_rgba[c], shape)
             
             output_rgba[c][nz] = output_rgba[c][nz] * alpha_ratio \
-                               + bottom_rgba[c][nz] * (1 - alpha_ratio)
+                               + bottom_chan[nz] * (1 - alpha_ratio)
             
             # let the zeros perish
             output_rgba[c][~nz] = 0
     
     # output mask is the screen of the existing and overlaid alphas
-    output_rgba[3] = screen(bottom_rgba[3], mask_chan)
+    screen(bottom_rgba[3], mask_chan, out=output_rgba[3])
 
     return output_rgba
 
-def screen(bottom_chan, top_chan):
+def _shaped(chan, shape):
+    """ Return an array of the given shape, the same one if possible.
+    """
+    if chan.shape == shape:
+        return chan
+    
+    return numpy.array(numpy.broadcast_to(chan, shape))
+
+def screen(bottom_chan, top_chan, out=None):
     """ Screen blend function.
     
         Math from http://illusions.hu/effectwiki/doku.php?id=screen_blending
     """
-    return 1 - (1 - bottom_chan) * (1 - top_chan)
+    kernel = backends.kernel('screen')
+    
+    if kernel:
+        return kernel(bottom_chan, top_chan, out=out)
+    
+    # 1 - (1 - b) * (1 - t) is b + t - b * t
+    out = numpy.multiply(bottom_chan, top_chan, out=_out(bottom_chan, top_chan, out))
+    numpy.subtract(bottom_chan, out, out=out)
+    
+    return numpy.add(out, top_chan, out=out)
 
-def add(bottom_chan, top_chan):
+def add(bottom_chan, top_chan, out=None):
     """ Additive blend function.
     
         Math from http://illusions.hu/effectwiki/doku.php?id=additive_blending
     """
-    return numpy.clip(bottom_chan + top_chan, 0, 1)
+    kernel = backends.kernel('add')
+    
+    if kernel:
+        return kernel(bottom_chan, top_chan, out=out)
+    
+    out = numpy.add(bottom_chan, top_chan, out=_out(bottom_chan, top_chan, out))
+    
+    return numpy.clip(out, 0, 1, out=out)
 
-def multiply(bottom_chan, top_chan):
+def multiply(bottom_chan, top_chan, out=None):
     """ Multiply blend function.
     
         Math from http://illusions.hu/effectwiki/doku.php?id=multiply_blending
     """
-    return bottom_chan * top_chan
+    kernel = backends.kernel('multiply')
+    
+    if kernel:
+        return kernel(bottom_chan, top_chan, out=out)
+    
+    return numpy.multiply(bottom_chan, top_chan, out=_out(bottom_chan, top_chan, out))
 
-def subtract(bottom_chan, top_chan):
+def subtract(bottom_chan, top_chan, out=None):
     """ Subtractive blend function.
     
         Math from http://illusions.hu/effectwiki/doku.php?id=subtractive_blending
     """
-    return numpy.clip(bottom_chan - top_chan, 0, 1)
+    kernel = backends.kernel('subtract')
+    
+    if kernel:
+        return kernel(bottom_chan, top_chan, out=out)
+    
+    out = numpy.subtract(bottom_chan, top_chan, out=_out(bottom_chan, top_chan, out))
+    
+    return numpy.clip(out, 0, 1, out=out)
 
-def linear_light(bottom_chan, top_chan):
+def linear_light(bottom_chan, top_chan, out=None):
     """ Linear light blend function.
     
         Math from http://illusions.hu/effectwiki/doku.php?id=linear_light_blending
     """
-    return numpy.clip(bottom_chan + 2 * top_chan - 1, 0, 1)
+    kernel = backends.kernel('linear_light')
+    
+    if kernel:
+        return kernel(bottom_chan, top_chan, out=out)
+    
+    out = numpy.multiply(top_chan, 2, out=_out(bottom_chan, top_chan, out))
+    numpy.add(out, bottom_chan, out=out)
+    numpy.subtract(out, 1, out=out)
+    
+    return numpy.clip(out, 0, 1, out=out)
 
-def hard_light(bottom_chan, top_chan):
+def hard_light(bottom_chan, top_chan, out=None):
     """ Hard light blend function.
     
         Math from http://illusions.hu/effectwiki/doku.php?id=hard_light_blending
     """
-    # different pixel subsets for dark and light parts of overlay
-    dk, lt = top_chan < .5, top_chan >= .5
+    kernel = backends.kernel('hard_light')
+    
+    if kernel:
+        return kernel(bottom_chan, top_chan, out=out)
     
-    output_chan = numpy.empty(bottom_chan.shape, bottom_chan.dtype)
-    output_chan[dk] = 2 * bottom_chan[dk] * top_chan[dk]
-    output_chan[lt] = 1 - 2 * (1 - bottom_chan[lt]) * (1 - top_chan[lt])
+    #
+    # Multiply for dark top values and screen for light ones, written without
+    # branches as 1 - (1 - b * min(2t, 1)) * min(2 - 2t, 1). The second factor
+    # needs the only scratch array.
+    #
+    out = numpy.multiply(top_chan, 2, out=_out(bottom_chan, top_chan, out))
+    numpy.minimum(out, 1, out=out)
+    numpy.multiply(out, bottom_chan, out=out)
+    numpy.subtract(1, out, out=out)
     
-    return output_chan
+    light = numpy.empty(numpy.shape(top_chan), numpy.result_type(top_chan))
+    numpy.subtract(1, top_chan, out=light)
+    numpy.multiply(light, 2, out=light)
+    numpy.minimum(light, 1, out=light)
+    
+    numpy.multiply(out, light, out=out)
+    
+    return numpy.subtract(1, out, out=out)
+
+def overlay(bottom_chan, top_chan, out=None):
+    """ Overlay blend function, hard light with layers swapped.
+    
+        Math from http://illusions.hu/effectwiki/doku.php?id=overlay_blending
+    """
+    kernel = backends.kernel('overlay')
+    
+    if kernel:
+        return kernel(bottom_chan, top_chan, out=out)
+    
+    return hard_light(top_chan, bottom_chan, out=_out(bottom_chan, top_chan, out))
+
+def soft_light(bottom_chan, top_chan, out=None):
+    """ Soft light blend function, matching Photoshop.
+    
+        Darkens by (1 - 2t) * b * (1 - b) for dark top values, and lightens
+        by (2t - 1) * (sqrt(b) - b) for light ones, as Photoshop does, so
+        saved PSD files look the same there.
+    """
+    kernel = backends.kernel('soft_light')
+    
+    if kernel:
+        return kernel(bottom_chan, top_chan, out=out)
+    
+    #
+    # Written without branches as b + max(2t - 1, 0) * (sqrt(b) - b)
+    # + min(2t - 1, 0) * b * (1 - b). The scratch array takes each of the
+    # clipped 2t - 1 factors in turn.
+    #
+    out = numpy.sqrt(bottom_chan, out=_out(bottom_chan, top_chan, out))
+    numpy.subtract(out, bottom_chan, out=out)
+    
+    scratch = numpy.empty(out.shape, out.dtype)
+    numpy.multiply(top_chan, 2, out=scratch)
+    numpy.subtract(scratch, 1, out=scratch)
+    numpy.maximum(scratch, 0, out=scratch)
+    numpy.multiply(out, scratch, out=out)
+    
+    numpy.multiply(top_chan, 2, out=scratch)
+    numpy.subtract(scratch, 1, out=scratch)
+    numpy.minimum(scratch, 0, out=scratch)
+    
+    # b * (1 - b) as b - b^2, one product at a time
+    numpy.multiply(scratch, bottom_chan, out=scratch)
+    numpy.add(out, scratch, out=out)
+    numpy.multiply(scratch, bottom_chan, out=scratch)
+    numpy.subtract(out, scratch, out=out)
+    
+    return numpy.add(out, bottom_chan, out=out)
+
+def darken(bottom_chan, top_chan, out=None):
+    """ Darken blend function, the darker of the two values.
+    """
+    kernel = backends.kernel('darken')
+    
+    if kernel:
+        return kernel(bottom_chan, top_chan, out=out)
+    
+    return numpy.minimum(bottom_chan, top_chan, out=_out(bottom_chan, top_chan, out))
+
+def lighten(bottom_chan, top_chan, out=None):
+    """ Lighten blend function, the lighter of the two values.
+    """
+    kernel = backends.kernel('lighten')
+    
+    if kernel:
+        return kernel(bottom_chan, top_chan, out=out)
+    
+    return numpy.maximum(bottom_chan, top_chan, out=_out(bottom_chan, top_chan, out))
+
+def difference(bottom_chan, top_chan, out=None):
+    """ Difference blend function.
+    
+        Math from http://illusions.hu/effectwiki/doku.php?id=difference_blending
+    """
+    kernel = backends.kernel('difference')
+    
+    if kernel:
+        return kernel(bottom_chan, top_chan, out=out)
+    
+    out = numpy.subtract(bottom_chan, top_chan, out=_out(bottom_chan, top_chan, out))
+    
+    return numpy.absolute(out, out=out)
+
+def exclusion(bottom_chan, top_chan, out=None):
+    """ Exclusion blend function, b + t - 2bt.
+    """
+    kernel = backends.kernel('exclusion')
+    
+    if kernel:
+        return kernel(bottom_chan, top_chan, out=out)
+    
+    out = numpy.multiply(bottom_chan, top_chan, out=_out(bottom_chan, top_chan, out))
+    numpy.multiply(out, -2, out=out)
+    numpy.add(out, bottom_chan, out=out)
+    
+    return numpy.add(out, top_chan, out=out)
+
+def color_dodge(bottom_chan, top_chan, out=None):
+    """ Color dodge blend function, b / (1 - t) clipped to 1.
+    
+        Math from http://illusions.hu/effectwiki/doku.php?id=color_dodge_blending
+    """
+    kernel = backends.kernel('color_dodge')
+    
+    if kernel:
+        return kernel(bottom_chan, top_chan, out=out)
+    
+    # tiny lower limit on the divisor takes the place of a zero check
+    out = numpy.subtract(1, top_chan, out=_out(bottom_chan, top_chan, out))
+    numpy.maximum(out, _tiny, out=out)
+    numpy.divide(bottom_chan, out, out=out)
+    
+    return numpy.minimum(out, 1, out=out)
+
+def color_burn(bottom_chan, top_chan, out=None):
+    """ Color burn blend function, 1 - (1 - b) / t clipped to 0.
+    
+        Math from http://illusions.hu/effectwiki/doku.php?id=color_burn_blending
+    """
+    kernel = backends.kernel('color_burn')
+    
+    if kernel:
+        return kernel(bottom_chan, top_chan, out=out)
+    
+    # tiny lower limit on the divisor takes the place of a zero check
+    divisor = numpy.maximum(top_chan, _tiny)
+    
+    out = numpy.subtract(1, bottom_chan, out=_out(bottom_chan, top_chan, out))
+    numpy.divide(out, divisor, out=out)
+    numpy.subtract(1, out, out=out)
+    
+    return numpy.maximum(out, 0, out=out)
+
+_tiny = 1e-6
+
+def _out(bottom_chan, top_chan, out):
+    """ Return an output array for two inputs, or the one provided.
+    """
+    if out is not None:
+        return out
+    
+    shape = numpy.broadcast(bottom_chan, top_chan).shape
+    
+    return numpy.empty(shape, numpy.result_type(bottom_chan, top_chan))
+
+# blends from this module that accept an out argument
+_with_out = set([screen, add, multiply, subtract, linear_light, hard_light, overlay,
+                 soft_light, darken, lighten, difference, exclusion, color_dodge, color_burn])
+
+# blend functions by name, with None for a normal blend
+modes = dict([(func.__name__, func) for func in _with_out])
+modes['normal'] = None
@@ -0,0 +1,105 @@
+""" Process-wide cache of decoded source images.
+
+Bitmaps made from file names keep their decoded channels here, so that hot
+sources built on every request are read, decoded and converted just once.
+Entries are keyed by file path, modification time and file size, so a file
+that changes on disk is decoded again. The least recently used entries are
+evicted when the total size of cached channels passes a limit in bytes.
+
+>>> from Blit import Bitmap, cache
+>>> cache.limit(512 * 1024 * 1024)
+>>> relief = Bitmap('hillshade.png')
+>>> relief = Bitmap('hillshade.png')
+>>> cache.stats()
+{'hits': 1, 'misses': 1, 'evictions': 0, 'entries': 1, 'bytes': 16777216, 'limit': 536870912}
+
+Cached channels are read-only and shared by every Bitmap that uses them.
+A limit of zero turns the cache off.
+"""
+import os
+import threading
+
+from collections import OrderedDict
+
+_lock = threading.Lock()
+_entries = OrderedDict()
+_limit, _bytes = 128 * 1024 * 1024, 0
+_counts = dict(hits=0, misses=0, evictions=0)
+
+def limit(nbytes):
+    """ Set the largest total size of cached channels in bytes.
+    """
+    global _limit
+    
+    with _lock:
+        _limit = nbytes
+        _evict()
+
+def stats():
+    """ Return a dictionary of hits, misses, evictions, entries, bytes and limit.
+    """
+    with _lock:
+        return dict(_counts, entries=len(_entries), bytes=_bytes, limit=_limit)
+
+def clear():
+    """ Remove all entries and reset statistics.
+    """
+    global _bytes
+    
+    with _lock:
+        _entries.clear()
+        _bytes = 0
+        _counts.update(hits=0, misses=0, evictions=0)
+
+def key(filename, *extra):
+    """ Return a cache key for a file, with any extra hashable decoding options.
+    """
+    info = os.stat(filename)
+    return (os.path.abspath(filename), info.st_mtime, info.st_size) + extra
+
+def get(key):
+    """ Return a list of cached channels, or None.
+    """
+    with _lock:
+        if key not in _entries:
+            _counts['misses'] += 1
+            return None
+        
+        _counts['hits'] += 1
+        
+        # most recently used entries go at the end
+        channels = _entries.pop(key)
+        _entries[key] = channels
+        
+        return channels
+
+def put(key, channels):
+    """ Add a list of channels to the cache, if it fits.
+    """
+    global _bytes
+    
+    nbytes = sum([chan.nbytes for chan in channels])
+    
+    with _lock:
+        if nbytes > _limit or key in _entries:
+            return
+        
+        # older versions of a changed file will never be asked for again
+        for other in [other for other in _entries if other[0] == key[0] and other[1:3] != key[1:3]]:
+            _bytes -= sum([chan.nbytes for chan in _entries.pop(other)])
+        
+        _entries[key] = channels
+        _bytes += nbytes
+        _evict()
+
+def _evict():
+    """ Drop least recently used entries until the cache fits its limit.
+        
+        Called with the lock held.
+    """
+    global _bytes
+    
+    while _entries and _bytes > _limit:
+        key, channels = _entries.popitem(last=False)
+        _bytes -= sum([chan.nbytes for chan in channels])
+        _counts['evictions'] += 1
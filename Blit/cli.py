@@ -0,0 +1,190 @@
+""" Command-line batch renderer.
+
+Reads composition jobs, one JSON object per line, and renders them on a pool
+of worker processes. Each job is a style spec as in Blit.plans, with file
+names for its named sources, and an output file:
+
+    {"layers": [{"source": "base"}, {"source": {"color": [50, 0, 100]}, "mask": "water"}],
+     "sources": {"base": "tiles/base.png", "water": "tiles/water.png"},
+     "output": "out/tile.png"}
+
+Output format is PNG, JPEG or PSD, given by an optional "format" or guessed
+from the output file name. PSD output keeps layers separate, using optional
+layer "name" values. At the end, throughput, time spent in each stage and any
+failures are reported.
+
+Usage: blit [options] [jobs file]
+"""
+from optparse import OptionParser
+from contextlib import contextmanager
+from os.path import splitext
+import multiprocessing
+import traceback
+import json
+import time
+import sys
+
+from . import Bitmap, Mask
+from . import plans
+
+_stages = 'compile', 'load', 'composite', 'save'
+
+parser = OptionParser(usage='%prog [options] [jobs file]',
+                      description='Render Blit composition jobs, one JSON object per line. '
+                                  'Reads from standard input without a jobs file.')
+
+parser.add_option('-p', '--processes', dest='processes', type='int',
+                  help='Number of worker processes, default %default.')
+
+parser.add_option('-v', '--verbose', dest='verbose', action='store_true',
+                  help='Report each job as it finishes.')
+
+parser.set_defaults(processes=multiprocessing.cpu_count(), verbose=False)
+
+def main(argv=None, stdin=sys.stdin, stdout=sys.stdout):
+    """ Render jobs named on the command line, and return an exit status.
+        
+        Status is one if any jobs failed, zero otherwise.
+    """
+    options, args = parser.parse_args(argv)
+    
+    if len(args) > 1:
+        parser.error('At most one jobs file')
+    
+    lines = open(args[0]) if args else stdin
+    jobs = [(number, line) for (number, line) in enumerate(lines, 1) if line.strip()]
+    
+    start = time.time()
+    
+    if options.processes > 1:
+        pool = multiprocessing.Pool(options.processes)
+        results = pool.imap_unordered(render, jobs)
+    else:
+        pool, results = None, (render(job) for job in jobs)
+    
+    done, pixels, failures = 0, 0, []
+    timings = dict([(stage, 0.) for stage in _stages])
+    
+    for result in results:
+        if result['error']:
+            failures.append(result)
+        else:
+            done += 1
+            pixels += result['pixels']
+        
+        for (stage, seconds) in result['timings'].items():
+            timings[stage] += seconds
+        
+        if options.verbose:
+            stdout.write(_describe(result) + '\n')
+    
+    if pool:
+        pool.close()
+        pool.join()
+    
+    elapsed = max(time.time() - start, 1e-6)
+    
+    stdout.write('%d jobs in %.2fs: %.2f jobs/s, %.2f megapixels/s\n'
+                 % (done, elapsed, done / elapsed, pixels / elapsed / 1e6))
+    
+    for stage in _stages:
+        stdout.write('  %-10s %8.3fs\n' % (stage, timings[stage]))
+    
+    if failures:
+        stdout.write('%d failed:\n' % len(failures))
+    
+    for result in sorted(failures, key=lambda result: result['line']):
+        stdout.write('  %s\n' % _describe(result))
+    
+    return 1 if failures else 0
+
+def render(job):
+    """ Render one (line number, JSON string) job, and return a dictionary of results.
+        
+        Results have the line number, output file name, output pixel count,
+        a dictionary of seconds spent in each stage, and an error message
+        or None. Errors are caught here so that one job can't stop the rest.
+    """
+    number, line = job
+    result = dict(line=number, output=None, pixels=0, timings={}, error=None)
+    timings = result['timings']
+    
+    try:
+        with _timed(timings, 'compile'):
+            spec = json.loads(line)
+            result['output'] = spec.pop('output')
+            format = spec.pop('format', splitext(result['output'])[1][1:]).upper()
+            files = spec.pop('sources', {})
+            plan = plans.compile(spec)
+        
+        with _timed(timings, 'load'):
+            # names only ever used as masks need just one channel
+            layers = set([step[0] for step in plan.steps])
+            sources = dict([(name, (Bitmap if name in layers else Mask)(files[name]))
+                            for name in plan.sources])
+            
+            # decode sources up front, so that they're timed on their own
+            for source in sources.values():
+                source.region(*(source.origin() + source.size()))
+        
+        with _timed(timings, 'composite'):
+            if format == 'PSD':
+                layer = _psd(plan, sources)
+            else:
+                layer = plan.run(**sources)
+        
+        with _timed(timings, 'save'):
+            if format == 'PSD':
+                layer.save(result['output'])
+            else:
+                layer.save(result['output'], format)
+        
+        width, height = layer.size()
+        result['pixels'] = width * height
+    
+    except Exception as e:
+        result['error'] = traceback.format_exception_only(type(e), e)[-1].strip()
+    
+    return result
+
+def _psd(plan, sources):
+    """ Return a new PSD instance with a layer for each step of a plan.
+        
+        The document takes its size from the first layer or mask that has
+        one, as Plan.run() does, so a job may start with a color.
+    """
+    from . import photoshop
+    
+    steps = zip(plan.names, plan.layers(**sources))
+    sizes = [layer.size() for (name, (other, mask, opacity, blendfunc)) in steps
+             for layer in (other, mask) if layer is not None and layer.size()]
+    
+    if not sizes:
+        raise ValueError('PSD output needs a source with a size')
+    
+    psd = photoshop.PSD(*sizes[0])
+    
+    for (name, (layer, mask, opacity, blendfunc)) in steps:
+        psd = psd.blend(name, layer, mask, opacity, blendfunc)
+    
+    return psd
+
+def _describe(result):
+    """ Return a one-line description of a job result.
+    """
+    if result['error']:
+        return 'line %d, %s: %s' % (result['line'], result['output'], result['error'])
+    
+    return 'line %d, %s: %d pixels in %.3fs' % (result['line'], result['output'],
+                                                result['pixels'], sum(result['timings'].values()))
+
+@contextmanager
+def _timed(timings, stage):
+    """ Add seconds spent in the body of a with statement to a named stage.
+    """
+    start = time.time()
+    
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0) + time.time() - start
@@ -0,0 +1,171 @@
+""" Disk-backed layers for canvases too large to fit in memory.
+
+A DiskLayer keeps its channels in numpy.memmap arrays backed by anonymous
+scratch files, so the operating system's page cache decides how much of a
+huge canvas lives in memory. Blends and adjustments are computed a strip of
+rows at a time, and only one strip's worth of temporary arrays is ever held
+in memory. Scratch files are removed as soon as they are created, and their
+space is given back when the layer is garbage collected.
+
+>>> from Blit import Bitmap, Color, disk, photoshop
+>>> canvas = disk.todisk(photoshop.PSD(40000, 30000))
+>>> canvas = canvas.blend(Bitmap('relief.png'), opacity=.6)
+>>> canvas = canvas.blend(Color(50, 0, 100), mask=Bitmap('water.png'))
+>>> canvas.save('print.png')
+
+PSD documents given rows keep the composite of every layer in their chain
+in scratch files the same way, and are saved a strip at a time:
+
+>>> psd = photoshop.PSD(40000, 30000, rows=256)
+>>> psd = psd.blend('Relief', Bitmap('relief.png'), opacity=.6)
+>>> psd = psd.blend('Water', Color(50, 0, 100), mask=Bitmap('water.png'))
+>>> psd.save('print.psd')
+
+Any layer can also be dumped to a file with its channels stored as raw buffers,
+and loaded again with those channels memory-mapped instead of read into memory:
+
+>>> disk.dump(canvas, 'canvas.blit')
+>>> canvas = disk.load('canvas.blit')
+"""
+from struct import pack, unpack
+from io import BytesIO
+import tempfile
+import pickle
+import mmap
+
+import numpy
+
+from . import Layer
+
+def scratch(shape, dtype=numpy.float32, directory=None):
+    """ Return a new zero-filled numpy.memmap array backed by a scratch file.
+    """
+    with tempfile.TemporaryFile(dir=directory) as file:
+        # the mapping stays valid after the file itself is closed
+        return numpy.memmap(file, dtype=dtype, mode='w+', shape=shape)
+
+def todisk(layer, rows=256, dtype=numpy.float32, directory=None):
+    """ Return a new DiskLayer with a copy of another layer's channels.
+    """
+    (x, y), (width, height) = layer.origin(), layer.size()
+    channels = [scratch((height, width), dtype, directory) for i in range(4)]
+    
+    for strip in layer.strips(rows):
+        top = strip.origin()[1] - y
+        rgba = strip.region(x, y + top, width, strip.size()[1])
+        
+        for (chan, part) in zip(channels, rgba):
+            chan[top:top+part.shape[0],:] = part
+    
+    return DiskLayer(channels, (x, y), rows, directory)
+
+def dump(layer, filename):
+    """ Write a layer to a named file, with channels stored as raw buffers.
+    
+        Arrays are written contiguously at 64-byte aligned offsets, followed
+        by a pickle of everything else that refers to them by offset, and
+        finally the offset of the pickle itself. Arrays shared between
+        layers, such as in PSD chains, are written once.
+    """
+    offsets = {}
+    
+    with open(filename, 'wb') as file:
+        file.write(_magic)
+        
+        def persistent_id(obj):
+            if not isinstance(obj, numpy.ndarray) or obj.dtype.hasobject:
+                return None
+            
+            if id(obj) not in offsets:
+                file.write('\x00' * (-file.tell() % 64))
+                offsets[id(obj)] = obj, file.tell()
+                file.write(numpy.ascontiguousarray(obj).data)
+            
+            return 'array', offsets[id(obj)][1], obj.dtype.str, obj.shape
+        
+        # arrays go to the file as they're found, and the pickle after them
+        buffer = BytesIO()
+        pickler = pickle.Pickler(buffer, 2)
+        pickler.persistent_id = persistent_id
+        pickler.dump(layer)
+        
+        start = file.tell()
+        file.write(buffer.getvalue())
+        file.write(pack('>Q', start))
+
+def load(filename):
+    """ Return a layer from a named file written by dump().
+    
+        Channels are read-only views of one memory-mapped file,
+        so pages are only read from disk when they're needed.
+    """
+    with open(filename, 'rb') as file:
+        if file.read(len(_magic)) != _magic:
+            raise ValueError('Not a dumped layer: "%s"' % filename)
+        
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        file.seek(-8, 2)
+        start = unpack('>Q', file.read(8))[0]
+        file.seek(start)
+        
+        arrays = {}
+        
+        def persistent_load(pid):
+            kind, offset, dtype, shape = pid
+            
+            if offset not in arrays:
+                count = int(numpy.prod(shape))
+                arrays[offset] = numpy.frombuffer(data, dtype, count, offset).reshape(shape)
+            
+            return arrays[offset]
+        
+        unpickler = pickle.Unpickler(file)
+        unpickler.persistent_load = persistent_load
+        
+        return unpickler.load()
+
+_magic = 'Blit\x00\x01\r\n'
+
+class DiskLayer (Layer):
+    """ Raster layer with channels stored in scratch files on disk.
+    
+        Results of blend() and adjust() are new DiskLayers, computed
+        a strip of rows at a time. Adjustments must work pixel by pixel.
+    """
+    def __init__(self, channels, origin=(0, 0), rows=256, directory=None):
+        """ Channels is a four-element list of numpy.memmap arrays, see scratch().
+        
+            Rows is the height of strips used for blends and adjustments,
+            and directory an optional location for new scratch files.
+        """
+        Layer.__init__(self, channels, origin)
+        
+        self.rows = rows
+        self.directory = directory
+    
+    def blend(self, other, mask=None, opacity=1, blendfunc=None):
+        """ Return a new DiskLayer, with data from another layer blended on top.
+        """
+        return self._each_strip(lambda strip: strip.blend(other, mask, opacity, blendfunc))
+    
+    def adjust(self, adjustfunc):
+        """ Return a new DiskLayer adjusted a strip at a time.
+        """
+        return self._each_strip(lambda strip: strip.adjust(adjustfunc))
+    
+    def _each_strip(self, func):
+        """ Return a new DiskLayer built from a function of each strip.
+        """
+        (x, y), (width, height) = self.origin(), self.size()
+        dtype = self._rgba[0].dtype
+        channels = [scratch((height, width), dtype, self.directory) for i in range(4)]
+        
+        for strip in self.strips(self.rows):
+            top = strip.origin()[1] - y
+            rgba = func(strip).region(*(strip.origin() + strip.size()))
+            
+            for (chan, part) in zip(channels, rgba):
+                chan[top:top+part.shape[0],:] = part
+        
+        return DiskLayer(channels, (x, y), self.rows, self.directory)
@@ -0,0 +1,196 @@
+""" Streaming image file output.
+
+Encoders take a sequence of layers covering consecutive strips of rows, and
+write them to a file without ever building a complete PIL image. Any layer can
+supply strips of itself with Layer.strips(), and strips can just as well be
+composited one at a time so a huge image never exists in memory all at once:
+
+>>> from Blit import Bitmap, encode
+>>> base, marker = Bitmap('base.png'), Bitmap('marker.png', origin=(1200, 840))
+>>> width, height = base.size()
+>>> strips = (strip.blend(marker) for strip in base.strips(64))
+>>> encode.png(open('out.png', 'wb'), width, height, strips)
+
+PNG output can be 8-bit indexed color instead, with a palette built by
+palette() from one layer or shared across a whole set of tiles:
+
+>>> colors = encode.palette(base.region(0, 0, width, height), 64)
+>>> encode.png(open('out.png', 'wb'), width, height, base.strips(64), palette=colors)
+"""
+from struct import pack
+import zlib
+
+import numpy
+
+from . import utils
+
+def png_chunk(kind, data):
+    ''' Return a complete PNG chunk with length and checksum.
+    
+        http://www.w3.org/TR/PNG/#5Chunk-layout
+    '''
+    return pack('>I', len(data)) + kind + data + pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+def png(outfile, width, height, strips, level=6, palette=None):
+    ''' Write RGBA PNG data to a file-like object, one strip at a time.
+    
+        Strips is a sequence of layers covering consecutive rows from
+        the top of the image, each compressed as soon as it arrives.
+        
+        Optional palette is an array of up to 256 8-bit RGBA colors from
+        palette(), for indexed color output with each pixel mapped to
+        the nearest palette color.
+    '''
+    outfile.write('\x89PNG\r\n\x1a\n')
+    
+    if palette is None:
+        outfile.write(png_chunk('IHDR', pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)))
+    
+    else:
+        palette = numpy.asarray(palette, numpy.ubyte)
+        outfile.write(png_chunk('IHDR', pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)))
+        outfile.write(png_chunk('PLTE', palette[:,0:3].tostring()))
+        
+        # alpha for palette entries up to the last translucent one
+        translucent = numpy.nonzero(palette[:,3] < 0xff)[0]
+        
+        if len(translucent):
+            outfile.write(png_chunk('tRNS', palette[:translucent[-1]+1,3].tostring()))
+    
+    compressor = zlib.compressobj(level)
+    
+    for (top, rgba) in _strip_channels(width, height, strips):
+        rows, columns = rgba[0].shape
+        
+        if palette is None:
+            # one leading filter type byte per row, zero for no filter
+            pixels = numpy.zeros((rows, 1 + columns * 4), numpy.ubyte)
+            
+            for (index, chan) in enumerate(utils.rgba2ubytes(rgba)):
+                pixels[:,1+index::4] = chan
+        
+        else:
+            pixels = numpy.zeros((rows, 1 + columns), numpy.ubyte)
+            pixels[:,1:] = _indexes(rgba, palette)
+        
+        data = compressor.compress(pixels.tostring())
+        
+        if data:
+            outfile.write(png_chunk('IDAT', data))
+    
+    outfile.write(png_chunk('IDAT', compressor.flush()))
+    outfile.write(png_chunk('IEND', ''))
+
+def jpeg(outfile, width, height, strips, quality=75):
+    ''' Write JPEG data to a file-like object.
+    
+        JPEG encoding needs a whole image at once, so strips are collected
+        into a single 8-bit RGB buffer instead of a stack of PIL bands.
+        Alpha is discarded.
+    '''
+    import Image
+    
+    pixels = numpy.zeros((height, width, 3), numpy.ubyte)
+    
+    for (top, rgba) in _strip_channels(width, height, strips):
+        rows = rgba[0].shape[0]
+    
+        for (index, chan) in enumerate(utils.rgba2ubytes(rgba[0:3])):
+            pixels[top:top+rows,:,index] = chan
+    
+    # contiguous pixels are shared with the image, not copied
+    image = Image.frombuffer('RGB', (width, height), pixels, 'raw', 'RGB', 0, 1)
+    image.save(outfile, 'JPEG', quality=quality)
+
+def palette(rgba, colors=256):
+    ''' Return an array of up to 256 8-bit RGBA colors representing channels.
+    
+        Colors are chosen by median cut on a histogram of the distinct 8-bit
+        colors present, so work depends on the number of colors rather than
+        pixels. Fully transparent pixels all count as transparent black.
+        Pass channels of a whole tile set for a palette they can share.
+    '''
+    values, counts = numpy.unique(_packed(rgba), return_counts=True)
+    pixels = _unpacked(values).astype(int)
+    boxes = [numpy.arange(len(values))]
+    ranges = [pixels.max(axis=0) - pixels.min(axis=0)]
+    
+    while len(boxes) < min(colors, 256, len(values)):
+        #
+        # Split the box with the widest range in any one channel,
+        # at the pixel-weighted median along that channel.
+        #
+        widest = numpy.argmax([span.max() for span in ranges])
+        
+        if ranges[widest].max() == 0:
+            break
+        
+        box, span = boxes.pop(widest), ranges.pop(widest)
+        box = box[numpy.argsort(pixels[box, numpy.argmax(span)], kind='mergesort')]
+        
+        weights = numpy.cumsum(counts[box])
+        split = numpy.searchsorted(weights, weights[-1] / 2.) + 1
+        split = min(max(split, 1), len(box) - 1)
+        
+        for half in (box[:split], box[split:]):
+            boxes.append(half)
+            ranges.append(pixels[half].max(axis=0) - pixels[half].min(axis=0))
+    
+    # each palette color is the pixel-weighted mean of its box
+    means = [numpy.dot(counts[box], pixels[box]) / float(counts[box].sum()) for box in boxes]
+    
+    return numpy.round(means).astype(numpy.ubyte).reshape(len(boxes), 4)
+
+def _packed(rgba):
+    ''' Return 8-bit RGBA channels packed into single 32-bit values.
+    '''
+    red, green, blue, alpha = [chan.astype(numpy.uint32) for chan in utils.rgba2ubytes(rgba)]
+    packed = (red << 24) | (green << 16) | (blue << 8) | alpha
+    
+    packed[alpha == 0] = 0
+    
+    return packed
+
+def _unpacked(values):
+    ''' Return an (N, 4) array of 8-bit RGBA colors from packed 32-bit values.
+    '''
+    return numpy.array([(values >> shift) & 0xff for shift in (24, 16, 8, 0)], numpy.ubyte).T.reshape(-1, 4)
+
+def _indexes(rgba, palette):
+    ''' Return an 8-bit array of nearest palette indexes for channels.
+    
+        Distances are measured once for each distinct color, not each pixel.
+    '''
+    values, inverse = numpy.unique(_packed(rgba), return_inverse=True)
+    colors, palette = _unpacked(values).astype(numpy.float32), palette.astype(numpy.float32)
+    nearest = numpy.empty(len(values), numpy.ubyte)
+    
+    # half the squared distance less a per-color constant, as one matrix product
+    offsets = (palette ** 2).sum(axis=1) / 2
+    
+    # a few thousand colors at a time keep the distance matrix small
+    for start in range(0, len(values), 4096):
+        distances = offsets - numpy.dot(colors[start:start+4096], palette.T)
+        nearest[start:start+4096] = numpy.argmin(distances, axis=1)
+    
+    return nearest[inverse].reshape(rgba[0].shape)
+
+def _strip_channels(width, height, strips):
+    ''' Generate top row and channel arrays for each strip in turn.
+    '''
+    top = 0
+    
+    for strip in strips:
+        rows = min(strip.size()[1], height - top)
+        
+        if rows <= 0:
+            break
+        
+        # strips are read from their own position on the canvas
+        x, y = strip.origin()
+        
+        yield top, strip.region(x, y, width, rows)
+        top += rows
+    
+    if top < height:
+        raise ValueError('Strips cover %d of %d rows' % (top, height))
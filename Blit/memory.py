@@ -0,0 +1,196 @@
+""" Memory estimates and an optional budget for compositing.
+
+Each blend allocates several temporary arrays the size of the blended area,
+so a huge canvas can use far more memory than its own channels. Blit can
+estimate the peak memory of a blend, an adjustment, a compiled plan or
+PSD.save() from layer sizes and dtypes alone, before doing any work:
+
+>>> from Blit import Bitmap, memory
+>>> memory.blend_bytes(Bitmap('relief-1024.png'), Bitmap('water-1024.png'))
+50331648
+
+With a budget set, blends over it switch strategy or refuse to run. Adjustments
+and PSD output always refuse, since adjustments may not work pixel by pixel:
+
+>>> memory.budget(256 * 1024 * 1024, strategy='strips')
+
+Strategies are "raise" for an OverBudget error, "strips" to blend a strip
+of rows at a time into new in-memory channels, and "disk" to blend a strip
+at a time into disk-backed channels as in Blit.disk.
+"""
+from . import utils
+
+_strategies = 'raise', 'strips', 'disk'
+_budget, _strategy = None, 'raise'
+
+#
+# Peak arrays allocated per blended pixel, in units of channel itemsize:
+# four channels of the other layer, two for masked alpha, four outputs and
+# temporaries in blends.combine(). Partial blends paste four more channels
+# the size of the whole bottom layer. Adjustments make four new channels and
+# a couple of temporaries. PSD.save() writes a layer at a time, with four
+# channels and a temporary plus 8-bit copies of each.
+#
+_per_blended_pixel = 12
+_per_pasted_pixel = 4
+_per_adjusted_pixel = 6
+_per_saved_pixel = 5
+
+class OverBudget (MemoryError):
+    """ Raised for work estimated to need more memory than the budget.
+    """
+    pass
+
+def budget(nbytes, strategy='raise'):
+    """ Set a memory budget in bytes for blends and adjustments, or None for no limit.
+        
+        Strategy is one of "raise", "strips" or "disk", for blends over budget.
+    """
+    global _budget, _strategy
+    
+    if strategy not in _strategies:
+        raise ValueError('Unknown strategy "%s"' % strategy)
+    
+    _budget, _strategy = nbytes, strategy
+
+def check(nbytes, action, strategies=()):
+    """ Return None if an action fits the budget, or a strategy to use instead.
+        
+        Strategies is a list of those the action allows other than "raise".
+        Raise OverBudget if the budget strategy isn't one of them.
+    """
+    if _budget is None or nbytes <= _budget:
+        return None
+    
+    if _strategy in strategies:
+        return _strategy
+    
+    raise OverBudget('%s needs about %.1fMB, over the %.1fMB budget'
+                     % (action, nbytes / 1048576., _budget / 1048576.))
+
+def blend_bytes(bottom, other, mask=None):
+    """ Return an estimate of peak bytes allocated by bottom.blend(other, mask).
+    """
+    sized = [layer for layer in (bottom, other, mask) if layer is not None and layer.size()]
+    
+    if not sized:
+        return 0
+    
+    canvas = sized[0].origin() + sized[0].size()
+    area = canvas
+    
+    for layer in sized[1:]:
+        area = utils.intersection(area, layer.origin() + layer.size())
+    
+    return _blend_bytes(canvas, area, *_channels(sized[0]))
+
+def adjust_bytes(layer):
+    """ Return an estimate of peak bytes allocated by layer.adjust().
+    """
+    if not layer.size():
+        return 0
+    
+    width, height = layer.size()
+    itemsize, count = _channels(layer)
+    
+    return width * height * itemsize * count * _per_adjusted_pixel
+
+def save_bytes(psd):
+    """ Return an estimate of peak bytes allocated by PSD.save().
+        
+        PSDs with rows are saved that many rows at a time.
+    """
+    width, height = psd.size()
+    height = min(height, psd.rows or height)
+    itemsize, count = _channels(psd)
+    
+    return width * height * (itemsize * _per_saved_pixel + 4)
+
+def plan_bytes(plan, **sources):
+    """ Return an estimate of peak bytes allocated by plan.run(**sources).
+        
+        Counts the largest single step, plus the layer being built up.
+    """
+    canvas, peak = None, 0
+    
+    for (source, adjustfuncs, mask, opacity, blendfunc) in plan.steps:
+        other = sources[source] if type(source) is str else source
+        mask = sources[mask] if type(mask) is str else mask
+        
+        if adjustfuncs:
+            peak = max(peak, _held_bytes(canvas) + adjust_bytes(other))
+        
+        if canvas is None:
+            canvas = other
+        else:
+            peak = max(peak, _held_bytes(canvas) + blend_bytes(canvas, other, mask))
+    
+    return peak
+
+def blend_strips(layer, canvas, area):
+    """ Return None if a blend fits the budget, or a strategy and strip height.
+        
+        Canvas and area are (left, top, width, height) rectangles of the whole
+        output and the part of it that's blended, see Layer.blend(). Raise
+        OverBudget if the blend won't fit even one row at a time.
+    """
+    itemsize, count = _channels(layer)
+    nbytes = _blend_bytes(canvas, area, itemsize, count)
+    strategy = check(nbytes, 'Blend', ('strips', 'disk') if layer.size() else ())
+    
+    if strategy is None:
+        return None
+    
+    # rows where the layers overlap cost the most
+    row_bytes = area[2] * _per_blended_pixel
+    
+    if area != canvas:
+        row_bytes += canvas[2] * _per_pasted_pixel
+    
+    # strips are pasted into new channels held in memory
+    held = _held_bytes(layer) if strategy == 'strips' else 0
+    rows = (_budget - held) // (row_bytes * itemsize * count)
+    
+    if rows < 1:
+        raise OverBudget('Blend needs about %.1fMB, over the %.1fMB budget even a row at a time'
+                         % (nbytes / 1048576., _budget / 1048576.))
+    
+    return strategy, int(rows)
+
+def _blend_bytes(canvas, area, itemsize, count):
+    """ Return an estimate of peak bytes for a blend of an area of a canvas.
+    """
+    nbytes = area[2] * area[3] * itemsize * count * _per_blended_pixel
+    
+    if area != canvas:
+        nbytes += canvas[2] * canvas[3] * itemsize * count * _per_pasted_pixel
+    
+    return nbytes
+
+def _held_bytes(layer):
+    """ Return bytes of channels held by a layer, assumed not to share them.
+    """
+    if layer is None or not layer.size():
+        return 0
+    
+    width, height = layer.size()
+    itemsize, count = _channels(layer)
+    
+    return width * height * itemsize * count * 4
+
+def _channels(layer):
+    """ Return channel itemsize and number of layers in a batch.
+        
+        Undecoded Bitmaps will have 32-bit channels.
+    """
+    rgba = layer.__dict__.get('_rgba')
+    
+    if rgba is None:
+        return 4, 1
+    
+    count = 1
+    
+    for length in rgba[0].shape[:-2]:
+        count *= length
+    
+    return max([chan.dtype.itemsize for chan in rgba]), count
@@ -0,0 +1,107 @@
+""" Cutting rendered metatiles into map tiles.
+
+Compositing a metatile of several tiles at once, with a buffer around the
+edge, avoids artifacts where features cross tile boundaries. A Metatile takes
+the finished composite of the whole buffered canvas and exposes each tile as
+a Layer whose channels are views into it, so cutting tiles copies nothing.
+
+>>> from Blit import Bitmap, metatiles
+>>> rendered = Bitmap('metatile.png')
+>>> metatile = metatiles.Metatile(rendered, rows=4, columns=4, size=256, buffer=32)
+>>> for (tile, data) in metatile.encode('PNG'):
+...     if not tile.empty():
+...         open('%d-%d.png' % (tile.column, tile.row), 'wb').write(data)
+"""
+from StringIO import StringIO
+
+from . import Layer
+from . import encode
+from . import workers
+from . import utils
+
+class Tile (Layer):
+    """ Single tile cut from a metatile, sharing its channel data.
+    """
+    def __init__(self, channels, row, column):
+        """ Channels are views of the metatile, row and column count from zero.
+        """
+        Layer.__init__(self, channels)
+        
+        self.row = row
+        self.column = column
+    
+    def empty(self):
+        """ Return true if the tile is completely transparent.
+        """
+        return self.transparent()
+    
+    def solid(self):
+        """ Return an 8-bit (red, green, blue, alpha) tuple if the tile is one color.
+        
+            Return None if the tile has more than one color in it.
+        """
+        rgba = self.uniform()
+        
+        if rgba is None:
+            return None
+        
+        rgba = list(utils.color2srgb(rgba[0:3])) + [rgba[3]]
+        
+        return tuple([int(round(value * 255)) for value in rgba])
+
+class Metatile:
+    """ Grid of tiles cut from a single composited layer.
+    """
+    def __init__(self, layer, rows, columns, size=256, buffer=0):
+        """ Layer is the rendered metatile, including buffer pixels on all sides.
+        """
+        width, height = columns * size + buffer * 2, rows * size + buffer * 2
+        
+        if layer.size() != (width, height):
+            raise ValueError('Expected a %dx%d layer, got %dx%d' % ((width, height) + layer.size()))
+        
+        self.layer = layer
+        self.rows, self.columns = rows, columns
+        self.size, self.buffer = size, buffer
+    
+    def tiles(self):
+        """ Return a list of Tiles, row by row.
+        """
+        # whole layer at once, so that every tile is a view of the same channels
+        rgba = self.layer.region(*(self.layer.origin() + self.layer.size()))
+        tiles = []
+        
+        for row in range(self.rows):
+            for column in range(self.columns):
+                left, top = self.buffer + column * self.size, self.buffer + row * self.size
+                channels = [chan[..., top:top+self.size, left:left+self.size] for chan in rgba]
+                tiles.append(Tile(channels, row, column))
+        
+        return tiles
+    
+    def encode(self, format='PNG', executor=None, palette=None):
+        """ Return a list of (Tile, encoded data) tuples, row by row.
+        
+            Tiles are encoded in parallel on an optional workers.Executor.
+            
+            Optional palette makes indexed color PNG tiles, see Layer.save().
+            A number of colors is chosen from the whole metatile at once,
+            so that every tile shares a single palette.
+        """
+        executor = executor or workers.default()
+        tiles = self.tiles()
+        
+        if type(palette) is int:
+            palette = encode.palette(self.layer.region(*(self.layer.origin() + self.layer.size())), palette)
+        
+        jobs = [executor.submit(_encode, tile, format, palette) for tile in tiles]
+        
+        return [(tile, job.result()) for (tile, job) in zip(tiles, jobs)]
+
+def _encode(layer, format, palette):
+    """ Return encoded file data for a layer.
+    """
+    buffer = StringIO()
+    layer.save(buffer, format, palette=palette)
+    
+    return buffer.getvalue()
@@ -10,18 +10,26 @@ layers and allows saving to PSD files.
 >>> psd = psd.blend('Photo', Bitmap('photo.jpg'), blendfunc=blends.linear_light)
 >>> psd.save('photo.psd')
 
+PSD documents too large for memory can keep the composite of each layer in
+scratch files on disk, computed and saved a strip of rows at a time:
+
+>>> psd = photoshop.PSD(40000, 30000, rows=256)
+
 Output PSD files have been tested with Photoshop CS3 on Mac, based on this spec:
     http://www.adobe.com/devnet-apps/photoshop/fileformatashtml/PhotoshopFileFormats.htm
 
 Photoshop is a registered trademark of Adobe Corporation.
 '''
 from struct import pack
+from functools import reduce
+from StringIO import StringIO
 
 import numpy
-import Image
 
-from . import Layer
+from . import Layer, Color
 from . import utils
+from . import disk
+from . import memory
 from . import blends
     
 def uint8(num):
@@ -68,9 +76,20 @@ class PhotoshopFile:
         self.image_data = image_data
     
     def tostring(self):
-        return self.file_header.tostring() + self.color_mode_data.tostring() \
-             + self.image_resources.tostring() + self.layer_mask_info.tostring() \
-             + self.image_data.tostring()
+        buffer = StringIO()
+        self.write(buffer)
+        
+        return buffer.getvalue()
+    
+    def write(self, file):
+        ''' Write complete file a section at a time, with no need to hold
+            all of its pixel data in memory at once.
+        '''
+        file.write(self.file_header.tostring())
+        file.write(self.color_mode_data.tostring())
+        file.write(self.image_resources.tostring())
+        self.layer_mask_info.write(file)
+        self.image_data.write(file)
 
 class FileHeader:
     ''' The file header contains the basic properties of the image.
@@ -118,12 +137,15 @@ class LayerMaskInformation:
         self.layer_info = layer_info
         self.global_layer_mask = global_layer_mask
     
-    def tostring(self):
-        layer_info = self.layer_info.tostring()
-        global_layer_mask = self.global_layer_mask.tostring()
-        
-        layer_mask_info = layer_info + global_layer_mask
-        return uint32(len(layer_mask_info)) + layer_mask_info
+    def length(self):
+        ''' Length including the leading length itself.
+        '''
+        return 4 + self.layer_info.length() + len(self.global_layer_mask.tostring())
+    
+    def write(self, file):
+        file.write(uint32(self.length() - 4))
+        self.layer_info.write(file)
+        file.write(self.global_layer_mask.tostring())
 
 class LayerInformation:
     ''' Layer info shows the high-level organization of the layer information.
@@ -135,13 +157,26 @@ class LayerInformation:
         self.layer_records = layer_records
         self.channel_image_data = channel_image_data
     
-    def tostring(self):
-        layer_count = uint16(self.layer_count)
-        layer_records = ''.join([record.tostring() for record in self.layer_records])
-        channel_image_data = self.channel_image_data.tostring()
+    def length(self):
+        ''' Length including the leading length itself, rounded up to an even number.
+        '''
+        length = 2 + sum([len(record.tostring()) for record in self.layer_records]) \
+               + self.channel_image_data.length()
+        
+        return 4 + length + length % 2
+    
+    def write(self, file):
+        records = [record.tostring() for record in self.layer_records]
+        length = 2 + sum(map(len, records)) + self.channel_image_data.length()
         
-        layer_info = layer_count + layer_records + channel_image_data
-        return uint32(len(layer_info)) + layer_info
+        file.write(uint32(length + length % 2))
+        file.write(uint16(self.layer_count))
+        
+        for record in records:
+            file.write(record)
+        
+        self.channel_image_data.write(file)
+        file.write('\x00' * (length % 2))
 
 class LayerRecord:
     ''' Information about each layer.
@@ -226,48 +261,142 @@ class ChannelImageData:
     
         http://www.adobe.com/devnet-apps/photoshop/fileformatashtml/PhotoshopFileFormats.htm#50577409_26431
     '''
-    def __init__(self, channels):
-        self.channels = channels
+    def __init__(self, layers, rows=None):
+        ''' Layers is a list of (layer, mask, rectangle, channel count) tuples.
+        
+            Rectangles are (left, top, width, height). Channel counts are 3 for
+            color only, 4 with alpha and 5 with a layer mask as well.
+            Rows is an optional height of strips to convert at a time.
+        '''
+        self.layers = layers
+        self.rows = rows
     
-    def tostring(self):
+    def length(self):
+        return sum([count * (2 + width * height)
+                    for (layer, mask, (left, top, width, height), count) in self.layers])
+    
+    def write(self, file):
         '''
         '''
-        # Compression. 0 = Raw Data, 1 = RLE compressed, 2/3 = ZIP.
-        return ''.join(['\x00\x00' + chan.tostring() for chan in self.channels])
+        for (layer, mask, (left, top, width, height), count) in self.layers:
+            for index in range(count):
+                # Compression. 0 = Raw Data, 1 = RLE compressed, 2/3 = ZIP.
+                file.write('\x00\x00')
+                
+                for (y, rows) in _strips(top, height, self.rows):
+                    if index == 4:
+                        chan = utils.chan2ubyte(mask.luminance(left, y, width, rows))
+                    else:
+                        chan = layer.region(left, y, width, rows)[index]
+                        chan = (utils.color2ubyte if index < 3 else utils.chan2ubyte)(chan)
+                    
+                    file.write(chan.tostring())
 
 class ImageData:
     ''' Bitmap content of flattened whole-file preview.
     
         http://www.adobe.com/devnet-apps/photoshop/fileformatashtml/PhotoshopFileFormats.htm#50577409_89817
     '''
-    def __init__(self, channels):
-        self.channels = channels
+    def __init__(self, layer, rows=None):
+        self.layer = layer
+        self.rows = rows
     
-    def tostring(self):
+    def write(self, file):
         '''
         '''
         # Compression. 0 = Raw Data, 1 = RLE compressed, 2/3 = ZIP.
-        return '\x00\x00' + ''.join([chan.tostring() for chan in self.channels])
+        file.write('\x00\x00')
+        
+        (left, top), (width, height) = self.layer.origin(), self.layer.size()
+        
+        for index in range(3):
+            for (y, rows) in _strips(top, height, self.rows):
+                chan = self.layer.region(left, y, width, rows)[index]
+                file.write(utils.color2ubyte(chan).tostring())
 
 class PSD (Layer):
     ''' Represents a Photoshop document that can be combined with other layers.
     
         Behaves identically to Blit.Layer with addition of a save() method.
     '''
-    def __init__(self, width, height):
+    def __init__(self, width, height, rows=None, directory=None):
         ''' Create a new, plain-black PSD instance with specified width and height.
+        
+            With rows, composites of layers blended on top are kept in scratch
+            files as in Blit.disk, and computed and saved that many rows at a
+            time. Directory is an optional location for the scratch files.
         '''
-        channels = [numpy.zeros((height, width), dtype=float)] * 4
+        # a single broadcast zero stands in for every background pixel
+        channels = [numpy.broadcast_to(numpy.float32(0), (height, width))] * 4
         Layer.__init__(self, channels)
         
         self.head = FileHeader(3, height, width, 8, 3)
         self.info = 'Background', self, None, 0xff, 'norm', False
+        self.rows, self.directory = rows, directory
+    
+    def __getstate__(self):
+        ''' Return just the size and storage for pickling, since the background is blank.
+        '''
+        return dict(size=self.size(), rows=self.rows, directory=self.directory)
+    
+    def __setstate__(self, state):
+        ''' Restore a pickled PSD.
+        '''
+        width, height = state['size']
+        PSD.__init__(self, width, height, state.get('rows'), state.get('directory'))
     
     def blend(self, name, other, mask=None, opacity=1, blendfunc=None, clipped=False):
         ''' Return a new PSD instance, with data from another layer included.
         '''
         return _PSDMore(self, name, other, mask, opacity, blendfunc, clipped)
     
+    def replace(self, layer, dirty=None, **changes):
+        ''' Return a new PSD instance, with one existing layer changed.
+        
+            Layer is the index of a layer counting up from 1 above the
+            background, or its name. Changes are keyword arguments from
+            blend(): name, other, mask, opacity, blendfunc or clipped.
+            
+            Composites below the changed layer are reused as they are, and
+            the layers above it are only recomputed within the dirty area:
+            a (left, top, width, height) rectangle, by default the combined
+            area of the old and new layer and mask, if they have sizes.
+        '''
+        chain = self._chain()
+        names = [None] + [psd.args['name'] for psd in chain[1:]]
+        
+        if layer in names[1:]:
+            layer = names.index(layer)
+        
+        if type(layer) is not int or not 0 < layer < len(chain):
+            raise IndexError('No layer "%s" to replace' % layer)
+        
+        old_args = chain[layer].args
+        new_args = dict(old_args, **changes)
+        
+        if dirty is None:
+            dirty = utils.union(_bounds(old_args), _bounds(new_args))
+        
+        psd = chain[layer - 1]
+        
+        for previous in chain[layer:]:
+            args = new_args if previous is chain[layer] else previous.args
+            psd = _PSDMore(psd, dirty=dirty, previous=previous, **args)
+        
+        return psd
+    
+    def _chain(self):
+        ''' Return a list of PSD instances from the background up to this one.
+        '''
+        chain, psd = [self], self
+        
+        while not psd.head:
+            psd = psd.base
+            chain.append(psd)
+        
+        chain.reverse()
+        return chain
+    
     def adjust(self, adjustfunc):
         ''' Adjustment layers are currently not implemented in PSD.
         '''
@@ -275,91 +404,132 @@ class PSD (Layer):
 
     def save(self, outfile):
         ''' Save Photoshop-compatible file to a named file or file-like object.
-        '''
-        #
-        # Follow the chain of PSD instances to build up a list of layers.
-        #
-        info = []
-        psd = self
         
-        while psd.info:
-            info.insert(0, psd.info)
-            
-            if psd.head:
-                file_header = psd.head
-                break
-
-            psd = psd.base
+            Raise memory.OverBudget if a layer won't fit a budget set in Blit.memory.
+        '''
+        memory.check(memory.save_bytes(self), 'PSD.save()')
         
         #
-        # Iterate over layers, make new LayerRecord objects and add channels.
+        # Follow the chain of PSD instances from the background up, and make
+        # a LayerRecord for each. Pixels are only read while writing the file.
         #
-        records = []
-        channels = []
-        
-        for (index, (name, layer, mask, opacity, mode, clipped)) in enumerate(info):
+        chain = self._chain()
+        canvas = (0, 0) + self.size()
+        records, layers = [], []
         
-            record = dict(
-                name = name,
-                channel_count = 4,
-                channel_info = (0, 1, 2, -1),
-                blend_mode = mode,
-                opacity = opacity,
-                clipping = int(bool(clipped)),
-                mask_data = LayerMaskAdjustmentData(),
-                blending_ranges = LayerBlendingRangesData(),
-                rectangle = (0, 0) + (self.size()[1], self.size()[0]),
-                additional_infos = []
-                )
+        for (index, psd) in enumerate(chain):
+            name, layer, mask, opacity, mode, clipped = psd.info
+            rectangle, channel_info = canvas, (0, 1, 2, -1)
+            additional_infos = []
             
-            channels += utils.rgba2img(layer.rgba(*self.size())).split()
-
             if index == 0:
                 #
                 # Background layer has its alpha channel removed.
                 #
-                record['channel_count'] = 3
-                record['channel_info'] = (0, 1, 2)
-                channels.pop()
+                channel_info = (0, 1, 2)
             
             elif layer.size() is None:
                 #
-                # Layers without sizes are treated as solid colors.
+                # Layers without sizes are treated as solid colors, which
+                # need no pixels at all unless there's a layer mask to show.
+                #
+                red, green, blue, alpha = [chan[0,0] for chan in layer.rgba(1, 1)]
+                red, green, blue = [utils.color2srgb(value) * 255 for value in (red, green, blue)]
+                additional_infos.append(SolidColorInfo(red, green, blue))
+                
+                if alpha < 1:
+                    # fills are opaque, so translucent colors lower layer opacity
+                    opacity = int(round(opacity * alpha))
+                    layer = Color(red, green, blue)
+                
+                if not mask:
+                    rectangle = 0, 0, 0, 0
+            
+            elif not mask:
+                #
+                # Positioned layers cover just their own area of the canvas.
                 #
-                red, green, blue = [chan[0,0] * 255 for chan in layer.rgba(1, 1)[0:3]]
-                record['additional_infos'].append(SolidColorInfo(red, green, blue))
+                rectangle = utils.intersection(canvas, layer.origin() + layer.size())
+                
+                if not rectangle[2] or not rectangle[3]:
+                    # nothing inside the document, so no pixels anywhere
+                    rectangle = 0, 0, 0, 0
             
             if mask:
                 #
                 # Add a layer mask channel.
                 #
-                record['channel_count'] = 5
-                record['channel_info'] = (0, 1, 2, -1, -2)
-                luminance = utils.rgba2lum(mask.rgba(*self.size()))
-                channels.append(utils.chan2img(luminance))
+                channel_info += (-2, )
+            
+            left, top, width, height = rectangle
+            
+            records.append(LayerRecord(
+                name = name,
+                channel_count = len(channel_info),
+                channel_info = channel_info,
+                blend_mode = mode,
+                opacity = opacity,
+                clipping = int(bool(clipped)),
+                mask_data = LayerMaskAdjustmentData(),
+                blending_ranges = LayerBlendingRangesData(),
+                rectangle = (top, left, top + height, left + width),
+                additional_infos = additional_infos
+                ))
             
-            records.append(LayerRecord(**record))
+            layers.append((layer, mask, rectangle, len(channel_info)))
         
-        info = LayerInformation(len(records), records, ChannelImageData(channels))
+        info = LayerInformation(len(records), records, ChannelImageData(layers, self.rows))
         layer_mask_info = LayerMaskInformation(info, GlobalLayerMask())
-        image_data = ImageData(self.image().split()[0:3])
+        image_data = ImageData(self, self.rows)
         
-        file = PhotoshopFile(file_header, ColorModeData(), ImageResourceSection(), layer_mask_info, image_data)
+        file = PhotoshopFile(chain[0].head, ColorModeData(), ImageResourceSection(), layer_mask_info, image_data)
         
         if not hasattr(outfile, 'write'):
-            outfile = open(outfile, 'w')
+            outfile = open(outfile, 'wb')
         
-        outfile.write(file.tostring())
+        file.write(outfile)
         outfile.close()
 
 _modes = {
     blends.screen: 'scrn',
     blends.add: 'lddg',
     blends.multiply: 'mul ',
+    blends.subtract: 'fsub',
     blends.linear_light: 'lLit',
-    blends.hard_light: 'hLit'
+    blends.hard_light: 'hLit',
+    blends.overlay: 'over',
+    blends.soft_light: 'sLit',
+    blends.darken: 'dark',
+    blends.lighten: 'lite',
+    blends.difference: 'diff',
+    blends.exclusion: 'smud',
+    blends.color_dodge: 'div ',
+    blends.color_burn: 'idiv'
     }
 
+def _bounds(args):
+    ''' Return a (left, top, width, height) rectangle affected by blend() arguments.
+    
+        Return None if the whole canvas could be affected.
+    '''
+    layers = [layer for layer in (args['other'], args['mask']) if layer is not None]
+    sized = [layer for layer in layers if layer.size()]
+    
+    if not sized:
+        return None
+    
+    rects = [layer.origin() + layer.size() for layer in sized]
+    
+    return reduce(utils.intersection, rects)
+
+def _strips(top, height, rows):
+    ''' Generate (top, height) pairs for strips of up to rows each, or one for everything.
+    '''
+    rows = rows or max(height, 1)
+    
+    for y in range(top, top + height, rows):
+        yield y, min(rows, top + height - y)
+
 class _PSDMore (PSD):
     ''' Represents a Photoshop document that can be combined with other layers.
     
@@ -367,7 +537,8 @@ class _PSDMore (PSD):
     '''
     head = None
 
-    def __init__(self, base, name, other, mask=None, opacity=1, blendfunc=None, clipped=False):
+    def __init__(self, base, name, other, mask=None, opacity=1, blendfunc=None, clipped=False,
+                 dirty=None, previous=None):
         ''' Create a new PSD instance with the given additional Layer blended.
         
             Arguments
@@ -375,10 +546,71 @@ class _PSDMore (PSD):
               name: string with name of new layer for Photoshop output.
               other, mask, etc.: identical arguments as Layer.blend().
               clipped: boolean to clip this layer or no.
+              dirty: optional rectangle where base differs from previous.base.
+              previous: optional PSD instance to copy outside dirty rectangle.
         '''
-        more = Layer.blend(base, other, mask, opacity, blendfunc)
-        Layer.__init__(self, more.rgba(*more.size()))
+        self.rows, self.directory = base.rows, base.directory
+        
+        if dirty is None or previous is None:
+            if self.rows is None:
+                more = Layer.blend(base, other, mask, opacity, blendfunc)
+            else:
+                # composite into scratch files a strip at a time
+                strips = disk.DiskLayer(base.rgba(*base.size()), (0, 0), self.rows, self.directory)
+                more = strips.blend(other, mask, opacity, blendfunc)
+            
+            Layer.__init__(self, more.rgba(*more.size()))
+        
+        else:
+            #
+            # Recompute just the dirty area, and take the rest from previous.
+            #
+            rgba = [self._copy(chan) for chan in previous.rgba(*previous.size())]
+            left, top, width, height = utils.intersection(dirty, (0, 0) + previous.size())
+            
+            if width and height:
+                area = Layer(base.region(left, top, width, height), (left, top))
+                more = area.blend(other, mask, opacity, blendfunc)
+            
+                for (chan, part) in zip(rgba, more.region(left, top, width, height)):
+                    chan[top:top+height, left:left+width] = part
+            
+            Layer.__init__(self, rgba)
         
         self.base = base
+        self.args = dict(name=name, other=other, mask=mask, opacity=opacity,
+                         blendfunc=blendfunc, clipped=clipped)
         self.info = name, other, mask, int(opacity * 0xff), \
                     _modes.get(blendfunc, 'norm'), bool(clipped)
+    
+    def _copy(self, chan):
+        ''' Return a writeable copy of a channel, in a scratch file if composites are on disk.
+        '''
+        if self.rows is None:
+            return numpy.copy(chan)
+        
+        copy = disk.scratch(chan.shape, chan.dtype, self.directory)
+        copy[:] = chan
+        
+        return copy
+    
+    def __getstate__(self):
+        ''' Return the background and the blend() arguments of each layer for pickling.
+        
+            Composites aren't pickled, but rebuilt from these on unpickling.
+            The whole chain is pickled flat, so long ones don't run into the
+            recursion limit.
+        '''
+        chain = self._chain()
+        
+        return dict(background=chain[0], layers=[psd.args for psd in chain[1:]])
+    
+    def __setstate__(self, state):
+        ''' Rebuild a pickled PSD chain, layer by layer.
+        '''
+        psd = state['background']
+        
+        for args in state['layers'][:-1]:
+            psd = _PSDMore(psd, **args)
+        
+        _PSDMore.__init__(self, psd, **state['layers'][-1])
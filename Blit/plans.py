@@ -0,0 +1,164 @@
+""" Compiled composition plans from declarative style specs.
+
+A style spec describes a stack of layers as plain data, such as a dictionary
+or a JSON string, so it can be stored alongside other configuration. Each
+layer has a source and optional adjustments, and layers after the first are
+blended on top with an optional mask, opacity and blend mode:
+
+>>> from Blit import plans
+>>> plan = plans.compile({
+...     'layers': [
+...         {'source': 'base'},
+...         {'source': {'file': 'relief.png'}, 'opacity': .6, 'blend': 'multiply'},
+...         {'source': {'color': [50, 0, 100]}, 'mask': 'water',
+...          'adjust': [['curves', 0, 128, 255]]}
+...         ]
+...     })
+>>> plan.sources
+['base', 'water']
+>>> tile = plan.run(base=Bitmap('tile.png'), water=Bitmap('water.png'))
+
+Sources and masks are names of layers given to run(), a color as a list of
+8-bit values, or a file name. Layers may also have names, used in PSD output.
+Blend modes are names of functions in Blit.blends, and adjustments are
+a factory name from Blit.adjustments followed by its arguments.
+
+Specs are checked once by compile(), which also builds colors, files,
+blend functions and adjustment functions, and adjusts colors and files,
+so each run only adjusts named sources and composites.
+"""
+import json
+
+from . import Bitmap, Color, Mask
+from . import blends
+from . import adjustments
+
+_adjustments = dict([(func.__name__, func) for func in (adjustments.threshold,
+    adjustments.curves, adjustments.curves2, adjustments.blur, adjustments.glow,
+    adjustments.drop_shadow, adjustments.hillshade, adjustments.slope)])
+
+class Plan:
+    """ Compiled composition plan, reusable for any number of runs.
+    """
+    def __init__(self, steps, names=None):
+        """ Steps is a list of (source, adjustfuncs, mask, opacity, blendfunc) tuples.
+            
+            Sources and masks are Layers, or names of layers given to run().
+            Optional names is a list of layer names, one for each step.
+            Use compile() to make a Plan from a spec.
+        """
+        self.steps = steps
+        self.names = names or ['Layer %d' % index for index in range(len(steps))]
+        
+        names = [step[0] for step in steps] + [step[2] for step in steps]
+        self.sources = sorted(set([name for name in names if type(name) is str]))
+    
+    def run(self, **sources):
+        """ Return a new Layer composited from named source layers.
+            
+            Raise ValueError if a named source is missing.
+        """
+        layer = None
+        
+        for (other, mask, opacity, blendfunc) in self.layers(**sources):
+            if layer is None:
+                layer = other
+            else:
+                layer = layer.blend(other, mask, opacity, blendfunc)
+        
+        return layer
+    
+    def layers(self, **sources):
+        """ Generate (layer, mask, opacity, blendfunc) for each step in turn.
+            
+            Layers are adjusted and ready to blend, e.g. into a PSD chain.
+            Raise ValueError if a named source is missing.
+        """
+        missing = [name for name in self.sources if name not in sources]
+        
+        if missing:
+            raise ValueError('Missing sources: %s' % ', '.join(missing))
+        
+        for (source, adjustfuncs, mask, opacity, blendfunc) in self.steps:
+            other = sources[source] if type(source) is str else source
+            mask = sources[mask] if type(mask) is str else mask
+            
+            for adjustfunc in adjustfuncs:
+                other = other.adjust(adjustfunc)
+            
+            yield other, mask, opacity, blendfunc
+
+def compile(spec):
+    """ Return a new Plan for a style spec, a dictionary or JSON string.
+        
+        Raise ValueError for anything in the spec that doesn't make sense.
+    """
+    if type(spec) in (str, unicode):
+        spec = json.loads(spec)
+    
+    if type(spec) is not dict or not spec.get('layers'):
+        raise ValueError('Spec must have a list of layers')
+    
+    steps, names = [], []
+    
+    for (index, layer) in enumerate(spec['layers']):
+        unknown = set(layer) - set(('name', 'source', 'mask', 'opacity', 'blend', 'adjust'))
+        
+        if unknown:
+            raise ValueError('Unknown layer %d keys: %s' % (index, ', '.join(sorted(unknown))))
+        
+        if index == 0 and set(layer) & set(('mask', 'opacity', 'blend')):
+            raise ValueError('First layer has nothing to blend onto')
+        
+        if 'source' not in layer:
+            raise ValueError('Layer %d has no source' % index)
+        
+        source = _source(layer['source'], Bitmap)
+        mask = None if layer.get('mask') is None else _source(layer['mask'], Mask)
+        opacity = layer.get('opacity', 1)
+        
+        if not 0 <= opacity <= 1:
+            raise ValueError('Layer %d opacity must be from zero to one' % index)
+        
+        if layer.get('blend', 'normal') not in blends.modes:
+            raise ValueError('Unknown blend mode "%s"' % layer['blend'])
+        
+        blendfunc = blends.modes[layer.get('blend', 'normal')]
+        adjustfuncs = [_adjustment(args) for args in layer.get('adjust', [])]
+        
+        if type(source) is not str:
+            # colors and files are adjusted once here, instead of on every run
+            for adjustfunc in adjustfuncs:
+                source = source.adjust(adjustfunc)
+            
+            adjustfuncs = []
+        
+        steps.append((source, adjustfuncs, mask, opacity, blendfunc))
+        names.append(str(layer.get('name', 'Layer %d' % index)))
+    
+    return Plan(steps, names)
+
+def _source(value, kind):
+    """ Return a layer name, a Color, or a layer of a kind from a file.
+    """
+    if type(value) in (str, unicode):
+        return str(value)
+    
+    if type(value) is dict and list(value) == ['color'] and len(value['color']) in (3, 4):
+        return Color(*value['color'])
+    
+    if type(value) is dict and list(value) == ['file']:
+        return kind(value['file'])
+    
+    raise ValueError('Unknown source %s' % repr(value))
+
+def _adjustment(args):
+    """ Return an adjustment function from a factory name and arguments.
+    """
+    if type(args) not in (list, tuple) or not args or args[0] not in _adjustments:
+        raise ValueError('Unknown adjustment %s' % repr(args))
+    
+    try:
+        return _adjustments[args[0]](*args[1:])
+    except TypeError as e:
+        raise ValueError('Bad arguments for %s adjustment: %s' % (args[0], e))
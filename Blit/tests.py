@@ -4,9 +4,21 @@ Run as a module, like this:
     python -m Blit.tests
 """
 import unittest
+import pickle
+import json
+import threading
+import logging
+import subprocess
+import sys
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+import numpy
 import Image
 
-from . import Bitmap, Color, Layer, blends, adjustments, utils, photoshop
+from . import Bitmap, Color, Layer, LayerBatch, Mask, blends, adjustments, encode, workers, metatiles, disk, backends, cache, plans, cli, memory, utils, photoshop
 
 def _str2img(str):
     """
@@ -361,6 +373,1807 @@ class BlendTests(unittest.TestCase):
         
         assert psd.size() == (3, 6)
 
+class PositionTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+    
+        _ccc, _fff = '\xCC\xCC\xCC\xFF', '\xFF\xFF\xFF\xFF'
+        
+        # wide gray canvas, 5x3
+        self.canvas = Bitmap(Image.fromstring('RGBA', (5, 3), _ccc * 15))
+        
+        # small white marker, 2x1
+        self.marker = Bitmap(Image.fromstring('RGBA', (2, 1), _fff * 2), origin=(3, 1))
+    
+    def test0(self):
+        
+        # non-square layers are padded without swapping width and height
+        r, g, b, a = self.marker.rgba(5, 3)
+        
+        assert r.shape == (3, 5)
+        assert a[1,3] == 1 and a[1,4] == 1, 'marker pixels'
+        assert a.sum() == 2, 'everything else empty'
+    
+    def test1(self):
+        
+        out = self.canvas.blend(self.marker)
+        img = out.image()
+        
+        assert out.size() == (5, 3)
+        assert img.getpixel((2, 1)) == (0xCC, 0xCC, 0xCC, 0xFF), 'left of marker'
+        assert img.getpixel((3, 1)) == (0xFF, 0xFF, 0xFF, 0xFF), 'marker left'
+        assert img.getpixel((4, 1)) == (0xFF, 0xFF, 0xFF, 0xFF), 'marker right'
+        assert img.getpixel((3, 2)) == (0xCC, 0xCC, 0xCC, 0xFF), 'below marker'
+    
+    def test2(self):
+        
+        # marker hanging off the edge of the canvas is clipped
+        marker = Bitmap(self.marker.image(), origin=(4, 2))
+        out = self.canvas.blend(marker)
+        img = out.image()
+        
+        assert img.getpixel((3, 2)) == (0xCC, 0xCC, 0xCC, 0xFF), 'left of marker'
+        assert img.getpixel((4, 2)) == (0xFF, 0xFF, 0xFF, 0xFF), 'marker'
+    
+    def test3(self):
+        
+        # marker entirely outside the canvas does nothing
+        marker = Bitmap(self.marker.image(), origin=(10, 10))
+        out = self.canvas.blend(marker)
+        
+        assert out.image().getcolors() == [(15, (0xCC, 0xCC, 0xCC, 0xFF))]
+    
+    def test4(self):
+        
+        # colors blended onto a positioned layer take its place
+        out = Color(0, 0, 0).blend(self.marker)
+        
+        assert out.size() == (2, 1)
+        assert out.origin() == (3, 1)
+    
+    def test5(self):
+        
+        # masks restrict the blended area too
+        out = self.canvas.blend(Color(0, 0, 0), mask=self.marker)
+        img = out.image()
+        
+        assert img.getpixel((2, 1)) == (0xCC, 0xCC, 0xCC, 0xFF), 'left of mask'
+        assert img.getpixel((3, 1)) == (0x00, 0x00, 0x00, 0xFF), 'mask'
+        
+    def test6(self):
+        
+        # blending through a mask leaves the blended layer alone
+        self.canvas.blend(self.marker, mask=Color(0, 0, 0))
+        
+        assert self.marker.region(3, 1, 2, 1)[3].all()
+
+class EncodeTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+    
+        # 4x3 vertical gradient, transparent black to opaque white
+        pixels = ''.join([chr(v) * 4 for v in (0x00, 0x80, 0xFF) for i in range(4)])
+        self.gradient = Bitmap(Image.fromstring('RGBA', (4, 3), pixels))
+    
+    def test0(self):
+        
+        buffer = StringIO()
+        self.gradient.save(buffer, 'PNG', rows=2)
+        img = Image.open(StringIO(buffer.getvalue()))
+        
+        assert img.size == (4, 3)
+        assert img.mode == 'RGBA'
+        assert list(img.getdata()) == list(self.gradient.image().getdata())
+    
+    def test1(self):
+        
+        buffer = StringIO()
+        self.gradient.save(buffer, 'JPEG')
+        img = Image.open(StringIO(buffer.getvalue()))
+        
+        assert img.size == (4, 3)
+        assert img.format == 'JPEG'
+    
+    def test2(self):
+    
+        # strips can be composited one at a time
+        marker = Color(0xFF, 0x00, 0x00)
+        width, height = self.gradient.size()
+        strips = (strip.blend(marker, opacity=0.5) for strip in self.gradient.strips(1))
+        
+        buffer = StringIO()
+        encode.png(buffer, width, height, strips)
+        img = Image.open(StringIO(buffer.getvalue()))
+        
+        expected = self.gradient.blend(marker, opacity=0.5).image()
+        assert list(img.getdata()) == list(expected.getdata())
+    
+    def test3(self):
+        
+        # strips must cover the whole image
+        strips = self.gradient.strips(1)
+        self.assertRaises(ValueError, encode.png, StringIO(), 4, 5, strips)
+    
+    def test4(self):
+        
+        directory = tempfile.mkdtemp(prefix='blit-')
+        
+        try:
+            for format in ('PNG', 'JPEG'):
+                filename = os.path.join(directory, 'gradient.' + format.lower())
+                self.gradient.save(filename, format)
+                
+                img = Image.open(filename)
+                assert img.size == (4, 3) and img.format == format
+                assert img.getpixel((0, 2))[0:3] == (0xFF, 0xFF, 0xFF)
+            
+            # unknown formats are caught before any file is made
+            filename = os.path.join(directory, 'gradient.gif')
+            self.assertRaises(ValueError, self.gradient.save, filename, 'GIF')
+            assert not os.path.exists(filename)
+        finally:
+            shutil.rmtree(directory)
+
+class WorkerTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+    
+        self.gray = Bitmap(Image.new('RGBA', (3, 3), (0x80, 0x80, 0x80, 0xFF)))
+        self.executor = workers.Executor(threads=1, backlog=1, timeout=.1)
+        
+        # blocks the single worker thread until set
+        self.gate = threading.Event()
+    
+    def tearDown(self):
+        
+        self.gate.set()
+    
+    def test0(self):
+        
+        job = self.gray.blend_async(Color(0xFF, 0xFF, 0xFF), opacity=.5, executor=self.executor)
+        img = job.result(1).image()
+        
+        assert job.done()
+        assert img.getpixel((1, 1)) == (0xC0, 0xC0, 0xC0, 0xFF)
+    
+    def test1(self):
+    
+        job = self.gray.image_async(self.executor)
+        assert job.result(1).size == (3, 3)
+    
+    def test2(self):
+        
+        # one running and one waiting job fill the executor
+        running = self.executor.submit(self.gate.wait)
+        waiting = self.executor.submit(self.gray.image)
+        
+        self.assertRaises(workers.Busy, self.executor.submit, self.gray.image)
+        
+        # cancelling the waiting job makes room for another
+        assert waiting.cancel()
+        assert waiting.cancelled()
+        self.assertRaises(workers.Cancelled, waiting.result)
+        
+        job = self.executor.submit(self.gray.image)
+        self.gate.set()
+        
+        assert running.result(1)
+        assert job.result(1).size == (3, 3)
+    
+    def test3(self):
+        
+        # errors are raised from result()
+        job = self.executor.submit(self.gray.rgba, 'not', 'numbers')
+        self.assertRaises(TypeError, job.result, 1)
+    
+    def test4(self):
+    
+        finished = []
+        job = self.executor.submit(self.gray.image)
+        job.result(1)
+        job.add_done_callback(finished.append)
+        
+        assert finished == [job]
+    
+    def test5(self):
+        
+        def fail(job):
+            raise RuntimeError('Event loop is closed')
+        
+        # a failing callback doesn't take the only worker thread with it
+        job = self.executor.submit(self.gate.wait, .2)
+        job.add_done_callback(fail)
+        
+        logger = logging.getLogger('Blit.workers')
+        logger.disabled = True
+        
+        try:
+            job.result(1)
+            assert self.executor.submit(self.gray.image).result(1).size == (3, 3)
+        finally:
+            logger.disabled = False
+    
+    def test6(self):
+        
+        executor = workers.Executor(threads=1, backlog=0, timeout=.1)
+        started, stopping = threading.Event(), threading.Event()
+        
+        def render():
+            started.set()
+            stopping.wait(1)
+        
+        running = executor.submit(render)
+        started.wait(1)
+        
+        # a cancelled job still holds its thread until it returns
+        assert running.cancel()
+        self.assertRaises(workers.Busy, executor.submit, self.gray.image)
+        
+        stopping.set()
+        
+        # room is made as soon as the cancelled render returns
+        assert executor.submit(self.gray.image).result(1).size == (3, 3)
+    
+    def test7(self):
+        
+        executor = workers.Executor(threads=4)
+        corner = Layer([numpy.zeros((8, 8), numpy.float32)] * 4, (4, 4))
+        whole = Layer([numpy.zeros((128, 128), numpy.float32)] * 4)
+        random = numpy.random.RandomState(0)
+        
+        for trial in range(100):
+            noise = random.randint(0, 0x100, 256 * 256 * 4).astype(numpy.uint8)
+            image = Image.fromstring('RGBA', (256, 256), noise.tostring())
+            
+            expected = [layer.blend(Bitmap(image, scale=.5)).image().tostring() for layer in (corner, whole)]
+            
+            # one undecoded bitmap shared by jobs, some converting only a region
+            bitmap = Bitmap(image, scale=.5)
+            jobs = [(corner, whole)[index % 2].blend_async(bitmap, executor=executor) for index in range(8)]
+            
+            for (index, job) in enumerate(jobs):
+                assert job.result(5).image().tostring() == expected[index % 2]
+
+class MetatileTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+    
+        # 2x2 metatile of 2px tiles with 1px buffer, a red dot in the top right
+        image = Image.new('RGBA', (6, 6), (0, 0, 0, 0))
+        image.putpixel((3, 1), (0xFF, 0x00, 0x00, 0xFF))
+        
+        # bottom row is solid gray
+        image.paste((0x80, 0x80, 0x80, 0xFF), (0, 3, 6, 6))
+        
+        self.rendered = Bitmap(image)
+    
+    def test0(self):
+        
+        tiles = metatiles.Metatile(self.rendered, 2, 2, 2, 1).tiles()
+        
+        assert [(tile.row, tile.column) for tile in tiles] == [(0, 0), (0, 1), (1, 0), (1, 1)]
+        assert [tile.size() for tile in tiles] == [(2, 2)] * 4
+        
+        # tiles are views of the rendered layer, not copies
+        for tile in tiles:
+            for (chan, source) in zip(tile.rgba(2, 2), self.rendered.rgba(6, 6)):
+                assert numpy.may_share_memory(chan, source)
+    
+    def test1(self):
+        
+        tiles = metatiles.Metatile(self.rendered, 2, 2, 2, 1).tiles()
+        
+        assert [tile.empty() for tile in tiles] == [True, False, False, False]
+        assert tiles[0].solid() == (0, 0, 0, 0)
+        assert tiles[1].solid() is None
+        assert tiles[2].solid() == (0x80, 0x80, 0x80, 0xFF)
+    
+    def test2(self):
+        
+        metatile = metatiles.Metatile(self.rendered, 2, 2, 2, 1)
+        encoded = metatile.encode('PNG', workers.Executor(threads=2))
+        
+        tile, data = encoded[1]
+        img = Image.open(StringIO(data))
+        
+        assert (tile.row, tile.column) == (0, 1)
+        assert img.size == (2, 2)
+        assert img.getpixel((0, 0)) == (0xFF, 0x00, 0x00, 0xFF)
+        assert img.getpixel((1, 1)) == (0x00, 0x00, 0x00, 0x00)
+    
+    def test3(self):
+        
+        self.assertRaises(ValueError, metatiles.Metatile, self.rendered, 4, 4, 2, 1)
+
+class BatchTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+    
+        _808f, _fff8 = '\x80\x80\x80\xFF', '\xFF\xFF\xFF\x80'
+        _000f, _0000 = '\x00\x00\x00\xFF', '\x00\x00\x00\x00'
+        
+        self.gray = Bitmap(_str2img(_808f * 9))
+        self.black = Bitmap(_str2img(_000f * 9))
+        self.nothing = Bitmap(_str2img(_0000 * 9))
+        self.white_wipe = Bitmap(_str2img(_0000 * 3 + _fff8 * 3 + _808f * 3))
+        
+        self.tiles = [self.gray, self.black, self.nothing]
+    
+    def test0(self):
+        
+        batch = LayerBatch(self.tiles)
+        
+        assert len(batch) == 3
+        assert batch.size() == (3, 3)
+        assert batch[1].image().getpixel((1, 1)) == (0x00, 0x00, 0x00, 0xFF)
+    
+    def test1(self):
+    
+        # shared color and per-item masks match one-at-a-time blending
+        masks = LayerBatch([self.white_wipe, self.gray, self.black])
+        out = LayerBatch(self.tiles).blend(Color(0xFF, 0x99, 0x00), masks, opacity=.8)
+        
+        assert isinstance(out, LayerBatch)
+        
+        for (index, (tile, mask)) in enumerate(zip(self.tiles, masks.image())):
+            expected = tile.blend(Color(0xFF, 0x99, 0x00), Bitmap(mask), opacity=.8)
+            assert out[index].image().tostring() == expected.image().tostring()
+    
+    def test2(self):
+    
+        # single layer blended onto a whole batch, with a blend function
+        out = LayerBatch(self.tiles).blend(self.white_wipe, blendfunc=blends.hard_light)
+        
+        for (index, tile) in enumerate(self.tiles):
+            expected = tile.blend(self.white_wipe, blendfunc=blends.hard_light)
+            assert out[index].image().tostring() == expected.image().tostring()
+    
+    def test3(self):
+    
+        # color blended under a batch
+        out = Color(0x00, 0x00, 0xFF).blend(LayerBatch(self.tiles))
+        
+        assert isinstance(out, LayerBatch)
+        assert out[2].image().getpixel((1, 1)) == (0x00, 0x00, 0xFF, 0xFF)
+    
+    def test4(self):
+    
+        out = LayerBatch(self.tiles).adjust(adjustments.threshold(0x66))
+        images = out.image()
+        
+        assert images[0].getpixel((1, 1)) == (0xFF, 0xFF, 0xFF, 0xFF)
+        assert images[1].getpixel((1, 1)) == (0x00, 0x00, 0x00, 0xFF)
+    
+    def test5(self):
+        
+        nothing = LayerBatch([self.nothing, self.nothing])
+        blacks = LayerBatch([self.black, self.black])
+        
+        # a layer under a batch gives a batch, whatever the pixels
+        for out in (self.gray.blend(nothing), self.gray.blend(self.white_wipe, blacks),
+                    self.gray.blend(self.black, LayerBatch([self.gray.blend(Color(0xFF, 0xFF, 0xFF))] * 2))):
+            assert isinstance(out, LayerBatch) and len(out) == 2
+        
+        out = self.gray.blend(nothing)
+        assert out[1].image().tostring() == self.gray.image().tostring()
+
+class ImportTests(unittest.TestCase):
+    """
+    """
+    def test0(self):
+        
+        # heavy dependencies are left for first use
+        script = 'import sys, time; start = time.time(); import Blit; ' \
+                 'print time.time() - start; print sorted(set(sys.modules) & set(["sympy", "Image", "PIL"]))'
+        
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=package_dir)
+        elapsed, loaded = output.splitlines()
+        
+        assert loaded == '[]', 'Loaded ' + loaded
+        assert float(elapsed) < 1.0, 'Took %s seconds to import' % elapsed
+
+class DiskTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+    
+        _808f, _fff8, _0000 = '\x80\x80\x80\xFF', '\xFF\xFF\xFF\x80', '\x00\x00\x00\x00'
+        
+        self.gray = Bitmap(_str2img(_808f * 9))
+        self.white_wipe = Bitmap(_str2img(_0000 * 3 + _fff8 * 3 + _808f * 3))
+        self.directory = tempfile.mkdtemp(prefix='blit-')
+    
+    def tearDown(self):
+        
+        shutil.rmtree(self.directory)
+    
+    def test0(self):
+        
+        layer = disk.todisk(self.gray, rows=2, directory=self.directory)
+        
+        assert isinstance(layer.rgba(3, 3)[0], numpy.memmap)
+        assert layer.image().tostring() == self.gray.image().tostring()
+    
+        # scratch files disappear right away
+        assert os.listdir(self.directory) == []
+    
+    def test1(self):
+        
+        layer = disk.todisk(self.gray, rows=1, directory=self.directory)
+        out = layer.blend(self.white_wipe, Color(0xCC, 0xCC, 0xCC), opacity=.8, blendfunc=blends.screen)
+        expected = self.gray.blend(self.white_wipe, Color(0xCC, 0xCC, 0xCC), opacity=.8, blendfunc=blends.screen)
+        
+        assert isinstance(out, disk.DiskLayer)
+        assert isinstance(out.rgba(3, 3)[0], numpy.memmap)
+        assert out.image().tostring() == expected.image().tostring()
+    
+    def test2(self):
+        
+        layer = disk.todisk(self.white_wipe, rows=2, directory=self.directory)
+        out = layer.adjust(adjustments.curves(0xFF, 0x80, 0x00))
+        expected = self.white_wipe.adjust(adjustments.curves(0xFF, 0x80, 0x00))
+        
+        assert isinstance(out, disk.DiskLayer)
+        assert out.image().tostring() == expected.image().tostring()
+    
+    def test3(self):
+        
+        # disk layers work as sources for PSD files
+        layer = disk.todisk(self.white_wipe, rows=2, directory=self.directory)
+        psd = photoshop.PSD(3, 3).blend('Wipe', layer)
+        
+        filename = os.path.join(self.directory, 'wipe.psd')
+        psd.save(filename)
+        
+        assert open(filename, 'rb').read(4) == '8BPS'
+
+class ReplaceTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+    
+        _fff, _999 = '\xFF\xFF\xFF\xFF', '\x99\x99\x99\xFF'
+        
+        self.dots = Bitmap(Image.fromstring('RGBA', (2, 1), _fff * 2), origin=(1, 1))
+        self.moved = Bitmap(Image.fromstring('RGBA', (2, 1), _999 * 2), origin=(3, 2))
+        
+        self.psd = photoshop.PSD(5, 4)
+        self.psd = self.psd.blend('Orange', Color(0xFF, 0x99, 0x00))
+        self.psd = self.psd.blend('Dots', self.dots)
+        self.psd = self.psd.blend('Purple', Color(0x32, 0x00, 0x64), opacity=.5, blendfunc=blends.screen)
+    
+    def test0(self):
+        
+        out = self.psd.replace(1, other=Color(0x00, 0x99, 0xFF))
+        
+        expected = photoshop.PSD(5, 4)
+        expected = expected.blend('Orange', Color(0x00, 0x99, 0xFF))
+        expected = expected.blend('Dots', self.dots)
+        expected = expected.blend('Purple', Color(0x32, 0x00, 0x64), opacity=.5, blendfunc=blends.screen)
+        
+        assert out.image().tostring() == expected.image().tostring()
+        
+        # composites below the changed layer are reused
+        assert out.base.base.base is self.psd.base.base.base
+    
+    def test1(self):
+        
+        # moving a positioned layer only recomputes the area it covers
+        out = self.psd.replace('Dots', other=self.moved, opacity=.8)
+        
+        expected = photoshop.PSD(5, 4)
+        expected = expected.blend('Orange', Color(0xFF, 0x99, 0x00))
+        expected = expected.blend('Dots', self.moved, opacity=.8)
+        expected = expected.blend('Purple', Color(0x32, 0x00, 0x64), opacity=.5, blendfunc=blends.screen)
+        
+        assert out.image().tostring() == expected.image().tostring()
+        assert out.base.args['opacity'] == .8
+    
+    def test2(self):
+        
+        # explicit dirty areas are trusted
+        out = self.psd.replace('Purple', dirty=(0, 0, 1, 1), opacity=1)
+        img = out.image()
+        
+        assert img.getpixel((0, 0)) == (0xFF, 0x99, 0x64, 0xFF), 'recomputed'
+        assert img.getpixel((4, 3)) == self.psd.image().getpixel((4, 3)), 'reused'
+    
+    def test3(self):
+        
+        self.assertRaises(IndexError, self.psd.replace, 0, opacity=.5)
+        self.assertRaises(IndexError, self.psd.replace, 'Nothing', opacity=.5)
+
+class ConstantTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+    
+        _808f, _fff8, _0000 = '\x80\x80\x80\xFF', '\xFF\xFF\xFF\x80', '\x00\x00\x00\x00'
+        
+        self.gray = Bitmap(_str2img(_808f * 9))
+        self.nothing = Bitmap(_str2img(_0000 * 9))
+        self.white_wipe = Bitmap(_str2img(_0000 * 3 + _fff8 * 3 + _808f * 3))
+    
+    def test0(self):
+        
+        assert self.gray.opaque() and not self.gray.transparent()
+        assert self.nothing.transparent() and not self.nothing.opaque()
+        assert not self.white_wipe.opaque() and not self.white_wipe.transparent()
+        
+        assert [round(value * 255) for value in self.gray.uniform()] == [0x80, 0x80, 0x80, 0xFF]
+        assert self.white_wipe.uniform() is None
+        assert Color(0, 0, 0, 0).transparent()
+    
+    def test1(self):
+        
+        # empty top returns the bottom unchanged
+        out = self.white_wipe.blend(self.nothing, blendfunc=blends.screen)
+        
+        for (chan, bottom) in zip(out.rgba(3, 3), self.white_wipe.rgba(3, 3)):
+            assert numpy.may_share_memory(chan, bottom)
+    
+    def test2(self):
+        
+        # opaque plain paste returns the top
+        out = self.white_wipe.blend(self.gray)
+        
+        for (chan, top) in zip(out.rgba(3, 3), self.gray.rgba(3, 3)):
+            assert numpy.may_share_memory(chan, top)
+    
+    def test3(self):
+    
+        # single-color bitmaps blend just like colors
+        out1 = self.white_wipe.blend(self.gray, self.white_wipe, blendfunc=blends.hard_light)
+        out2 = self.white_wipe.blend(Color(0x80, 0x80, 0x80), self.white_wipe, blendfunc=blends.hard_light)
+        
+        assert out1.image().tostring() == out2.image().tostring()
+    
+    def test4(self):
+        
+        # uniform masks work like opacity
+        out1 = self.gray.blend(self.white_wipe, Color(0x80, 0x80, 0x80))
+        out2 = self.gray.blend(self.white_wipe, opacity=0x80/255.)
+        
+        assert out1.image().tostring() == out2.image().tostring()
+
+class SharingTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+    
+        _000f, _808f, _ffff = '\x00\x00\x00\xFF', '\x80\x80\x80\xFF', '\xFF\xFF\xFF\xFF'
+        
+        # opaque horizontal gradient, black to white
+        self.h_gradient = Bitmap(_str2img((_000f + _808f + _ffff) * 3))
+    
+    def test0(self):
+        
+        red = self.h_gradient.rgba(3, 3)[0]
+        
+        assert not red.flags.writeable
+        self.assertRaises(ValueError, red.fill, 0)
+    
+    def test1(self):
+    
+        # adjustments leave the source layer alone, and share what they don't change
+        before = self.h_gradient.image().tostring()
+        out = self.h_gradient.adjust(adjustments.threshold(0x99))
+        
+        assert self.h_gradient.image().tostring() == before
+        assert numpy.may_share_memory(out.rgba(3, 3)[3], self.h_gradient.rgba(3, 3)[3])
+    
+    def test2(self):
+        
+        # blends that change nothing share the bottom
+        rgba = self.h_gradient.rgba(3, 3)
+        out = blends.combine(rgba, rgba[0:3], numpy.zeros((3, 3)), 1, None)
+        
+        assert [chan is bottom for (chan, bottom) in zip(out, rgba)] == [True] * 4
+
+class BackendTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+    
+        random = numpy.random.RandomState(0)
+        
+        self.bottom = [random.rand(16, 16).astype(numpy.float32) for i in range(4)]
+        self.top = [random.rand(16, 16).astype(numpy.float32) for i in range(3)]
+        self.mask = random.rand(16, 16).astype(numpy.float32)
+    
+    def tearDown(self):
+    
+        backends.use('numpy')
+    
+    def _results(self):
+        """ Return a list of output arrays from all the kernels.
+        """
+        funcs = blends.screen, blends.add, blends.multiply, blends.subtract, \
+                blends.linear_light, blends.hard_light, blends.overlay, blends.soft_light, \
+                blends.darken, blends.lighten, blends.difference, blends.exclusion, \
+                blends.color_dodge, blends.color_burn
+        
+        results = [func(self.bottom[0], self.top[0]) for func in funcs]
+        
+        for func in (None, ) + funcs:
+            results += blends.combine(self.bottom, self.top, self.mask, .8, func)
+        
+        results += adjustments.curves2([(0, 22), (128, 150), (255, 240)])(self.bottom)[0:3]
+        
+        return results
+    
+    def test0(self):
+        
+        assert 'numpy' in backends.available()
+        self.assertRaises(ValueError, backends.use, 'nonexistent')
+    
+    def test1(self):
+        
+        expected = self._results()
+        
+        for name in backends.available():
+            backends.use(name)
+            
+            assert backends.current() == name
+            
+            for (result, value) in zip(self._results(), expected):
+                assert numpy.allclose(result, value, atol=1e-6), 'Backend %s' % name
+                assert result.dtype == value.dtype, 'Backend %s' % name
+
+class BlendModeTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        
+        # every combination of a few values, including the extremes
+        values = numpy.array([0, .2, .5, .8, 1], dtype=numpy.float32)
+        self.bottom, self.top = [chan.copy() for chan in numpy.meshgrid(values, values)]
+    
+    def test0(self):
+        
+        b, t = self.bottom.astype(float), self.top.astype(float)
+        
+        # reference math written with branches
+        expected = {
+            blends.hard_light: numpy.where(t < .5, 2 * b * t, 1 - 2 * (1 - b) * (1 - t)),
+            blends.overlay: numpy.where(b < .5, 2 * b * t, 1 - 2 * (1 - b) * (1 - t)),
+            blends.soft_light: numpy.where(t <= .5, b - (1 - 2 * t) * b * (1 - b), b + (2 * t - 1) * (numpy.sqrt(b) - b)),
+            blends.darken: numpy.minimum(b, t),
+            blends.lighten: numpy.maximum(b, t),
+            blends.difference: numpy.abs(b - t),
+            blends.exclusion: b + t - 2 * b * t,
+            blends.color_dodge: numpy.where(t == 1, numpy.where(b == 0, 0, 1), numpy.clip(b / (1 - t + (t == 1)), 0, 1)),
+            blends.color_burn: numpy.where(t == 0, numpy.where(b == 1, 1, 0), numpy.clip(1 - (1 - b) / (t + (t == 0)), 0, 1))
+            }
+        
+        for (func, values) in expected.items():
+            assert numpy.allclose(func(self.bottom, self.top), values, atol=1e-6), func.__name__
+    
+    def test1(self):
+    
+        # output goes where it's asked to
+        out = numpy.empty_like(self.bottom)
+        
+        for func in blends._with_out:
+            assert func(self.bottom, self.top, out=out) is out, func.__name__
+    
+    def test2(self):
+    
+        # single colors broadcast across whole channels
+        top = numpy.array(.8)
+        
+        for func in blends._with_out:
+            out = func(self.bottom, top)
+            assert numpy.allclose(out, func(self.bottom, numpy.ones_like(self.top) * .8)), func.__name__
+    
+    def test3(self):
+    
+        for func in blends._with_out:
+            assert func in photoshop._modes, func.__name__
+
+class MaskTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        
+        # horizontal gradient from black to white
+        self.gradient = numpy.tile(numpy.linspace(0, 1, 16).astype(numpy.float32), (8, 1))
+        self.rgba = [self.gradient.copy() for band in 'rgb'] + [numpy.ones((8, 16), numpy.float32)]
+    
+    def test0(self):
+        
+        # one channel in memory, whatever the source
+        mask = Mask(self.gradient.copy())
+        
+        red, green, blue, alpha = mask._rgba
+        
+        assert red is green and green is blue
+        assert alpha.strides == (0, 0)
+        assert mask.opaque()
+        assert mask.size() == (16, 8)
+        
+        image = Image.new('L', (16, 8), 0x80)
+        mask = Mask(image, origin=(4, 2))
+        
+        assert mask.image().mode == 'L'
+        assert mask.origin() == (4, 2)
+        assert mask.uniform() is not None
+        assert abs(mask.uniform()[0] - 0x80/255.) < 1e-6
+    
+    def test1(self):
+        
+        # same result as an equivalent RGBA mask
+        bottom = Color(0, 0, 0).blend(Layer(self.rgba), opacity=0)
+        
+        mask1 = Layer(self.rgba)
+        mask2 = Mask(mask1)
+        
+        out1 = bottom.blend(Color(255, 153, 0), mask=mask1).region(0, 0, 16, 8)
+        out2 = bottom.blend(Color(255, 153, 0), mask=mask2).region(0, 0, 16, 8)
+        
+        for (chan1, chan2) in zip(out1, out2):
+            assert numpy.allclose(chan1, chan2)
+    
+    def test2(self):
+        
+        # positioned masks clip like other layers
+        mask = Mask(self.gradient.copy(), origin=(4, 4))
+        lum = mask.luminance(0, 0, 8, 8)
+        
+        assert (lum[:4] == 0).all() and (lum[:, :4] == 0).all()
+        assert numpy.allclose(lum[4:, 4:], self.gradient[:4, :4])
+        assert numpy.may_share_memory(mask.luminance(4, 4, 4, 4), mask._lum)
+        
+        # constant masks take the shortcuts
+        assert Mask(numpy.zeros((8, 8), numpy.float32))._uniform_luminance() == 0
+    
+    def test3(self):
+        
+        # mask channel goes into Photoshop files
+        psd = photoshop.PSD(16, 8).blend('Orange', Color(255, 153, 0), mask=Mask(self.gradient.copy()))
+        
+        dirname = tempfile.mkdtemp(prefix='blit-')
+        
+        try:
+            filename = os.path.join(dirname, 'out.psd')
+            psd.save(filename)
+            assert os.path.getsize(filename) > 0
+        finally:
+            shutil.rmtree(dirname)
+    
+    def test4(self):
+        
+        # adjustments give back masks
+        inverted = Mask(self.gradient.copy()).adjust(lambda rgba: [1 - chan for chan in rgba[:3]] + rgba[3:])
+        
+        assert isinstance(inverted, Mask)
+        assert numpy.allclose(inverted.luminance(0, 0, 16, 8), 1 - self.gradient, atol=1e-6)
+
+class LazyBitmapTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        
+        # left half red, right half translucent blue
+        image = Image.new('RGBA', (64, 32), (0xFF, 0x00, 0x00, 0xFF))
+        image.paste((0x00, 0x00, 0xFF, 0x80), (32, 0, 64, 32))
+        
+        self.dirname = tempfile.mkdtemp(prefix='blit-')
+        self.png = os.path.join(self.dirname, 'image.png')
+        self.jpeg = os.path.join(self.dirname, 'image.jpg')
+        
+        image.save(self.png)
+        image.convert('RGB').save(self.jpeg)
+    
+    def tearDown(self):
+        
+        shutil.rmtree(self.dirname)
+    
+    def test0(self):
+        
+        # size comes from the header alone
+        bitmap = Bitmap(self.png, origin=(10, 10))
+        
+        assert bitmap.size() == (64, 32)
+        assert '_rgba' not in bitmap.__dict__
+        
+        # regions convert only what they need
+        red, green, blue, alpha = bitmap.region(0, 0, 20, 20)
+        
+        assert '_rgba' not in bitmap.__dict__
+        assert (alpha[:10] == 0).all() and (alpha[:, :10] == 0).all()
+        assert (red[10:, 10:] == 1).all() and (alpha[10:, 10:] == 1).all()
+        
+        partial = bitmap.region(30, 20, 40, 30)
+        whole = bitmap.region(10, 10, 64, 32)
+        
+        assert '_rgba' in bitmap.__dict__
+        
+        for (chan1, chan2) in zip(partial, Layer(whole, (10, 10)).region(30, 20, 40, 30)):
+            assert (chan1 == chan2).all()
+    
+    def test1(self):
+        
+        # constants checks don't need channels
+        bitmap = Bitmap(self.png)
+        
+        assert bitmap.opaque() is False and bitmap.transparent() is False
+        assert bitmap._constant(1) == 0
+        assert '_rgba' not in bitmap.__dict__
+        
+        # every band comes from one pass over the image
+        bitmap = Bitmap(self.png)
+        bitmap._constant(3)
+        assert sorted(bitmap._constants) == [0, 1, 2, 3]
+    
+    def test2(self):
+        
+        for filename in (self.png, self.jpeg):
+            bitmap = Bitmap(filename, scale=.25)
+            
+            assert bitmap.size() == (16, 8)
+            
+            red, green, blue, alpha = bitmap.region(0, 0, 16, 8)
+            
+            assert red.shape == (8, 16)
+            assert abs(red[4, 4] - 1) < .05 and abs(blue[4, 12] - 1) < .05
+    
+    def test3(self):
+        
+        image = Image.new('RGBA', (4, 4), (0xFF, 0x99, 0x00, 0xFF))
+        bitmap = Bitmap(image)
+        
+        assert bitmap.uniform() is not None
+        
+        # changes to the original image after the fact don't show
+        image.putpixel((1, 1), (0, 0, 0, 0))
+        
+        assert bitmap.image().getpixel((1, 1)) == (0xFF, 0x99, 0x00, 0xFF)
+        assert bitmap.region(0, 0, 4, 4)[3].min() == 1
+
+class CacheTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        
+        self.dirname = tempfile.mkdtemp(prefix='blit-')
+        self.filenames = [os.path.join(self.dirname, 'image%d.png' % index) for index in range(3)]
+        
+        for filename in self.filenames:
+            Image.new('RGBA', (16, 16), (0xFF, 0x99, 0x00, 0xFF)).save(filename)
+        
+        self.limit = cache.stats()['limit']
+        cache.clear()
+    
+    def tearDown(self):
+        
+        cache.limit(self.limit)
+        cache.clear()
+        shutil.rmtree(self.dirname)
+    
+    def test0(self):
+        
+        bitmap1 = Bitmap(self.filenames[0])
+        bitmap1.region(0, 0, 16, 16)
+        bitmap2 = Bitmap(self.filenames[0], origin=(8, 8))
+        
+        # second bitmap shares decoded channels with the first
+        assert numpy.may_share_memory(bitmap1.region(0, 0, 16, 16)[0], bitmap2.region(8, 8, 16, 16)[0])
+        assert bitmap2.origin() == (8, 8) and bitmap2.size() == (16, 16)
+        
+        stats = cache.stats()
+        assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
+        assert stats['bytes'] == 16 * 16 * 4 * 4
+        
+        # a different scale is a different entry
+        Bitmap(self.filenames[0], scale=.5).region(0, 0, 8, 8)
+        assert cache.stats()['entries'] == 2
+    
+    def test1(self):
+        
+        Bitmap(self.filenames[0]).region(0, 0, 16, 16)
+        
+        # changed files are decoded again
+        Image.new('RGBA', (16, 16), (0x00, 0x00, 0xFF, 0xFF)).save(self.filenames[0])
+        info = os.stat(self.filenames[0])
+        os.utime(self.filenames[0], (info.st_atime, info.st_mtime + 10))
+        
+        bitmap = Bitmap(self.filenames[0])
+        
+        assert (bitmap.region(0, 0, 16, 16)[2] == 1).all()
+        assert cache.stats()['entries'] == 1
+    
+    def test2(self):
+        
+        # room for two entries
+        cache.limit(16 * 16 * 4 * 4 * 2)
+        
+        for filename in self.filenames[:2] + self.filenames[:1] + self.filenames[2:]:
+            Bitmap(filename).region(0, 0, 16, 16)
+        
+        # least recently used entry went first
+        Bitmap(self.filenames[0])
+        Bitmap(self.filenames[1])
+        
+        stats = cache.stats()
+        assert (stats['hits'], stats['evictions'], stats['entries']) == (2, 1, 2)
+        
+        cache.limit(0)
+        assert cache.stats()['entries'] == 0
+
+class PSDExportTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        
+        self.dirname = tempfile.mkdtemp(prefix='blit-')
+        self.filename = os.path.join(self.dirname, 'out.psd')
+    
+    def tearDown(self):
+        
+        shutil.rmtree(self.dirname)
+    
+    def test0(self):
+        
+        dot = Bitmap(Image.new('RGBA', (5, 3), (0x00, 0x00, 0xFF, 0xFF)), origin=(60, 10))
+        
+        psd = photoshop.PSD(64, 32)
+        psd = psd.blend('Orange', Color(255, 153, 0))
+        psd = psd.blend('Dot', dot, blendfunc=blends.multiply)
+        psd.save(self.filename)
+        
+        # solid colors are fill layers, positioned layers keep to their area
+        image = Image.open(self.filename)
+        rectangles = [bbox for (name, mode, bbox) in [layer[:3] for layer in image.layers]]
+        
+        assert rectangles == [(0, 0, 64, 32), (0, 0, 0, 0), (60, 10, 64, 13)]
+        assert image.getpixel((62, 11)) == psd.image().getpixel((62, 11))[:3]
+        
+        # layers entirely outside the document are empty, not out of bounds
+        psd = psd.blend('Outside', Bitmap(Image.new('RGBA', (5, 3)), origin=(70, 40)))
+        psd.save(self.filename)
+        
+        image = Image.open(self.filename)
+        assert image.layers[-1][2] == (0, 0, 0, 0)
+        
+        image.seek(len(image.layers))
+        image.load()
+    
+    def test1(self):
+        
+        psd = photoshop.PSD(64, 64)
+        
+        for index in range(300):
+            psd = psd.blend('Layer %d' % index, Color(index % 256, 0, 0), opacity=.1)
+        
+        psd.save(self.filename)
+        
+        # no pixel data for any of the three hundred colors
+        assert os.path.getsize(self.filename) < 64 * 64 * 3 * 2 + 300 * 256
+        assert len(Image.open(self.filename).layers) == 301
+        
+        # odd-sized layer info is padded to an even length
+        psd = photoshop.PSD(3, 3).blend('Dot', Bitmap(Image.new('RGBA', (1, 1), (0, 0, 0, 0xFF))))
+        psd.save(self.filename)
+        
+        data = open(self.filename, 'rb').read()
+        length = int(data[38:42].encode('hex'), 16)
+        
+        assert length % 2 == 0
+        assert len(Image.open(self.filename).layers) == 2
+    
+    def test2(self):
+        
+        red = Color(0xFF, 0, 0, 0x80)
+        
+        for mask in (None, Mask(numpy.ones((4, 4), numpy.float32) * .5)):
+            psd = photoshop.PSD(4, 4).blend('Red', red, mask, opacity=.5)
+            psd.save(self.filename)
+            
+            # a translucent fill layer keeps its alpha as layer opacity
+            data = open(self.filename, 'rb').read()
+            opacity = ord(data[data.rindex('8BIMnorm') + 8])
+            
+            assert opacity == 0x40
+            
+            # and any pixels it stores are opaque, so alpha isn't applied twice
+            if mask is not None:
+                assert data.count('\x00\x00' + '\x80' * 16) == 1
+    
+    def test3(self):
+        
+        dot = Bitmap(Image.new('RGBA', (5, 3), (0x00, 0x00, 0xFF, 0xFF)), origin=(60, 10))
+        mask = Mask(numpy.linspace(0, 1, 64 * 32).astype(numpy.float32).reshape(32, 64))
+        saved = []
+        
+        for rows in (None, 5):
+            psd = photoshop.PSD(64, 32, rows=rows, directory=self.dirname)
+            psd = psd.blend('Orange', Color(255, 153, 0), mask)
+            psd = psd.blend('Dot', dot, blendfunc=blends.multiply)
+            psd = psd.replace('Orange', opacity=.5)
+            psd.save(self.filename)
+            
+            saved.append(open(self.filename, 'rb').read())
+        
+        # composites of the whole chain are in scratch files
+        for layer in (psd, psd.base):
+            assert isinstance(layer.rgba(64, 32)[0], numpy.memmap)
+        
+        # and save the same file a strip at a time
+        assert saved[0] == saved[1]
+        assert Image.open(self.filename).getpixel((62, 11)) == psd.image().getpixel((62, 11))[:3]
+
+class PaletteTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        
+        # four flat colors, one of them translucent and one transparent
+        image = Image.new('RGBA', (8, 8), (0xFF, 0x99, 0x00, 0xFF))
+        image.paste((0x00, 0x00, 0xFF, 0x80), (4, 0, 8, 4))
+        image.paste((0x11, 0x22, 0x33, 0x00), (0, 4, 4, 8))
+        image.paste((0xFF, 0xFF, 0xFF, 0xFF), (4, 4, 8, 8))
+        
+        self.flat = Bitmap(image)
+        
+        # smooth gradient with many more colors than fit in a palette
+        ramp = numpy.linspace(0, 1, 64).astype(numpy.float32)
+        red, green = numpy.meshgrid(ramp, ramp)
+        self.gradient = Layer([red, green, numpy.zeros_like(red), numpy.ones_like(red)])
+    
+    def test0(self):
+        
+        palette = encode.palette(self.flat.region(0, 0, 8, 8))
+        
+        # exact colors when there are few enough, transparent as black
+        assert palette.dtype == numpy.ubyte and palette.shape == (4, 4)
+        assert (0, 0, 0, 0) in map(tuple, palette)
+        
+        buffer = StringIO()
+        self.flat.save(buffer, palette=palette)
+        image = Image.open(StringIO(buffer.getvalue()))
+        
+        assert image.mode == 'P'
+        assert image.convert('RGBA').getpixel((6, 2)) == (0x00, 0x00, 0xFF, 0x80)
+        assert image.convert('RGBA').getpixel((6, 6)) == (0xFF, 0xFF, 0xFF, 0xFF)
+        assert image.convert('RGBA').getpixel((2, 6))[3] == 0
+    
+    def test1(self):
+        
+        palette = encode.palette(self.gradient.region(0, 0, 64, 64), 32)
+        
+        assert palette.shape == (32, 4)
+        
+        buffer = StringIO()
+        self.gradient.save(buffer, palette=32)
+        image = Image.open(StringIO(buffer.getvalue()))
+        
+        # nearest colors stay close to the originals
+        expected = numpy.array(self.gradient.image().convert('RGB')).astype(int)
+        actual = numpy.array(image.convert('RGB')).astype(int)
+        
+        assert len(image.getcolors()) <= 32
+        assert numpy.abs(expected - actual).max() < 32
+    
+    def test2(self):
+        
+        # one palette is shared by every tile
+        layer = Layer(self.gradient.region(0, 0, 64, 64))
+        encoded = metatiles.Metatile(layer, 2, 2, 32).encode(palette=16)
+        
+        palettes = [Image.open(StringIO(data)).getpalette()[:48] for (tile, data) in encoded]
+        
+        assert len(encoded) == 4
+        assert palettes[1:] == palettes[:-1]
+
+class FilterTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        
+        # white square in the middle of a transparent layer
+        alpha = numpy.zeros((80, 80), numpy.float32)
+        alpha[30:50, 30:50] = 1
+        
+        self.square = Layer([numpy.ones((80, 80), numpy.float32)] * 3 + [alpha])
+    
+    def test0(self):
+        
+        red, green, blue, alpha = self.square.adjust(adjustments.blur(3)).region(0, 0, 80, 80)
+        
+        # alpha spreads out but its total stays the same
+        assert abs(alpha.sum() - 400) < 1e-2
+        assert 0 < alpha[40, 27] < alpha[40, 30] < alpha[40, 33] < 1
+        assert alpha[40, 10] == 0
+        
+        # premultiplied colors don't pick up black from transparent areas
+        assert numpy.allclose(red[alpha > 0], 1)
+        
+        # no radius, no change
+        out = self.square.adjust(adjustments.blur(0)).region(0, 0, 80, 80)
+        assert (out[3] == self.square.region(0, 0, 80, 80)[3]).all()
+    
+    def test1(self):
+        
+        # cost doesn't depend on radius
+        assert len(adjustments._box_radii(2)) == len(adjustments._box_radii(40)) == 3
+        
+        # rows threaded in bands match a single pass
+        chan1 = numpy.random.RandomState(0).rand(300, 200).astype(numpy.float32)
+        chan2 = chan1.copy()
+        
+        adjustments._filter(chan1, [5])
+        adjustments._box(chan2, 5, -1)
+        adjustments._box(chan2, 5, -2)
+        
+        assert numpy.allclose(chan1, chan2, atol=1e-6)
+    
+    def test2(self):
+        
+        red, green, blue, alpha = self.square.adjust(adjustments.glow(2, 0xFF, 0x99, 0x00, 3)).region(0, 0, 80, 80)
+        
+        # original content stays on top of the halo
+        assert (red[30:50, 30:50] == 1).all() and (green[30:50, 30:50] == 1).all()
+        assert abs(green[40, 28] - 0x99/255.) < 1e-6 and alpha[40, 28] > .5
+        assert alpha[40, 10] == 0
+    
+    def test3(self):
+        
+        shadow = adjustments.drop_shadow(5, 5, 1, opacity=.5)
+        red, green, blue, alpha = self.square.adjust(shadow).region(0, 0, 80, 80)
+        
+        # shadow below and right, half opaque black
+        assert abs(alpha[52, 52] - .5) < 1e-6 and red[52, 52] == 0
+        assert alpha[28, 28] == 0
+        assert (alpha[30:50, 30:50] == 1).all()
+    
+    def test4(self):
+        
+        # blurred masks feather edges
+        mask = Mask(self.square.region(0, 0, 80, 80)[3].copy())
+        feathered = mask.adjust(adjustments.blur(2))
+        
+        assert isinstance(feathered, Mask)
+        assert 0 < feathered.luminance(0, 0, 80, 80)[40, 29] < 1
+
+class PyramidTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        
+        # opaque red on the left half, transparent green on the right
+        red = numpy.zeros((8, 10), numpy.float32)
+        green = numpy.zeros((8, 10), numpy.float32)
+        alpha = numpy.zeros((8, 10), numpy.float32)
+        
+        red[:, :5], alpha[:, :5], green[:, 5:] = 1, 1, 1
+        
+        self.layer = Layer([red, green, numpy.zeros_like(red), alpha], (4, 6))
+    
+    def test0(self):
+        
+        levels = self.layer.pyramid(2)
+        
+        assert levels[0] is self.layer
+        assert [level.size() for level in levels] == [(10, 8), (5, 4), (3, 2)]
+        assert [level.origin() for level in levels] == [(4, 6), (2, 3), (1, 1)]
+        
+        # no green bleeds in from transparent pixels
+        red, green, blue, alpha = levels[2].region(1, 1, 3, 2)
+        
+        assert (green == 0).all() and (red[alpha > 0] == 1).all()
+        assert numpy.allclose(alpha[0], [1, .25, 0])
+    
+    def test1(self):
+        
+        # reductions go all the way down, one at a time
+        reductions = self.layer.reductions()
+        
+        assert hasattr(reductions, 'next')
+        assert [level.size() for level in reductions] == [(5, 4), (3, 2), (2, 1), (1, 1)]
+        
+        # partly covered single pixel
+        red, green, blue, alpha = list(self.layer.reductions())[-1].region(0, 0, 1, 1)
+        assert 0 < alpha[0, 0] < 1 and red[0, 0] == 1 and green[0, 0] == 0
+    
+    def test2(self):
+        
+        batch = LayerBatch([self.layer, self.layer])
+        level = batch.pyramid(1)[1]
+        
+        assert isinstance(level, LayerBatch) and len(level) == 2
+        assert level.size() == (5, 4)
+
+class PickleTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        
+        self.dots = Bitmap(Image.fromstring('RGBA', (2, 1), '\xFF\x99\x00\xFF' * 2), origin=(1, 1))
+        self.mask = Mask(numpy.linspace(0, 1, 15).astype(numpy.float32).reshape(3, 5))
+        
+        self.psd = photoshop.PSD(5, 3)
+        self.psd = self.psd.blend('Purple', Color(0x32, 0x00, 0x64), mask=self.mask)
+        self.psd = self.psd.blend('Dots', self.dots, blendfunc=blends.screen)
+        
+        self.dirname = tempfile.mkdtemp(prefix='blit-')
+    
+    def tearDown(self):
+        
+        shutil.rmtree(self.dirname)
+    
+    def test0(self):
+        
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            layer = pickle.loads(pickle.dumps(self.dots, protocol))
+            
+            assert layer.origin() == (1, 1) and layer.size() == (2, 1)
+            assert layer.image().tostring() == self.dots.image().tostring()
+            assert not layer.region(1, 1, 2, 1)[0].flags.writeable
+            
+            mask = pickle.loads(pickle.dumps(self.mask, protocol))
+            
+            assert (mask.luminance(0, 0, 5, 3) == self.mask.luminance(0, 0, 5, 3)).all()
+            assert mask._rgba[0] is mask._rgba[2]
+            
+            color = pickle.loads(pickle.dumps(Color(0x32, 0x00, 0x64), protocol))
+            assert color.uniform() == Color(0x32, 0x00, 0x64).uniform()
+    
+    def test1(self):
+        
+        # chains are pickled as their arguments, not their composites
+        assert '_rgba' not in self.psd.__getstate__()
+        
+        psd = pickle.loads(pickle.dumps(self.psd, 2))
+        
+        assert psd.base.args['name'] == 'Purple'
+        assert psd.image().tostring() == self.psd.image().tostring()
+        
+        psd.save(os.path.join(self.dirname, 'out.psd'))
+    
+    def test2(self):
+        
+        filename = os.path.join(self.dirname, 'out.blit')
+        disk.dump(self.psd, filename)
+        psd = disk.load(filename)
+        
+        # channels are views of the mapped file
+        mask = psd.base.args['mask']
+        
+        assert isinstance(mask._lum.base, numpy.ndarray)
+        assert not mask._lum.flags.owndata and not mask._lum.flags.writeable
+        assert psd.image().tostring() == self.psd.image().tostring()
+        
+        # shared channels stay shared
+        layer = Layer([numpy.ones((4, 4), numpy.float32)] * 4, (3, 3))
+        disk.dump(layer, filename)
+        layer = disk.load(filename)
+        
+        assert layer.origin() == (3, 3)
+        assert layer._rgba[0] is layer._rgba[3]
+        
+        open(filename, 'wb').write('Nothing')
+        self.assertRaises(ValueError, disk.load, filename)
+    
+    def test3(self):
+        
+        chan = numpy.ones((64, 64), numpy.float32)
+        
+        # views are pickled as contiguous channels
+        state = Layer([chan[::2, ::2]] * 4).__getstate__()
+        assert all([part.flags.c_contiguous and part.shape == (32, 32) for part in state['_rgba']])
+        
+        # shared channels are pickled once, under every available protocol
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            data = pickle.dumps(Layer([chan] * 4), protocol)
+            layer = pickle.loads(data)
+            
+            assert layer._rgba[0] is layer._rgba[3]
+            assert protocol == 0 or len(data) < 64 * 64 * 4 * 2
+
+class PlanTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        
+        ramp = numpy.tile(numpy.linspace(0, 1, 8).astype(numpy.float32), (4, 1))
+        
+        self.base = Layer([ramp, ramp, ramp, numpy.ones_like(ramp)])
+        self.water = Mask(ramp[:, ::-1].copy())
+        
+        self.spec = {
+            'layers': [
+                {'source': 'base', 'adjust': [['curves', 0, 100, 255]]},
+                {'source': {'color': [255, 153, 0]}, 'opacity': .5, 'blend': 'multiply'},
+                {'source': {'color': [50, 0, 100]}, 'mask': 'water', 'blend': 'normal'}
+                ]
+            }
+    
+    def test0(self):
+        
+        plan = plans.compile(self.spec)
+        
+        assert plan.sources == ['base', 'water']
+        
+        # same as the equivalent chain of calls
+        expected = self.base.adjust(adjustments.curves(0, 100, 255))
+        expected = expected.blend(Color(255, 153, 0), opacity=.5, blendfunc=blends.multiply)
+        expected = expected.blend(Color(50, 0, 100), mask=self.water)
+        
+        for run in range(2):
+            out = plan.run(base=self.base, water=self.water)
+            
+            for (chan1, chan2) in zip(out.region(0, 0, 8, 4), expected.region(0, 0, 8, 4)):
+                assert numpy.allclose(chan1, chan2)
+    
+    def test1(self):
+        
+        # JSON works as well as dictionaries
+        plan = plans.compile(json.dumps(self.spec))
+        
+        assert plan.sources == ['base', 'water']
+        assert plan.steps[1][4] is blends.multiply
+        assert blends.modes['multiply'] is blends.multiply and blends.modes['normal'] is None
+        self.assertRaises(ValueError, plan.run, base=self.base)
+    
+    def test2(self):
+        
+        bad = [
+            {},
+            {'layers': [{'source': 'base', 'opacity': .5}]},
+            {'layers': [{'source': 'base'}, {'source': 'other', 'blend': 'nonexistent'}]},
+            {'layers': [{'source': 'base'}, {'source': 'other', 'opacity': 2}]},
+            {'layers': [{'source': 'base'}, {'source': {'colour': [0, 0, 0]}}]},
+            {'layers': [{'source': 'base', 'adjust': [['sharpen', 2]]}]},
+            {'layers': [{'source': 'base', 'adjust': [['curves', 0]]}]},
+            {'layers': [{'source': 'base', 'extra': True}]}
+            ]
+        
+        for spec in bad:
+            self.assertRaises(ValueError, plans.compile, spec)
+    
+    def test3(self):
+        
+        spec = {'layers': [{'source': 'base', 'adjust': [['threshold', 128]]},
+                           {'source': {'color': [255, 153, 0]}, 'adjust': [['threshold', 128]]}]}
+        
+        plan = plans.compile(spec)
+        
+        # named sources are adjusted on each run, colors just once up front
+        assert len(plan.steps[0][1]) == 1 and plan.steps[1][1] == []
+        assert plan.steps[1][0].uniform() == (1, 1, 0, 1)
+        assert plan.run(base=self.base).uniform() == (1, 1, 0, 1)
+
+class CommandLineTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        
+        self.dirname = tempfile.mkdtemp(prefix='blit-')
+        
+        Image.new('RGBA', (8, 4), (0x80, 0x80, 0x80, 0xFF)).save(os.path.join(self.dirname, 'base.png'))
+        Image.new('RGBA', (8, 4), (0xFF, 0xFF, 0xFF, 0xFF)).save(os.path.join(self.dirname, 'water.png'))
+        
+        layers = [{'source': 'base', 'name': 'Base'},
+                  {'source': {'color': [50, 0, 100]}, 'mask': 'water', 'name': 'Water'}]
+        
+        sources = dict(base=os.path.join(self.dirname, 'base.png'),
+                       water=os.path.join(self.dirname, 'water.png'))
+        
+        jobs = [dict(layers=layers, sources=sources, output=os.path.join(self.dirname, 'out.png')),
+                dict(layers=layers, sources=sources, output=os.path.join(self.dirname, 'out.psd')),
+                dict(layers=layers, sources={}, output=os.path.join(self.dirname, 'bad.png'))]
+        
+        self.jobs = os.path.join(self.dirname, 'jobs.txt')
+        open(self.jobs, 'w').write('\n'.join(map(json.dumps, jobs)) + '\n\n')
+    
+    def tearDown(self):
+        
+        shutil.rmtree(self.dirname)
+    
+    def test0(self):
+        
+        for processes in ('1', '2'):
+            output = StringIO()
+            status = cli.main(['-p', processes, self.jobs], stdout=output)
+            report = output.getvalue()
+            
+            assert status == 1
+            assert report.startswith('2 jobs in ')
+            assert '1 failed:' in report and 'line 3' in report and 'KeyError' in report
+            
+            for stage in ('compile', 'load', 'composite', 'save'):
+                assert ('  %s ' % stage) in report
+            
+            image = Image.open(os.path.join(self.dirname, 'out.png'))
+            assert image.getpixel((0, 0)) == (50, 0, 100, 0xFF)
+            
+            psd = open(os.path.join(self.dirname, 'out.psd'), 'rb').read()
+            assert psd.startswith('8BPS') and 'Base' in psd and 'Water' in psd
+    
+    def test1(self):
+        
+        output = StringIO()
+        status = cli.main(['-p', '1', '-v'], stdin=StringIO(open(self.jobs).read()), stdout=output)
+        
+        assert 'line 1, %s: 32 pixels in ' % os.path.join(self.dirname, 'out.png') in output.getvalue()
+    
+    def test2(self):
+        
+        masks = []
+        
+        class RecordedMask (Mask):
+            def __init__(self, input, origin=(0, 0)):
+                Mask.__init__(self, input, origin)
+                masks.append(input)
+        
+        # names used only as masks are loaded as Masks
+        cli.Mask = RecordedMask
+        
+        try:
+            result = cli.render((1, open(self.jobs).readline()))
+        finally:
+            cli.Mask = Mask
+        
+        assert result['error'] is None
+        assert masks == [os.path.join(self.dirname, 'water.png')]
+    
+    def test3(self):
+        
+        # a color background takes the document size from a later source
+        layers = [{'source': {'color': [50, 0, 100]}, 'name': 'Purple'},
+                  {'source': 'base', 'mask': 'water', 'name': 'Base'}]
+        
+        sources = dict(base=os.path.join(self.dirname, 'base.png'),
+                       water=os.path.join(self.dirname, 'water.png'))
+        
+        output = os.path.join(self.dirname, 'out.psd')
+        result = cli.render((1, json.dumps(dict(layers=layers, sources=sources, output=output))))
+        
+        assert result['error'] is None and result['pixels'] == 32
+        assert Image.open(output).size == (8, 4)
+        
+        # with no size anywhere, the error says so
+        output = os.path.join(self.dirname, 'color.psd')
+        result = cli.render((1, json.dumps(dict(layers=layers[:1], output=output))))
+        
+        assert 'PSD output needs a source with a size' in result['error']
+
+class MemoryTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        
+        random = numpy.random.RandomState(0)
+        
+        self.bottom = Layer([random.rand(40, 30).astype(numpy.float32) for i in range(4)])
+        self.top = Layer([random.rand(20, 10).astype(numpy.float32) for i in range(4)], (5, 10))
+        self.mask = Mask(random.rand(40, 30).astype(numpy.float32))
+    
+    def tearDown(self):
+        
+        memory.budget(None)
+    
+    def assertSameLayers(self, layer1, layer2):
+        
+        assert layer1.origin() == layer2.origin() and layer1.size() == layer2.size()
+        
+        for (chan1, chan2) in zip(layer1.region(0, 0, 30, 40), layer2.region(0, 0, 30, 40)):
+            assert numpy.abs(chan1 - chan2).max() < 1e-6
+    
+    def test0(self):
+        
+        # full overlap only needs temporaries for the blended area
+        assert memory.blend_bytes(self.bottom, self.mask) == 30 * 40 * 4 * 12
+        
+        # partial overlap adds a copy of the full bottom layer
+        assert memory.blend_bytes(self.bottom, self.top) == 10 * 20 * 4 * 12 + 30 * 40 * 4 * 4
+        assert memory.blend_bytes(self.bottom, Color(0, 0, 0), self.top) == memory.blend_bytes(self.bottom, self.top)
+        
+        assert memory.blend_bytes(Color(0, 0, 0), Color(0xFF, 0xFF, 0xFF)) == 0
+        assert memory.adjust_bytes(self.bottom) == 30 * 40 * 4 * 6
+        assert memory.adjust_bytes(Color(0, 0, 0)) == 0
+        
+        # estimates of undecoded bitmaps don't decode them
+        bitmap = Bitmap(Image.new('RGBA', (16, 16)))
+        assert memory.blend_bytes(bitmap, bitmap) == 16 * 16 * 4 * 12
+        assert '_rgba' not in bitmap.__dict__
+        
+        self.assertRaises(ValueError, memory.budget, 1024, 'swap')
+    
+    def test1(self):
+        
+        memory.budget(10000)
+        
+        self.assertRaises(memory.OverBudget, self.bottom.blend, self.top)
+        self.assertRaises(memory.OverBudget, self.bottom.adjust, adjustments.threshold(.5))
+        self.assertRaises(memory.OverBudget, self.mask.adjust, adjustments.threshold(.5))
+        self.assertRaises(MemoryError, self.bottom.blend, self.top, self.mask)
+        
+        # blends that need no temporaries still work
+        assert self.bottom.blend(self.top, opacity=0).size() == (30, 40)
+        assert self.bottom.blend(Layer([numpy.ones((40, 30))] * 4)).size() == (30, 40)
+        
+        memory.budget(None)
+        self.bottom.blend(self.top)
+    
+    def test2(self):
+        
+        expected1 = self.bottom.blend(self.top, opacity=.6, blendfunc=blends.multiply)
+        expected2 = self.bottom.blend(self.top, self.mask)
+        expected3 = Color(0xFF, 0x99, 0).blend(self.bottom, self.mask)
+        
+        memory.budget(30 * 40 * 4 * 4 + 30 * 12 * 4 * 7, strategy='strips')
+        
+        self.assertSameLayers(self.bottom.blend(self.top, opacity=.6, blendfunc=blends.multiply), expected1)
+        self.assertSameLayers(self.bottom.blend(self.top, self.mask), expected2)
+        
+        # unsized bottom layers can't be split into strips
+        self.assertRaises(memory.OverBudget, Color(0xFF, 0x99, 0).blend, self.bottom, self.mask)
+        
+        memory.budget(30 * 12 * 4 * 7, strategy='disk')
+        
+        blended = self.bottom.blend(self.top, self.mask)
+        assert isinstance(blended, disk.DiskLayer)
+        self.assertSameLayers(blended, expected2)
+        
+        # not even one row fits
+        memory.budget(30 * 4 * 4, strategy='disk')
+        self.assertRaises(memory.OverBudget, self.bottom.blend, self.top)
+    
+    def test3(self):
+        
+        batch = LayerBatch([self.bottom, self.bottom.adjust(adjustments.threshold(.5))])
+        expected = batch.blend(self.top, self.mask)
+        
+        nbytes = memory.blend_bytes(batch, self.top, self.mask)
+        
+        # room for new channels and a few rows at a time
+        memory.budget(30 * 40 * 4 * 4 * 2 + 5 * (10 * 12 + 30 * 4) * 4 * 2, strategy='strips')
+        self.assertRaises(memory.OverBudget, memory.check, nbytes, 'Blend')
+        
+        blended = batch.blend(self.top, self.mask)
+        
+        assert isinstance(blended, LayerBatch) and len(blended) == 2
+        
+        for index in range(2):
+            self.assertSameLayers(blended[index], expected[index])
+    
+    def test4(self):
+        
+        plan = plans.compile({'layers': [{'source': 'base'}, {'source': 'top', 'mask': 'water',
+                              'adjust': [['threshold', 128]]}]})
+        
+        nbytes = memory.plan_bytes(plan, base=self.bottom, top=self.top, water=self.mask)
+        held = 30 * 40 * 4 * 4
+        
+        assert nbytes == held + memory.blend_bytes(self.bottom, self.top, self.mask)
+        
+        # each step is held to the budget on its own
+        memory.budget(nbytes - held - 1)
+        self.assertRaises(memory.OverBudget, plan.run, base=self.bottom, top=self.top, water=self.mask)
+        
+        memory.budget(nbytes - held)
+        plan.run(base=self.bottom, top=self.top, water=self.mask)
+        
+        memory.budget(None)
+        psd = photoshop.PSD(30, 40).blend('Top', self.top, self.mask)
+        
+        memory.budget(memory.save_bytes(psd) - 1)
+        self.assertRaises(memory.OverBudget, psd.save, StringIO())
+        
+        directory = tempfile.mkdtemp(prefix='blit-')
+        filename = os.path.join(directory, 'top.psd')
+        
+        try:
+            memory.budget(memory.save_bytes(psd))
+            psd.save(filename)
+            assert open(filename, 'rb').read(4) == '8BPS'
+        finally:
+            shutil.rmtree(directory)
+    
+    def test5(self):
+        
+        assert utils.intersection((0, 0, 30, 40), (5, 10, 10, 20)) == (5, 10, 10, 20)
+        assert utils.intersection((0, 0, 30, 40), (25, 35, 10, 20)) == (25, 35, 5, 5)
+        assert utils.intersection((0, 0, 30, 40), (50, 0, 10, 20)) == (50, 0, 0, 20)
+        assert utils.union((0, 0, 30, 40), (25, 35, 10, 20)) == (0, 0, 35, 55)
+        assert utils.union((0, 0, 30, 40), None) is None
+        
+        canvas = self.bottom.origin() + self.bottom.size()
+        assert memory.blend_strips(self.bottom, canvas, (5, 10, 10, 20)) is None
+        
+        # room for new channels and three rows of the blend
+        memory.budget(30 * 40 * 4 * 4 + 3 * (10 * 12 + 30 * 4) * 4, strategy='strips')
+        assert memory.blend_strips(self.bottom, canvas, (5, 10, 10, 20)) == ('strips', 3)
+
+class ColorspaceTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        
+        self.dirname = tempfile.mkdtemp(prefix='blit-')
+        self.filename = os.path.join(self.dirname, 'grey.png')
+        Image.new('RGBA', (4, 4), (0x80, 0x80, 0x80, 0x80)).save(self.filename)
+        
+        self.previous = utils.colorspace('linear')
+    
+    def tearDown(self):
+        
+        utils.colorspace(self.previous)
+        cache.clear()
+        shutil.rmtree(self.dirname)
+    
+    def test0(self):
+        
+        assert utils.colorspace() == 'linear'
+        self.assertRaises(ValueError, utils.colorspace, 'cmyk')
+        
+        # every 8-bit value survives a round trip
+        ubytes = numpy.arange(256).astype(numpy.ubyte)
+        assert (utils.color2ubyte(utils.ubyte2color(ubytes)) == ubytes).all()
+        
+        # tables round exactly as the sRGB formula would
+        linear = numpy.linspace(-.1, 1.1, 100001).astype(numpy.float32)
+        expected = numpy.round(numpy.clip(utils._srgb(numpy.clip(linear, 0, 1)) * 255, 0, 255))
+        assert (utils.color2ubyte(linear) == expected).all()
+        
+        assert abs(utils.ubyte2color(0x80) - 0.2158605) < 1e-6
+        assert abs(utils.srgb2color(.5) - 0.2140411) < 1e-6
+        assert abs(utils.color2srgb(0.2140411) - .5) < 1e-6
+    
+    def test1(self):
+        
+        bitmap = Bitmap(self.filename)
+        red, green, blue, alpha = bitmap.region(0, 0, 4, 4)
+        
+        # color channels are linear, alpha isn't
+        assert abs(red[0,0] - 0.2158605) < 1e-6
+        assert abs(alpha[0,0] - 0x80 / 255.) < 1e-6
+        assert abs(Bitmap(self.filename)._constant(0) - 0.2158605) < 1e-6
+        
+        assert bitmap.image().getpixel((0, 0)) == (0x80, 0x80, 0x80, 0x80)
+        
+        color = Color(0xFF, 0x99, 0x00)
+        assert abs(color.rgba(1, 1)[1][0,0] - 0.3185468) < 1e-6
+        assert color.image().getpixel((0, 0)) == (0xFF, 0x99, 0x00, 0xFF)
+        assert color.adjust(adjustments.threshold(0)).image().getpixel((0, 0)) == (0xFF, 0xFF, 0x00, 0xFF)
+        
+        # half-and-half blends of black and white are lighter in linear light
+        grey = Color(0, 0, 0).blend(Color(0xFF, 0xFF, 0xFF), opacity=.5)
+        assert grey.image().getpixel((0, 0)) == (0xBC, 0xBC, 0xBC, 0xFF)
+        
+        black = Layer([numpy.zeros((2, 2), numpy.float32)] * 3 + [numpy.ones((2, 2), numpy.float32)])
+        white = black.blend(Color(0xFF, 0xFF, 0xFF), opacity=.5)
+        assert white.image().getpixel((0, 0)) == (0xBC, 0xBC, 0xBC, 0xFF)
+        
+        buffer = StringIO()
+        white.save(buffer)
+        assert Image.open(StringIO(buffer.getvalue())).convert('RGBA').getpixel((1, 1)) == (0xBC, 0xBC, 0xBC, 0xFF)
+        
+        tile = metatiles.Metatile(white, rows=1, columns=1, size=2, buffer=0).tiles()[0]
+        assert tile.solid() == (0xBC, 0xBC, 0xBC, 0xFF)
+    
+    def test2(self):
+        
+        Bitmap(self.filename).region(0, 0, 4, 4)
+        utils.colorspace('srgb')
+        
+        # decoded channels for each color space are kept apart
+        red = Bitmap(self.filename).region(0, 0, 4, 4)[0]
+        assert abs(red[0,0] - 0x80 / 255.) < 1e-6
+        assert cache.stats()['entries'] == 2
+    
+    def test3(self):
+        
+        # masks are measured in sRGB, in any color space
+        bitmap, mask = Bitmap(self.filename), Mask(self.filename)
+        assert numpy.abs(bitmap.luminance(0, 0, 4, 4) - mask.luminance(0, 0, 4, 4)).max() < 1e-6
+        assert abs(Mask(bitmap)._uniform_luminance() - 0x80 / 255.) < 1e-6
+        assert abs(bitmap._uniform_luminance() - 0x80 / 255.) < 1e-6
+        
+        black = Color(0, 0, 0)
+        white = Color(0xFF, 0xFF, 0xFF)
+        
+        pixel1 = black.blend(white, mask=bitmap).image().getpixel((0, 0))
+        pixel2 = black.blend(white, mask=mask).image().getpixel((0, 0))
+        assert pixel1 == pixel2 == (0xBC, 0xBC, 0xBC, 0xFF)
+        
+        # adjusted masks stay mask values, not colors
+        assert abs(mask.adjust(adjustments.curves(0, 0x80, 0xFF))._uniform_luminance() - .5) < 1e-3
+    
+    def test4(self):
+        
+        alpha = numpy.zeros((3, 3), numpy.float32)
+        alpha[1,1] = 1
+        dot = Layer([alpha * 0, alpha * 0, alpha * 0, alpha])
+        
+        # shadow and glow colors are sRGB, like Colors
+        shadow = dot.adjust(adjustments.drop_shadow(1, 0, 0, 1, 0x80, 0x80, 0x80))
+        assert shadow.image().getpixel((2, 1)) == (0x80, 0x80, 0x80, 0xFF)
+        
+        glow = dot.adjust(adjustments.glow(1, 0x80, 0x80, 0x80, strength=3))
+        assert glow.image().getpixel((0, 1))[0:3] == (0x80, 0x80, 0x80)
+
+class TerrainTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        
+        rows, columns = numpy.mgrid[0:8, 0:8].astype(numpy.float32)
+        alpha = numpy.ones((8, 8), numpy.float32)
+        
+        # rising to the east, and rising to the south and east
+        self.east = Layer([columns, columns, columns, alpha])
+        self.southeast = Layer([rows + columns, rows + columns, rows + columns, alpha * .5])
+        self.flat = Layer([alpha * .2, alpha * .2, alpha * .2, alpha])
+    
+    def test0(self):
+        
+        red, green, blue, alpha = self.flat.adjust(adjustments.hillshade(altitude=30)).region(0, 0, 8, 8)
+        assert numpy.abs(red - .5).max() < 1e-6 and red.dtype == numpy.float32
+        assert (red == green).all() and (red == blue).all() and (alpha == 1).all()
+        
+        # light from the northwest falls full on slopes facing it
+        red, green, blue, alpha = self.southeast.adjust(adjustments.hillshade()).region(0, 0, 8, 8)
+        assert red[4,4] > .98 and (alpha == .5).all()
+        
+        # slopes facing away from the light are in shadow
+        red = self.southeast.adjust(adjustments.hillshade(azimuth=135)).region(0, 0, 8, 8)[0]
+        assert red[4,4] == 0
+        
+        # light from due east, at 45 degrees, onto a 45 degree slope
+        red = self.east.adjust(adjustments.hillshade(azimuth=90)).region(0, 0, 8, 8)[0]
+        assert abs(red[4,4] - 0) < 1e-6
+        
+        red = self.east.adjust(adjustments.hillshade(azimuth=270)).region(0, 0, 8, 8)[0]
+        assert abs(red[4,4] - 1) < 1e-6
+        
+        red = self.east.adjust(adjustments.slope()).region(0, 0, 8, 8)[0]
+        assert numpy.abs(red[:,1:-1] - .5).max() < 1e-6
+        
+        # repeated edge pixels make for half the slope
+        assert abs(red[4,0] - numpy.arctan(.5) / (numpy.pi / 2)) < 1e-6
+        
+        red = self.east.adjust(adjustments.slope(zfactor=2, scale=2)).region(0, 0, 8, 8)[0]
+        assert numpy.abs(red[:,1:-1] - .5).max() < 1e-6
+    
+    def test1(self):
+        
+        elevation = numpy.random.RandomState(0).rand(40, 40).astype(numpy.float32)
+        relief = Mask(elevation).adjust(adjustments.hillshade(azimuth=300, zfactor=3))
+        
+        assert isinstance(relief, Mask)
+        
+        # a tile with a one pixel buffer matches the whole relief inside it
+        tile = Mask(elevation[9:31, 19:31].copy(), (19, 9)).adjust(adjustments.hillshade(azimuth=300, zfactor=3))
+        
+        expected = relief.luminance(20, 10, 10, 20)
+        assert numpy.abs(tile.luminance(20, 10, 10, 20) - expected).max() < 1e-6
+        
+        # but not without one
+        tile = Mask(elevation[10:30, 20:30].copy(), (20, 10)).adjust(adjustments.hillshade(azimuth=300, zfactor=3))
+        assert numpy.abs(tile.luminance(20, 10, 10, 20) - expected).max() > .01
+    
+    def test2(self):
+        
+        batch = LayerBatch([self.east, self.southeast])
+        relief = batch.adjust(adjustments.slope())
+        
+        assert isinstance(relief, LayerBatch)
+        assert numpy.abs(relief[1].region(0, 0, 8, 8)[0] - self.southeast.adjust(adjustments.slope()).region(0, 0, 8, 8)[0]).max() < 1e-6
+        
+        plan = plans.compile({'layers': [{'source': 'elevation', 'adjust': [['hillshade', 270, 45], ['slope']]}]})
+        relief = plan.run(elevation=self.east)
+        
+        assert numpy.abs(relief.region(0, 0, 8, 8)[0][:,2:-2] - 0).max() < 1e-6
+
 class AdjustmentTests(unittest.TestCase):
     """
     """
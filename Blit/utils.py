@@ -1,9 +1,24 @@
+""" Image and array utility functions.
+
+PIL is imported on first use, so that loading Blit stays quick for
+work that never touches an image file.
+
+Color channels are gamma-encoded sRGB values by default, so blends darken
+anti-aliased edges a little. In linear mode, color channels of images are
+converted to linear light as they're read and back to sRGB as they're
+written, through lookup tables that are exact for 8-bit values. Alpha and
+masks are unchanged. Switch before making any layers:
+
+>>> from Blit import utils
+>>> utils.colorspace('linear')
+'srgb'
+"""
 import numpy
-import Image
 
 def arr2img(ar):
     """ Convert Numeric array to PIL Image.
     """
+    import Image
     return Image.fromstring('L', (ar.shape[1], ar.shape[0]), ar.astype(numpy.ubyte).tostring())
 
 def img2arr(im):
@@ -12,10 +27,93 @@ def img2arr(im):
     assert im.mode == 'L'
     return numpy.reshape(numpy.fromstring(im.tostring(), numpy.ubyte), (im.size[1], im.size[0]))
 
+def colorspace(name=None):
+    """ Return the current color space, "srgb" or "linear", optionally setting a new one.
+    
+        Bitmaps in the cache are kept apart for each color space.
+    """
+    global _colorspace
+    
+    previous = _colorspace
+    
+    if name not in (None, 'srgb', 'linear'):
+        raise ValueError('Unknown color space "%s"' % name)
+    
+    _colorspace = name or _colorspace
+    
+    return previous
+
+def srgb2color(values):
+    """ Convert gamma-encoded sRGB values from 0 to 1 to color channel values.
+    
+        Color channel values are linear light in linear mode.
+    """
+    if _colorspace == 'linear':
+        return _linear(_floats(values))
+    
+    return values
+
+def color2srgb(values):
+    """ Convert color channel values to gamma-encoded sRGB values from 0 to 1.
+    """
+    if _colorspace == 'linear':
+        return _srgb(numpy.clip(_floats(values), 0, 1))
+    
+    return values
+
+def ubyte2color(arr):
+    """ Convert 8-bit sRGB values to a single floating point color channel.
+    """
+    if _colorspace == 'linear':
+        return _decoding[arr]
+    
+    return numpy.asarray(arr).astype(numpy.float32) / 255.0
+
+def color2ubyte(chan):
+    """ Convert single floating point color channel to 8-bit sRGB values.
+    
+        In linear mode, a table of 4096 steps gives each value's 8-bit value or
+        the one below it, and a comparison with the linear value halfway to the
+        next 8-bit value settles which, rounding exactly as sRGB values would.
+    """
+    if _colorspace == 'linear':
+        chan = numpy.clip(chan, 0, 1)
+        ubytes = _encoding_steps[(chan * 4096).astype(numpy.intp)]
+        ubytes += chan >= _encoding[ubytes]
+        return ubytes
+    
+    return chan2ubyte(chan)
+
+def rgba2ubytes(rgba):
+    """ Convert a list of channels to 8-bit values, treating the first three as colors.
+    """
+    return [(color2ubyte if index < 3 else chan2ubyte)(chan) for (index, chan) in enumerate(rgba)]
+
+def chan2ubyte(chan):
+    """ Convert single floating point Numeric array object to 8-bit values.
+    """
+    return numpy.round(chan * 255.0).astype(numpy.ubyte)
+
+def chan2constant(chan):
+    """ Return the single value of a Numeric array object, or None if it varies.
+    
+        A sparse sample of the array is checked first, so most varied
+        images are identified without looking at every value.
+    """
+    if not chan.size:
+        return None
+    
+    value = chan.flat[0]
+    
+    if (chan[..., ::61, ::61] != value).any() or (chan != value).any():
+        return None
+    
+    return float(value)
+
 def chan2img(chan):
     """ Convert single Numeric array object to one-channel PIL Image.
     """
-    return arr2img(numpy.round(chan * 255.0).astype(numpy.ubyte))
+    return arr2img(chan2ubyte(chan))
 
 def img2chan(img):
     """ Convert one-channel PIL Image to single Numeric array object.
@@ -25,14 +123,16 @@ def img2chan(img):
 def rgba2img(rgba):
     """ Convert four Numeric array objects to PIL Image.
     """
+    import Image
     assert type(rgba) in (tuple, list)
-    return Image.merge('RGBA', [chan2img(band) for band in rgba])
+    return Image.merge('RGBA', [arr2img(band) for band in rgba2ubytes(rgba)])
 
 def img2rgba(im):
     """ Convert PIL Image to four Numeric array objects.
     """
     assert im.mode == 'RGBA'
-    return [img2chan(band) for band in im.split()]
+    red, green, blue, alpha = im.split()
+    return [ubyte2color(img2arr(band)) for band in (red, green, blue)] + [img2chan(alpha)]
 
 def rgba2lum(rgba):
     """ Convert four Numeric array objects to single luminance array.
@@ -46,3 +146,49 @@ def rgba2lum(rgba):
     red, green, blue = rgba[0:3]
     luminance = 0.299 * red + 0.587 * green + 0.114 * blue
     return luminance
+
+def intersection(rect1, rect2):
+    """ Return a (left, top, width, height) rectangle covered by both of two others, possibly empty.
+    """
+    left, top = max(rect1[0], rect2[0]), max(rect1[1], rect2[1])
+    right = min(rect1[0] + rect1[2], rect2[0] + rect2[2])
+    bottom = min(rect1[1] + rect1[3], rect2[1] + rect2[3])
+    
+    return left, top, max(0, right - left), max(0, bottom - top)
+
+def union(rect1, rect2):
+    """ Return a (left, top, width, height) rectangle covering two others, or None if either is None.
+    """
+    if rect1 is None or rect2 is None:
+        return None
+    
+    left, top = min(rect1[0], rect2[0]), min(rect1[1], rect2[1])
+    right = max(rect1[0] + rect1[2], rect2[0] + rect2[2])
+    bottom = max(rect1[1] + rect1[3], rect2[1] + rect2[3])
+    
+    return left, top, right - left, bottom - top
+
+def _floats(values):
+    """ Return values as a floating point array, keeping any float type they have.
+    """
+    values = numpy.asarray(values)
+    return values if values.dtype.kind == 'f' else values.astype(float)
+
+def _linear(values):
+    """ Convert sRGB values from 0 to 1 to linear light, with the sRGB formula.
+    """
+    return numpy.where(values <= 0.04045, values / 12.92, ((values + 0.055) / 1.055) ** 2.4)
+
+def _srgb(values):
+    """ Convert linear light values from 0 to 1 to sRGB, with the sRGB formula.
+    """
+    return numpy.where(values <= 0.0031308, values * 12.92, 1.055 * values ** (1 / 2.4) - 0.055)
+
+_colorspace = 'srgb'
+
+# linear value of each 8-bit sRGB value, and linear values halfway between them
+_decoding = _linear(numpy.arange(256) / 255.0).astype(numpy.float32)
+_encoding = _linear((numpy.arange(256) + 0.5) / 255.0).astype(numpy.float32)
+
+# halfway values are at least 1/3300 apart, so each step passes at most one
+_encoding_steps = numpy.searchsorted(_encoding, numpy.arange(4097) / 4096., side='right').astype(numpy.ubyte)
@@ -0,0 +1,260 @@
+""" Background execution of compositing work.
+
+NumPy releases the interpreter lock for most array math, so blends and
+adjustments can run on a small pool of worker threads while a server keeps
+handling other requests. An Executor limits how many jobs run at once and how
+many may wait in line; submitting to a full executor blocks the caller until
+there is room, which pushes back on whatever is producing work.
+
+>>> from Blit import Bitmap, Color, workers
+>>> executor = workers.Executor(threads=4, backlog=16)
+>>> job = Bitmap('photo.jpg').blend_async(Color(255, 153, 0), opacity=.5, executor=executor)
+>>> image = job.result()
+
+Jobs can be cancelled, so renders for clients that have gone away can be
+abandoned. A job that has not started yet is dropped from the queue, and the
+result of a job that is already running is thrown away when it finishes.
+
+Under asyncio, jobs may be awaited directly, and cancelling the awaiting task
+cancels the job:
+
+>>> layer = await Bitmap('photo.jpg').blend_async(Color(255, 153, 0), opacity=.5)
+"""
+from collections import deque
+import threading
+import logging
+import time
+
+class Cancelled (Exception):
+    """ Raised for the result of a cancelled job.
+    """
+    pass
+
+class Busy (Exception):
+    """ Raised when an executor has no room for a new job before a timeout.
+    """
+    pass
+
+class Job:
+    """ Pending result of a function called on an executor's worker thread.
+    """
+    def __init__(self, func, args, kwargs, release=None):
+        """ Optional release is called once the job no longer needs a thread:
+            when it's cancelled before starting, or when its function returns.
+        """
+        self._call = func, args, kwargs
+        self._release = release
+        self._state = 'pending'
+        self._result, self._error = None, None
+        self._callbacks = []
+        self._finished = threading.Event()
+        self._lock = threading.Lock()
+    
+    def cancel(self):
+        """ Abandon the job, return true if it had not already finished.
+        """
+        with self._lock:
+            if self._state in ('finished', 'cancelled'):
+                return self._state == 'cancelled'
+            
+            started, self._state = (self._state == 'running'), 'cancelled'
+        
+        if not started and self._release:
+            # a running job keeps its place until its function returns
+            self._release(self)
+        
+        self._finish()
+        return True
+    
+    def cancelled(self):
+        """ Return true if the job was cancelled.
+        """
+        return self._state == 'cancelled'
+    
+    def done(self):
+        """ Return true if the job has finished or was cancelled.
+        """
+        return self._finished.is_set()
+    
+    def result(self, timeout=None):
+        """ Wait for the job and return its result, or raise its exception.
+        """
+        if not self._finished.wait(timeout):
+            raise Busy('Job did not finish in %s seconds' % timeout)
+        
+        if self._state == 'cancelled':
+            raise Cancelled()
+        
+        if self._error is not None:
+            raise self._error
+        
+        return self._result
+    
+    def add_done_callback(self, callback):
+        """ Call a function with this job when it finishes or is cancelled.
+        
+            Callbacks are called from the worker thread, or right away
+            if the job is already done.
+        """
+        with self._lock:
+            if not self._finished.is_set():
+                self._callbacks.append(callback)
+                return
+        
+        callback(self)
+    
+    def __await__(self):
+        """ Wait for the job from an asyncio coroutine.
+        """
+        import asyncio
+        
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        
+        def settle(job):
+            if future.done():
+                return
+            elif job.cancelled():
+                future.cancel()
+            elif job._error is not None:
+                future.set_exception(job._error)
+            else:
+                future.set_result(job._result)
+        
+        def abandon(future):
+            if future.cancelled():
+                self.cancel()
+        
+        future.add_done_callback(abandon)
+        self.add_done_callback(lambda job: loop.call_soon_threadsafe(settle, job))
+        
+        return future.__await__()
+    
+    def _run(self):
+        """ Call the function, unless the job was cancelled first.
+        """
+        with self._lock:
+            if self._state != 'pending':
+                return
+            
+            self._state = 'running'
+        
+        func, args, kwargs = self._call
+        
+        try:
+            result, error = func(*args, **kwargs), None
+        except Exception as e:
+            result, error = None, e
+        
+        if self._release:
+            self._release(self)
+        
+        with self._lock:
+            if self._state == 'cancelled':
+                return
+            
+            self._result, self._error = result, error
+            self._state = 'finished'
+        
+        self._finish()
+    
+    def _finish(self):
+        """ Wake up anyone waiting and run callbacks.
+        
+            Errors in callbacks are logged, so they can't stop a worker thread.
+        """
+        with self._lock:
+            callbacks, self._callbacks = self._callbacks, []
+            self._finished.set()
+        
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                _log.exception('Error in job done callback')
+
+class Executor:
+    """ Bounded pool of worker threads for compositing jobs.
+    """
+    def __init__(self, threads=2, backlog=None, timeout=None):
+        """ Threads is the number of jobs that can run at once.
+        
+            Backlog is the number of jobs that can wait for a thread,
+            unlimited by default. When the backlog is full, submit() blocks
+            until there is room, or raises Busy after optional timeout.
+        """
+        self._threads = threads
+        self._timeout = timeout
+        self._limit = None if backlog is None else threads + backlog
+        self._pending = 0
+        self._room = threading.Condition()
+        self._queue = deque()
+        self._ready = threading.Condition()
+        self._workers = []
+    
+    def submit(self, func, *args, **kwargs):
+        """ Return a new Job that calls the function on a worker thread.
+        """
+        with self._room:
+            if self._timeout is not None:
+                deadline = time.time() + self._timeout
+            
+            while self._limit is not None and self._pending >= self._limit:
+                if self._timeout is None:
+                    self._room.wait()
+                elif time.time() < deadline:
+                    self._room.wait(deadline - time.time())
+                else:
+                    raise Busy('No room for another job in %s seconds' % self._timeout)
+            
+            self._pending += 1
+        
+        job = Job(func, args, kwargs, self._release)
+        
+        with self._ready:
+            self._queue.append(job)
+            self._ready.notify()
+            
+            if len(self._workers) < self._threads:
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+        
+        return job
+    
+    def _release(self, job):
+        """ Make room for another job when one is done.
+        """
+        with self._room:
+            self._pending -= 1
+            self._room.notify()
+    
+    def _work(self):
+        """ Run jobs from the queue forever.
+        """
+        while True:
+            with self._ready:
+                while not self._queue:
+                    self._ready.wait()
+                
+                job = self._queue.popleft()
+            
+            try:
+                job._run()
+            except Exception:
+                # keep the thread alive, nothing will replace it
+                _log.exception('Error running job')
+
+_default = None
+_log = logging.getLogger(__name__)
+
+def default():
+    """ Return a shared Executor, created on first use.
+    """
+    global _default
+    
+    if _default is None:
+        _default = Executor(threads=2)
+    
+    return _default
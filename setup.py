@@ -10,9 +10,9 @@ setup(name='Blit',
       author='Michal Migurski',
       author_email='mike@stamen.com',
       url='https://github.com/migurski/Blit',
-      requires=['numpy', 'sympy', 'PIL'],
+      requires=['numpy', 'PIL'],
       packages=['Blit'],
-      scripts=[],
+      scripts=['scripts/blit'],
       data_files=[],
       download_url='https://github.com/downloads/migurski/Blit/Blit-%(version)s.tar.gz' % locals(),
       license='BSD')